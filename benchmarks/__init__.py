@@ -0,0 +1,14 @@
+"""
+Benchmarks for the Recommendation Service
+
+Benchmarks run against the database in BENCHMARK_DATABASE_URI (a throwaway
+SQLite file by default) and drop its tables, so never point it at a
+database whose data you want to keep.
+"""
+import os
+
+BENCHMARK_DATABASE_URI = os.getenv(
+    "BENCHMARK_DATABASE_URI", "sqlite:////tmp/recommendations-benchmark.db"
+)
+# read by config.py when the app is created
+os.environ["DATABASE_URI"] = BENCHMARK_DATABASE_URI
@@ -0,0 +1,75 @@
+"""
+Benchmark of creating Recommendations one request at a time against
+POST /recommendations/batch
+
+Run with:
+    python -m benchmarks.batch_create --rows 10000 --batch-size 1000
+"""
+import argparse
+import logging
+import time
+
+from benchmarks import BENCHMARK_DATABASE_URI
+from service import app
+from service.models import db
+from tests.factories import RecommendationFactory
+
+
+def make_payload(count):
+    """Returns count serialized recommendations without ids"""
+    payload = []
+    for rec in RecommendationFactory.build_batch(count):
+        data = rec.serialize()
+        del data["id"]
+        payload.append(data)
+    return payload
+
+
+def run_single(client, payload):
+    """Creates the recommendations with one POST each"""
+    for data in payload:
+        resp = client.post("/recommendations", json=data)
+        assert resp.status_code == 201, resp.data
+
+
+def run_batch(client, payload, batch_size):
+    """Creates the recommendations with one POST per batch"""
+    for start in range(0, len(payload), batch_size):
+        resp = client.post("/recommendations/batch", json=payload[start:start + batch_size])
+        assert resp.status_code == 201, resp.data
+
+
+def measure(name, func, rows):
+    """Runs func on an empty table and prints its throughput"""
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:>8} rows {:>9.3f} s {:>12,.0f} rows/s".format(name, rows, elapsed, rows / elapsed))
+    return rows / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000, help="recommendations to create")
+    parser.add_argument("--batch-size", type=int, default=1000, help="recommendations per batch request")
+    args = parser.parse_args()
+
+    app.logger.setLevel(logging.CRITICAL)
+    logging.getLogger("flask.app").setLevel(logging.CRITICAL)
+    app.app_context().push()
+    client = app.test_client()
+    payload = make_payload(args.rows)
+    print("Database: {}".format(BENCHMARK_DATABASE_URI))
+    single = measure("POST /recommendations", lambda: run_single(client, payload), args.rows)
+    batch = measure("POST /recommendations/batch",
+                    lambda: run_batch(client, payload, args.batch_size), args.rows)
+    print("Speedup: {:.1f}x".format(batch / single))
+    db.session.remove()
+    db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
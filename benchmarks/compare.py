@@ -0,0 +1,58 @@
+"""
+Compares two benchmark result files from benchmarks.suite
+
+Prints the change of each metric per (scale, mode, scenario) and exits with
+status 1 if any scenario got slower than the threshold allows.
+
+Run with:
+    python -m benchmarks.compare baseline.json results.json --threshold 10
+"""
+import argparse
+import json
+import sys
+
+# metric: True if higher is better
+METRICS = {"p50_ms": False, "p95_ms": False, "p99_ms": False, "rps": True}
+
+
+def load(path: str) -> dict:
+    """Returns the results of a file keyed by (scale, mode, scenario)"""
+    with open(path) as results:
+        report = json.load(results)
+    return {(row["scale"], row["mode"], row["scenario"]): row for row in report["results"]}
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    """Returns the regressions of current against baseline, printing every change"""
+    regressions = []
+    for key in sorted(set(baseline) & set(current)):
+        changes = []
+        for metric, higher_is_better in METRICS.items():
+            before, after = baseline[key][metric], current[key][metric]
+            change = (after - before) / before * 100 if before else 0.0
+            worse = -change if higher_is_better else change
+            if worse > threshold:
+                regressions.append((key, metric, change))
+            changes.append("{} {:+6.1f}%{}".format(metric, change, " !" if worse > threshold else "  "))
+        print("{:>8} {:<9} {:<27} {}".format(*key, "  ".join(changes)))
+    for key in sorted(set(baseline) ^ set(current)):
+        print("{:>8} {:<9} {:<27} only in {}".format(*key, "baseline" if key in baseline else "current"))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("baseline", help="results of the reference run")
+    parser.add_argument("current", help="results of the run to check")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percentage a metric may get worse before it is a regression")
+    args = parser.parse_args()
+
+    regressions = compare(load(args.baseline), load(args.current), args.threshold)
+    if regressions:
+        print("{} regressions over {}%".format(len(regressions), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Seeds the benchmark database with a reproducible set of Recommendations
+
+Run with:
+    python -m benchmarks.seed --rows 100000
+"""
+import argparse
+import random
+import time
+
+from benchmarks import BENCHMARK_DATABASE_URI
+from service import app
+from service.models import Recommendation, RecommendationType, db
+
+# every query product gets about this many recommendations
+RECOMMENDATIONS_PER_PRODUCT = 10
+
+
+def seed(rows: int, chunk_size: int = 10000, random_seed: int = 42) -> int:
+    """Replaces the tables with rows Recommendations
+
+    The same rows and random_seed always produce the same table.
+
+    :return: the number of query products
+    :rtype: int
+
+    """
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    rng = random.Random(random_seed)
+    products = max(1, rows // RECOMMENDATIONS_PER_PRODUCT)
+    types = list(RecommendationType)
+    for start in range(0, rows, chunk_size):
+        Recommendation.create_many([
+            Recommendation(
+                product_id=rng.randrange(products),
+                rec_product_id=rng.randrange(products),
+                type=rng.choice(types),
+                interested=rng.randrange(1000),
+            )
+            for _ in range(min(chunk_size, rows - start))
+        ])
+    return products
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000, help="recommendations to create")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    args = parser.parse_args()
+
+    app.app_context().push()
+    start = time.perf_counter()
+    products = seed(args.rows, random_seed=args.seed)
+    print("Seeded {} with {} recommendations for {} products in {:.1f} s".format(
+        BENCHMARK_DATABASE_URI, args.rows, products, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Microbenchmark of encoding Recommendation responses: marshal_with and the
+stdlib json encoder against Recommendation.serialize() and orjson
+
+Run with:
+    python -m benchmarks.serialization --rows 1000 --repeat 200
+"""
+import argparse
+import json
+import timeit
+
+import orjson
+from flask_restx import marshal
+
+from benchmarks import BENCHMARK_DATABASE_URI  # noqa: F401 (sets DATABASE_URI)
+from service.routes import recommendation_model
+from tests.factories import RecommendationFactory
+
+
+def marshal_json(recs):
+    """The former path: serialize, marshal_with, then json.dumps"""
+    return json.dumps(marshal([rec.serialize() for rec in recs], recommendation_model)) + "\n"
+
+
+def serialize_orjson(recs):
+    """The current path: serialize, then orjson"""
+    return orjson.dumps([rec.serialize() for rec in recs], option=orjson.OPT_APPEND_NEWLINE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000, help="recommendations per response")
+    parser.add_argument("--repeat", type=int, default=200, help="responses encoded per measurement")
+    args = parser.parse_args()
+
+    recs = RecommendationFactory.build_batch(args.rows)
+    assert json.loads(marshal_json(recs)) == json.loads(serialize_orjson(recs))
+    results = {}
+    for func in (marshal_json, serialize_orjson):
+        best = min(timeit.repeat(lambda: func(recs), number=args.repeat, repeat=5))
+        results[func.__name__] = best / args.repeat
+        print("{:<18} {:>10.1f} us/response {:>12,.0f} rows/s".format(
+            func.__name__, best / args.repeat * 1e6, args.rows * args.repeat / best))
+    print("Speedup: {:.1f}x".format(results["marshal_json"] / results["serialize_orjson"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark of the columnar snapshot against SQL and ORM objects: memory held
+per row, the time of a page of a product's recommendations, and the time of
+a full load and of an incremental refresh after one write
+
+Run with:
+    python -m benchmarks.snapshot --rows 100000 --lookups 1000
+"""
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+from benchmarks import BENCHMARK_DATABASE_URI
+from benchmarks.seed import seed
+from service import app
+from service.models import Recommendation, RecommendationType, db
+from service.snapshot import RecommendationSnapshot
+
+
+def orm_bytes() -> int:
+    """Returns the memory taken by the whole table loaded as ORM instances"""
+    db.session.remove()
+    gc.collect()
+    tracemalloc.start()
+    recommendations = Recommendation.query.all()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del recommendations
+    db.session.remove()
+    return size
+
+
+def time_lookups(func, product_ids) -> float:
+    """Returns the mean seconds of func over the product ids"""
+    start = time.perf_counter()
+    for product_id in product_ids:
+        func(product_id)
+    return (time.perf_counter() - start) / len(product_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000, help="recommendations to seed")
+    parser.add_argument("--lookups", type=int, default=1000, help="product pages read per measurement")
+    parser.add_argument("--limit", type=int, default=100, help="recommendations per page")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    args = parser.parse_args()
+
+    app.logger.setLevel("CRITICAL")
+    app.app_context().push()
+    products = seed(args.rows, random_seed=args.seed)
+    print("Database: {}, {} recommendations".format(BENCHMARK_DATABASE_URI, args.rows))
+
+    snapshot = RecommendationSnapshot(refresh_interval=0)
+    snapshot.app = app
+    start = time.perf_counter()
+    snapshot.refresh()
+    print("Full load:             {:>10.1f} ms".format((time.perf_counter() - start) * 1000))
+    Recommendation(product_id=0, rec_product_id=1, type=RecommendationType.Generic).create()
+    start = time.perf_counter()
+    rows = snapshot.refresh()
+    print("Refresh after a write: {:>10.1f} ms ({} rows read)".format(
+        (time.perf_counter() - start) * 1000, rows))
+
+    orm = orm_bytes()
+    columnar = snapshot.stats()["bytes"]
+    print("ORM instances:         {:>10,} bytes {:>8.1f} bytes/row".format(orm, orm / args.rows))
+    print("Snapshot:              {:>10,} bytes {:>8.1f} bytes/row ({:.1%} of ORM)".format(
+        columnar, columnar / args.rows, columnar / orm))
+
+    rng = random.Random(args.seed)
+    product_ids = [rng.randrange(products) for _ in range(args.lookups)]
+
+    def sql_page(product_id):
+        query = Recommendation.find_rec_by_filter(product_id=product_id)
+        page, _ = Recommendation.find_page(query, args.limit, sort="interested")
+        db.session.remove()
+        return [recommendation.serialize() for recommendation in page]
+
+    def snapshot_page(product_id):
+        return snapshot.find_page(args.limit, sort="interested", product_id=product_id)[0]
+
+    assert sql_page(product_ids[0]) == snapshot_page(product_ids[0])
+    sql = time_lookups(sql_page, product_ids)
+    columnar = time_lookups(snapshot_page, product_ids)
+    print("SQL + ORM page:        {:>10.1f} us".format(sql * 1e6))
+    print("Snapshot page:         {:>10.1f} us".format(columnar * 1e6))
+    print("Speedup: {:.1f}x".format(sql / columnar))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Cold start benchmark
+
+Measures, in fresh processes, how long it takes to import the app
+(`from service import app`, what every gunicorn worker and test run does)
+and how long a gunicorn server takes from spawn to its first response.
+Pass --database-uri with an address nothing listens on to see how a slow or
+unreachable database affects startup.
+
+Run with:
+    python -m benchmarks.startup --repeat 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks import BENCHMARK_DATABASE_URI
+from benchmarks.suite import GunicornRunner
+
+IMPORT_APP = (
+    "import time; start = time.perf_counter(); from service import app; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def time_import(env: dict) -> float:
+    """Returns the seconds a fresh interpreter takes to import the app, None if it failed"""
+    result = subprocess.run([sys.executable, "-c", IMPORT_APP], env=env, capture_output=True,
+                            text=True, check=False)
+    if result.returncode != 0:
+        return None
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def time_boot(workers: int, timeout: float) -> float:
+    """Returns the seconds from spawning gunicorn to its first response, None if it failed"""
+    start = time.perf_counter()
+    try:
+        runner = GunicornRunner(workers, startup_timeout=timeout)
+    except RuntimeError:
+        return None
+    elapsed = time.perf_counter() - start
+    runner.close()
+    return elapsed
+
+
+def summary(name: str, values: list):
+    """Prints the median and range of a measurement"""
+    if not values:
+        print("{:<22} failed".format(name))
+        return
+    print("{:<22} median {:>8.1f} ms  min {:>8.1f} ms  max {:>8.1f} ms".format(
+        name, statistics.median(values) * 1000, min(values) * 1000, max(values) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10, help="measurements of each kind")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for gunicorn")
+    parser.add_argument("--database-uri", default=BENCHMARK_DATABASE_URI,
+                        help="database the app is configured with")
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URI"] = args.database_uri
+    env = dict(os.environ)
+    imports = [time_import(env) for _ in range(args.repeat)]
+    summary("import service.app", [value for value in imports if value is not None])
+    boots = [time_boot(args.workers, args.timeout) for _ in range(args.repeat)]
+    summary("gunicorn first response", [value for value in boots if value is not None])
+
+
+if __name__ == "__main__":
+    main()
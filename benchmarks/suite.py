@@ -0,0 +1,313 @@
+"""
+Endpoint benchmark suite
+
+Seeds the benchmark database at each scale, then drives every route of
+service/routes.py through the Flask test client and/or a real gunicorn
+process, and reports p50/p95/p99 latency and requests per second. Results
+are written as JSON that benchmarks.compare can diff between runs.
+
+Run with:
+    python -m benchmarks.suite --scales 1000,100000 --mode client,gunicorn \\
+        --requests 500 --concurrency 8 --output results.json
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from sqlalchemy.engine.url import make_url
+
+from benchmarks import BENCHMARK_DATABASE_URI
+from benchmarks.seed import seed
+from service import app
+from service.models import RecommendationType
+
+# A benchmarked request: make(rng) returns (method, path, json body or None)
+Scenario = namedtuple("Scenario", ["name", "make", "ok"])
+
+OK = (200, 201, 204, 304)
+# requests for ids or products that a write scenario already removed are fine
+OK_OR_MISSING = OK + (404,)
+
+
+def scenarios(rows: int, products: int, batch_size: int = 100, lookup_size: int = 20) -> list:
+    """Returns one Scenario per route, reads first and deletes last"""
+    types = [rec_type.name for rec_type in RecommendationType]
+
+    def rec_id(rng):
+        return rng.randrange(1, rows + 1)
+
+    def product(rng):
+        return rng.randrange(products)
+
+    def body(rng):
+        return {"product_id": product(rng), "rec_product_id": product(rng),
+                "type": rng.choice(types), "interested": 0}
+
+    return [
+        Scenario("index", lambda rng: ("GET", "/", None), OK),
+        Scenario("list", lambda rng: ("GET", "/recommendations", None), OK),
+        Scenario("list_by_product", lambda rng: (
+            "GET", "/recommendations?product_id={}".format(product(rng)), None), OK),
+        Scenario("list_by_product_and_type", lambda rng: (
+            "GET", "/recommendations?product_id={}&type={}".format(product(rng), rng.choice(types)),
+            None), OK),
+        Scenario("list_by_rec_product", lambda rng: (
+            "GET", "/recommendations?rec_product_id={}".format(product(rng)), None), OK),
+        Scenario("list_sorted_by_interested", lambda rng: (
+            "GET", "/recommendations?sort=interested&limit=20", None), OK),
+        Scenario("list_sorted_by_trending", lambda rng: (
+            "GET", "/recommendations?sort=trending&limit=20", None), OK),
+        Scenario("get", lambda rng: ("GET", "/recommendations/{}".format(rec_id(rng)), None),
+                 OK_OR_MISSING),
+        Scenario("get_batch", lambda rng: (
+            "GET", "/recommendations/batch?product_id={}&limit=5".format(
+                ",".join(str(product(rng)) for _ in range(lookup_size))), None), OK),
+        Scenario("top", lambda rng: (
+            "GET", "/products/{}/recommendations/top?n=5".format(product(rng)), None), OK),
+        Scenario("export_by_product", lambda rng: (
+            "GET", "/recommendations/export?product_id={}".format(product(rng)), None), OK),
+        Scenario("create", lambda rng: ("POST", "/recommendations", body(rng)), OK),
+        Scenario("create_batch", lambda rng: (
+            "POST", "/recommendations/batch", [body(rng) for _ in range(batch_size)]), OK),
+        Scenario("update", lambda rng: (
+            "PUT", "/recommendations/{}".format(rec_id(rng)), body(rng)), OK_OR_MISSING),
+        Scenario("interested", lambda rng: (
+            "PUT", "/recommendations/{}/interested".format(rec_id(rng)), None), OK_OR_MISSING),
+        Scenario("interested_batch", lambda rng: (
+            "PUT", "/recommendations/interested", [rec_id(rng) for _ in range(batch_size)]), OK),
+        Scenario("delete", lambda rng: (
+            "DELETE", "/recommendations/{}".format(rec_id(rng)), None), OK_OR_MISSING),
+    ]
+
+
+######################################################################
+#  R U N N E R S
+######################################################################
+class FlaskClientRunner:
+    """Sends requests through the Flask test client, in process"""
+
+    name = "client"
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def send(self, method, path, body):
+        """Sends a request and returns its status code"""
+        if body is None and method == "PUT":
+            resp = self.client.open(path, method=method, content_type="application/json")
+        else:
+            resp = self.client.open(path, method=method, json=body)
+        resp.get_data()  # drain streamed responses
+        return resp.status_code
+
+    def close(self):
+        """Nothing to clean up"""
+
+
+class GunicornRunner:
+    """Sends requests over HTTP to a gunicorn process serving the app"""
+
+    name = "gunicorn"
+
+    def __init__(self, workers: int = 1, extra_args: str = "", startup_timeout: float = 60,
+                 app_path: str = "service:app"):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        command = [sys.executable, "-m", "gunicorn", "--workers", str(workers),
+                   "--bind", "127.0.0.1:{}".format(self.port), "--log-level", "warning",
+                   *shlex.split(extra_args), app_path]
+        self.process = subprocess.Popen(command, env=dict(os.environ))
+        self.local = threading.local()
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            try:
+                self.send("GET", "/", None)
+                break
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.close()
+                    raise RuntimeError("gunicorn did not start: " + " ".join(command))
+                time.sleep(0.2)
+
+    def send(self, method, path, body):
+        """Sends a request and returns its status code"""
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        elif method == "PUT":
+            headers["Content-Type"] = "application/json"
+        conn = getattr(self.local, "conn", None)
+        # a kept-alive connection may have been closed by the server while idle
+        retry = conn is not None
+        while True:
+            if conn is None:
+                conn = self.local.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                break
+            except (http.client.HTTPException, OSError) as error:
+                conn.close()
+                conn = self.local.conn = None
+                if not (retry and isinstance(error, (http.client.RemoteDisconnected, ConnectionError))):
+                    raise
+                retry = False
+        if resp.will_close:
+            conn.close()
+            self.local.conn = None
+        return resp.status
+
+    def close(self):
+        """Stops gunicorn"""
+        self.process.terminate()
+        self.process.wait(timeout=30)
+
+
+######################################################################
+#  M E A S U R E M E N T
+######################################################################
+def percentile(values: list, fraction: float) -> float:
+    """Returns the nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def measure(runner, scenario, requests: int, concurrency: int, warmup: int, random_seed: int) -> dict:
+    """Runs a scenario and returns its latency percentiles and throughput"""
+    rng = random.Random(random_seed)
+    for _ in range(warmup):
+        runner.send(*scenario.make(rng))
+
+    plans = [scenario.make(rng) for _ in range(requests)]
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(plan_slice):
+        local_latencies = []
+        local_errors = 0
+        for method, path, body in plan_slice:
+            start = time.perf_counter()
+            try:
+                code = runner.send(method, path, body)
+            except (http.client.HTTPException, OSError):
+                code = None
+            local_latencies.append(time.perf_counter() - start)
+            if code not in scenario.ok:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    threads = [threading.Thread(target=worker, args=(plans[i::concurrency],))
+               for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "scenario": scenario.name,
+        "requests": requests,
+        "errors": sum(errors),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "rps": round(requests / elapsed, 1),
+    }
+
+
+def git_revision() -> str:
+    """Returns the commit being benchmarked, if known"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scales", default="1000,10000",
+                        help="comma separated numbers of recommendations to seed")
+    parser.add_argument("--mode", default="client,gunicorn",
+                        help="comma separated runners: client, gunicorn")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="concurrent connections for the gunicorn runner")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--gunicorn-args", default="",
+                        help='extra gunicorn arguments, e.g. "--worker-class gthread --threads 4"')
+    parser.add_argument("--scenarios", default="", help="comma separated scenarios to run (default all)")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    app.logger.setLevel("CRITICAL")
+    app.app_context().push()
+    selected = set(filter(None, args.scenarios.split(",")))
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database": repr(make_url(BENCHMARK_DATABASE_URI)),
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "workers": args.workers,
+            "gunicorn_args": args.gunicorn_args,
+        },
+        "results": [],
+    }
+    for scale in [int(value) for value in args.scales.split(",")]:
+        for mode in args.mode.split(","):
+            products = seed(scale, random_seed=args.seed)
+            if mode == "client":
+                runner, concurrency = FlaskClientRunner(), 1
+            else:
+                runner, concurrency = GunicornRunner(args.workers, args.gunicorn_args), args.concurrency
+            try:
+                for scenario in scenarios(scale, products):
+                    if selected and scenario.name not in selected:
+                        continue
+                    result = measure(runner, scenario, args.requests, concurrency,
+                                     args.warmup, args.seed)
+                    result.update(scale=scale, mode=runner.name, concurrency=concurrency)
+                    report["results"].append(result)
+                    print("{:>8} {:<9} {:<27} p50 {:>8.2f} ms  p95 {:>8.2f} ms  p99 {:>8.2f} ms"
+                          "  {:>9.1f} req/s  {} errors".format(
+                              scale, runner.name, scenario.name, result["p50_ms"], result["p95_ms"],
+                              result["p99_ms"], result["rps"], result["errors"]))
+            finally:
+                runner.close()
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+        print("Results written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,112 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Read replicas: comma separated database URIs that GET requests read from,
+# seconds a client reads from the primary after it changed data, and seconds
+# a replica that could not be connected to is left alone
+SQLALCHEMY_REPLICA_URIS = [uri for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri]
+REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+REPLICA_RETRY_INTERVAL = float(os.getenv("REPLICA_RETRY_INTERVAL", "30"))
+
+# Connection pool of each worker process: connections kept open, extra
+# connections opened under load, seconds to wait for a free connection before
+# failing, seconds after which a connection is replaced, and whether to test
+# a connection before handing it out. Size it so that DB_POOL_SIZE covers the
+# threads of a worker (GUNICORN_THREADS) and workers * (DB_POOL_SIZE +
+# DB_MAX_OVERFLOW) stays below the connection limit of the database
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1", "yes")
+
+# SQLite opens a connection per checkout and takes no pool size options, the
+# engine of each database URI only gets the options that apply to it
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_pre_ping": DB_POOL_PRE_PING,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+}
+
+# Connections of each worker of the async read path (service.asgi): a worker
+# runs many queries at once, so it needs more connections than a thread pool
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "20"))
+
+# Pagination of GET /recommendations: page size used when the client does
+# not ask for one, and the largest page size the server will return
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# Number of recommendations returned by GET /products/{id}/recommendations/top
+# when the client does not ask for a number
+TOP_N_DEFAULT = int(os.getenv("TOP_N_DEFAULT", "10"))
+
+# Number of rows read from the database at a time by GET /recommendations/export
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+
+# Largest number of recommendations accepted by POST /recommendations/batch
+BATCH_SIZE_MAX = int(os.getenv("BATCH_SIZE_MAX", "10000"))
+
+# Largest count of one click of PUT /recommendations/interested
+INTERESTED_COUNT_MAX = int(os.getenv("INTERESTED_COUNT_MAX", "1000"))
+
+# Largest number of products looked up by GET /recommendations/batch; each of
+# their lists holds at most limit (TOP_N_DEFAULT when not asked for, capped
+# at PAGE_SIZE_MAX) recommendations
+BATCH_LOOKUP_MAX = int(os.getenv("BATCH_LOOKUP_MAX", "50"))
+
+# Write coalescing of PUT /recommendations/{id}/interested: buffer the clicks
+# in process and write them every INTERESTED_FLUSH_INTERVAL seconds, or as soon
+# as INTERESTED_FLUSH_THRESHOLD clicks are pending
+INTERESTED_COALESCE = os.getenv("INTERESTED_COALESCE", "false").lower() in ("true", "1", "yes")
+INTERESTED_FLUSH_INTERVAL = float(os.getenv("INTERESTED_FLUSH_INTERVAL", "1.0"))
+INTERESTED_FLUSH_THRESHOLD = int(os.getenv("INTERESTED_FLUSH_THRESHOLD", "1000"))
+
+# Half-life in seconds of the interested events in the trending score that
+# ?sort=trending ranks by; scores already stored keep the decay they were
+# computed with, so changing it only gradually takes effect
+TRENDING_HALF_LIFE = float(os.getenv("TRENDING_HALF_LIFE", str(7 * 24 * 3600)))
+
+# Append-only interest events: turn them on to record clicks as INSERTs into
+# interest_event instead of UPDATEs of the recommendation, rolled up into the
+# counters every INTEREST_ROLLUP_INTERVAL seconds (0 only rolls them up with
+# flask recs rollup), at most INTEREST_ROLLUP_BATCH_SIZE events per transaction,
+# and into the hourly and/or daily aggregates listed in INTEREST_AGGREGATES
+INTEREST_EVENTS = os.getenv("INTEREST_EVENTS", "false").lower() in ("true", "1", "yes")
+INTEREST_ROLLUP_INTERVAL = float(os.getenv("INTEREST_ROLLUP_INTERVAL", "60"))
+INTEREST_ROLLUP_BATCH_SIZE = int(os.getenv("INTEREST_ROLLUP_BATCH_SIZE", "10000"))
+INTEREST_AGGREGATES = tuple(period for period in os.getenv("INTEREST_AGGREGATES", "").split(",") if period)
+
+# Compression of the responses of at least COMPRESS_MIN_SIZE bytes, with
+# brotli (when installed) at COMPRESS_BROTLI_QUALITY or gzip at
+# COMPRESS_GZIP_LEVEL; static files are compressed by flask compress-static
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "true").lower() in ("true", "1", "yes")
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "5"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))
+
+# Per worker cache of the recommendation lists of a product: the number of
+# lists kept (0 turns the cache off) and how many seconds a list may be served
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "4096"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+
+# Columnar in-memory snapshot of the recommendation table (needs numpy): turn
+# it on to answer list reads from memory in each worker, and how many seconds
+# apart it is refreshed from the database (0 only refreshes when asked to)
+SNAPSHOT_ENABLED = os.getenv("SNAPSHOT_ENABLED", "false").lower() in ("true", "1", "yes")
+SNAPSHOT_REFRESH_INTERVAL = float(os.getenv("SNAPSHOT_REFRESH_INTERVAL", "5"))
+
+# Statements slower than this many seconds are written to the log as
+# warnings, with their parameters left out (0 turns the slow query log off)
+SLOW_QUERY_THRESHOLD = float(os.getenv("SLOW_QUERY_THRESHOLD", "0.5"))
+
+# Return the number of statements of each request and the time they took in
+# a Server-Timing header; off by default, as it tells every client about the
+# internals of the service
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() in ("true", "1", "yes")
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
@@ -0,0 +1,40 @@
+"""
+gunicorn settings for the Recommendation Service
+
+gunicorn reads this file from the working directory on start. By default it
+runs WEB_CONCURRENCY gthread workers of GUNICORN_THREADS threads each; set
+GUNICORN_WORKER_CLASS=sync for one request at a time per worker. Command line
+options override these settings.
+
+Each worker is its own process with its own Prometheus metrics, so they write
+their samples to PROMETHEUS_MULTIPROC_DIR and GET /metrics adds up the files
+of all workers.
+"""
+import os
+import shutil
+import tempfile
+
+# must be set before prometheus_client is imported, by this file or the app:
+# it picks the value class of every metric, per process, at import time
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "recommendations-metrics"))
+
+from prometheus_client import multiprocess  # noqa: E402
+
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+# each thread serves a request with its own database session and connection,
+# so DB_POOL_SIZE should be at least this
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+
+
+def on_starting(server):
+    """Drops the samples left over by a previous run"""
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Drops the live gauges of a worker that exited"""
+    multiprocess.mark_process_dead(worker.pid)
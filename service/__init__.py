@@ -1,37 +1,75 @@
 """
 Package: service
 Package for the application models and service routes
-This module creates and configures the Flask app and sets up the logging
-and SQL database
+create_app() creates and configures the Flask app and sets up the logging
+and SQL database. The module attribute `app` (what `gunicorn service:app`
+and `from service import app` load) is created by create_app() on first use.
+
+Importing the app does not touch the database: the tables are created by
+`flask create-db` and the connections are opened by the first request.
 """
 import logging
 
 from flask import Flask
-import sys
 from service import log_handlers
 
-# Create Flask application
-app = Flask(__name__)
-app.config.from_object("config")
 
-# Import the routes After the Flask app is created
-from service import routes, models, error_handlers
+def create_app(config: str = "config") -> Flask:
+    """Creates and configures the Flask app
+
+    :param config: the name of the configuration module
+    :type config: str
+
+    :return: the Flask app
+    :rtype: Flask
+
+    """
+    # Create Flask application
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    # Import the routes After the Flask app is created
+    from service import (  # pylint: disable=import-outside-toplevel
+        routes, models, error_handlers, commands, counters, cache, metrics, querylog, replicas, rollup,
+        compression, assets,
+    )
+
+    # Set up logging for production
+    print("Setting up logging for {}...".format(__name__))
 
-# Set up logging for production
-print("Setting up logging for {}...".format(__name__))
+    log_handlers.init_logging(app, "gunicorn.error")
 
+    app.logger.info(70 * "*")
+    app.logger.info("=====   RECOMMENDATION SERVICE   =====".center(70, "*"))
+    app.logger.info(70 * "*")
 
-log_handlers.init_logging(app, "gunicorn.error")
+    # every app gets its own extensions, found in app.extensions
+    routes.init_app(app)
+    error_handlers.init_app(app)
+    models.init_app(app)
+    # the replica connection of a request is closed after its session
+    replicas.ReplicaRouter().init_app(app)
+    app.teardown_request(models.shutdown_session)
+    counters.InterestedCounter().init_app(app)
+    rollup.InterestRollup().init_app(app)
+    cache.RecommendationCache().init_app(app)
+    metrics.init_metrics(app)
+    querylog.init_querylog(app)
+    compression.init_compression(app)
+    assets.StaticAssets().init_app(app)
+    if app.config["SNAPSHOT_ENABLED"]:
+        # only imported when used, NumPy takes a while to import
+        from service.snapshot import RecommendationSnapshot  # pylint: disable=import-outside-toplevel
+        RecommendationSnapshot().init_app(app)
+    commands.init_app(app)
 
-app.logger.info(70 * "*")
-app.logger.info("=====   RECOMMENDATION SERVICE   =====".center(70, "*"))
-app.logger.info(70 * "*")
+    app.logger.info("Service inititalized!")
+    return app
 
-try:
-    models.init_db(app)  # make our sqlalchemy tables
-except Exception as error:
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
 
-app.logger.info("Service inititalized!")
+def __getattr__(name: str):
+    # creates the app the first time it is asked for
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
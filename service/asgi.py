@@ -0,0 +1,337 @@
+"""
+Asynchronous serving of the read routes
+
+An ASGI app that serves GET /recommendations and GET /recommendations/{id}
+on an async database driver (asyncpg for PostgreSQL, aiosqlite for SQLite),
+so that one worker process waits on many queries at once instead of holding
+a thread per request. Every other route, and every read it cannot answer
+itself (invalid parameters, 404s), is handed to the Flask app, which runs in
+a thread pool, so the status codes, headers and bodies are the same as the
+Flask app's.
+
+Reads follow the rules of the ReplicaRouter of the Flask app: with
+DATABASE_REPLICA_URIS set, a request reads from the next replica that is up,
+unless it has the sticky cookie of a recent write, and a statement that fails
+on a replica is run again on the primary. The list cache is only filled by
+reads from the primary and is skipped by sticky requests.
+
+Run with:
+    uvicorn service.asgi:app --workers 2
+or:
+    gunicorn --worker-class uvicorn.workers.UvicornWorker service.asgi:app
+"""
+import asyncio
+import itertools
+import time
+from types import SimpleNamespace
+
+import orjson
+from databases import Database
+from starlette.applications import Starlette
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+from werkzeug.urls import url_encode
+
+from service import app as flask_app
+from service.cache import TOO_LARGE
+from service.compression import encode_body
+from service.metrics import REQUEST_LATENCY, REQUESTS_IN_FLIGHT
+from service.models import DataValidationError, DataVersion, Recommendation, RecommendationType
+from service.replicas import STICKY_COOKIE
+from service.routes import etag_product_id, make_etag, version_scope
+
+flask = WSGIMiddleware(flask_app)
+# the list cache of the Flask app, shared with its routes
+recommendation_cache = flask_app.extensions["recommendation_cache"]
+
+
+def make_database(uri: str) -> Database:
+    """Returns the async database of a SQLAlchemy database URI"""
+    if uri.startswith("sqlite"):
+        return Database(uri)
+    size = flask_app.config["ASYNC_DB_POOL_SIZE"]
+    return Database(uri, min_size=min(size, flask_app.config["DB_POOL_SIZE"]), max_size=size)
+
+
+database = make_database(flask_app.config["SQLALCHEMY_DATABASE_URI"])
+
+
+class AsyncReplicas:
+    """Picks the database each request of the async path reads from"""
+
+    def __init__(self, uris: list, retry_interval: float = 30.0):
+        self.databases = [make_database(uri) for uri in uris]
+        self.retry_interval = retry_interval
+        self._down_until = {}
+        self._turn = itertools.count()
+        self._connecting = asyncio.Lock()
+
+    def reader(self, request: Request) -> "AsyncReader":
+        """Returns the reader of a request: the next replica that is up, or
+        the primary for sticky requests and when every replica is down"""
+        if not self.databases:
+            return AsyncReader(self, None)
+        if STICKY_COOKIE in request.cookies:
+            return AsyncReader(self, None, sticky=True)
+        start = next(self._turn)
+        for i in range(len(self.databases)):
+            replica = self.databases[(start + i) % len(self.databases)]
+            if self._down_until.get(replica, 0) <= time.monotonic():
+                return AsyncReader(self, replica)
+        return AsyncReader(self, None)
+
+    async def connect(self, replica: Database):
+        """Connects to a replica on its first read"""
+        async with self._connecting:
+            if not replica.is_connected:
+                await replica.connect()
+
+    def mark_down(self, replica: Database):
+        """Skips a replica for retry_interval seconds"""
+        self._down_until[replica] = time.monotonic() + self.retry_interval
+
+    async def disconnect(self):
+        """Closes the connections to the replicas"""
+        for replica in self.databases:
+            if replica.is_connected:
+                await replica.disconnect()
+
+
+class AsyncReader:
+    """Runs the statements of one request on its replica, or on the primary"""
+
+    def __init__(self, replicas: AsyncReplicas, replica: Database = None, sticky: bool = False):
+        self.replicas = replicas
+        self.replica = replica
+        self.sticky = sticky
+
+    @property
+    def reads_replica(self) -> bool:
+        """True if the statements of the request run on a replica"""
+        return self.replica is not None
+
+    async def fetch_one(self, statement):
+        """Returns the first row of a statement, as Database.fetch_one"""
+        return await self._fetch("fetch_one", statement)
+
+    async def fetch_all(self, statement):
+        """Returns all of the rows of a statement, as Database.fetch_all"""
+        return await self._fetch("fetch_all", statement)
+
+    async def fetch_val(self, statement):
+        """Returns the first column of the first row of a statement, as Database.fetch_val"""
+        return await self._fetch("fetch_val", statement)
+
+    async def _fetch(self, method: str, statement):
+        if self.replica is not None:
+            try:
+                await self.replicas.connect(self.replica)
+                return await getattr(self.replica, method)(statement)
+            except Exception as error:  # pylint: disable=broad-except
+                # the driver errors of asyncpg and aiosqlite have no common base
+                flask_app.logger.warning("Read replica %r failed, reading from the primary: %s",
+                                         self.replica.url.obscure_password, error)
+                self.replicas.mark_down(self.replica)
+                self.replica = None  # the rest of the request reads from the primary
+        return await getattr(database, method)(statement)
+
+
+replicas = AsyncReplicas(flask_app.config["SQLALCHEMY_REPLICA_URIS"], flask_app.config["REPLICA_RETRY_INTERVAL"])
+
+
+class AsyncRoute:
+    """An ASGI endpoint that serves GET requests with an async handler
+
+    The handler returns a Response, or None to hand the request to the Flask
+    app, which then answers it as if there were no async path at all.
+    """
+
+    def __init__(self, rule: str, handler):
+        self.rule = rule
+        self.handler = handler
+
+    async def __call__(self, scope, receive, send):
+        if scope["method"] != "GET":
+            await flask(scope, receive, send)
+            return
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            response = await self.handler(Request(scope, receive))
+            if response is not None:
+                await response(scope, receive, send)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+        if response is None:
+            await flask(scope, receive, send)  # the Flask app records its own metrics
+            return
+        REQUEST_LATENCY.labels("GET", self.rule, str(response.status_code)).observe(
+            time.perf_counter() - start)
+
+
+######################################################################
+#  PATH: /recommendations/{id}
+######################################################################
+async def get_recommendation(request: Request):
+    """Returns a single Recommendation, as GET /recommendations/{id} of the Flask app"""
+    id = request.path_params["id"]
+    flask_app.logger.info("Request to Retrieve a recommendation with id [%s]", id)
+    if flask_app.config["INTEREST_EVENTS"]:
+        return None  # the Flask app adds the interest events that are not rolled up
+    reader = replicas.reader(request)
+    # a client that is up to date is told so without reading the Recommendation
+    product_id = etag_product_id(parse_etags(request.headers.get("If-None-Match")))
+    if product_id is not None:
+        scope = DataVersion.product_scope(product_id)
+        version = await get_version(reader, scope)
+        etag, not_modified = check_etag(request, scope, version, product_id)
+        if not_modified:
+            return Response(status_code=304, headers={"ETag": etag})
+    record = await reader.fetch_one(Recommendation.find_statement(id))
+    if record is None:
+        return None  # the Flask app words the 404
+    scope = DataVersion.product_scope(record["product_id"])
+    version = await get_version(reader, scope)
+    etag, _ = check_etag(request, scope, version, record["product_id"])
+    flask_app.logger.info("Returning recommendation: %s", id)
+    return json_response(request, serialize_record(record), {"ETag": etag})
+
+
+######################################################################
+#  PATH: /recommendations
+######################################################################
+async def list_recommendations(request: Request):
+    """Returns a page of Recommendations, as GET /recommendations of the Flask app"""
+    flask_app.logger.info("Request to list Recommendations...")
+    args = request.query_params
+    try:
+        product_id = parse_id(args.get("product_id"))
+        rec_product_id = parse_id(args.get("rec_product_id"))
+        rec_type = RecommendationType[args["type"]] if args.get("type") else None
+        sort = args.get("sort")
+        columns, _ = Recommendation.sort_order(sort)
+        limit = parse_page_size(args.get("limit"))
+        cursor = args.get("cursor")
+        after = Recommendation.decode_cursor(cursor, sort) if cursor else None
+    except (KeyError, ValueError, DataValidationError):
+        return None  # the Flask app words the 400, or the empty list of an unknown type
+
+    reader = replicas.reader(request)
+    scope = version_scope(args.get("product_id"))
+    version = await get_version(reader, scope)
+    etag, not_modified = check_etag(request, scope, version)
+    if not_modified:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    # the cached lists have no trending score to sort by
+    cached = await find_cached(reader, product_id, rec_product_id, rec_type, version) \
+        if sort != "trending" else None
+    if cached is not None:
+        results, last_key = Recommendation.paginate_rows(cached, limit, after, sort)
+    else:
+        records = await reader.fetch_all(Recommendation.page_statement(
+            limit, after, sort, product_id=product_id, rec_product_id=rec_product_id, type=rec_type))
+        results = [serialize_record(record) for record in records[:limit]]
+        last_key = tuple(records[limit - 1][col.key] for col in columns) if len(records) > limit else None
+    headers = {"ETag": etag}
+    if last_key is not None:
+        headers["Link"] = '<{}>; rel="next"'.format(
+            next_url(request, Recommendation.encode_cursor(last_key)))
+    flask_app.logger.info("Returning %d recommendations", len(results))
+    return json_response(request, results, headers)
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+async def find_cached(reader: AsyncReader, product_id, rec_product_id, rec_type, version):
+    """Returns the serialized Recommendations matching a filter through the
+    cache, or None if the filter is not cached, as find_cached of the Flask app"""
+    key = recommendation_cache.key(product_id, rec_product_id, rec_type and rec_type.name)
+    if key is None or not recommendation_cache.enabled or reader.sticky:
+        return None
+    rows = recommendation_cache.get(key, version)
+    if rows is None:
+        limit = flask_app.config["PAGE_SIZE_MAX"]
+        records = await reader.fetch_all(Recommendation.page_statement(
+            limit, product_id=product_id, rec_product_id=rec_product_id, type=rec_type))
+        if len(records) > limit:
+            rows = TOO_LARGE  # too many to keep in the cache
+        else:
+            rows = [serialize_record(record) for record in records]
+        # a replica may not have the latest writes yet
+        if not reader.reads_replica:
+            recommendation_cache.set(key, rows, version)
+    return rows if rows is not TOO_LARGE else None
+
+
+async def get_version(reader: AsyncReader, scope: str) -> int:
+    """Returns the version of a DataVersion scope, as DataVersion.get"""
+    return await reader.fetch_val(DataVersion.get_statement(scope))
+
+
+def check_etag(request: Request, scope: str, version: int, product_id: int = None):
+    """Returns the ETag of the response to a request and whether the client
+    already has it, as check_etag of the Flask app"""
+    full_path = "{}?{}".format(request.scope["path"], request.scope["query_string"].decode("utf-8", "replace"))
+    etag = make_etag(scope, version, full_path, product_id)
+    return quote_etag(etag, weak=True), parse_etags(request.headers.get("If-None-Match")).contains_weak(etag)
+
+
+def parse_id(value):
+    """Returns a product id query parameter as an int, None if it is missing"""
+    return int(value) if value else None
+
+
+def parse_page_size(value):
+    """Returns the page size asked for, capped at the server maximum, as get_page_size of the Flask app"""
+    if value is None:
+        return flask_app.config["PAGE_SIZE_DEFAULT"]
+    limit = int(value)
+    if limit < 1:
+        raise ValueError("limit must be a positive integer")
+    return min(limit, flask_app.config["PAGE_SIZE_MAX"])
+
+
+def next_url(request: Request, cursor: str) -> str:
+    """Returns the URL of the next page of a list, as the Flask app builds it"""
+    args = {key: request.query_params[key] for key in request.query_params.keys()}
+    args["cursor"] = cursor
+    return "{}://{}{}/recommendations?{}".format(
+        request.url.scheme, request.headers.get("host", request.url.netloc),
+        request.scope.get("root_path", ""), url_encode(args))
+
+
+def serialize_record(record) -> dict:
+    """Serializes a row fetched by the async driver into a dictionary"""
+    return Recommendation.serialize_row(SimpleNamespace(**dict(record.items())))
+
+
+def json_response(request: Request, data, headers: dict) -> Response:
+    """Makes a response with a JSON encoded body, as output_json and the
+    response compression of the Flask app"""
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+    if flask_app.debug:
+        option |= orjson.OPT_INDENT_2
+    body = orjson.dumps(data, option=option)
+    if flask_app.config["COMPRESS_ENABLED"]:
+        headers["Vary"] = "Accept-Encoding"
+        body, encoding = encode_body(body, "application/json",
+                                     parse_accept_header(request.headers.get("accept-encoding")), flask_app.config)
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+
+app = Starlette(
+    routes=[
+        Route("/recommendations", AsyncRoute("/recommendations", list_recommendations)),
+        Route("/recommendations/{id:int}", AsyncRoute("/recommendations/<int:id>", get_recommendation)),
+        Mount("/", app=flask),
+    ],
+    on_startup=[database.connect],
+    on_shutdown=[database.disconnect, replicas.disconnect],
+)
@@ -0,0 +1,162 @@
+"""
+In-memory, fingerprinted static assets of the admin UI
+
+Every file of the static folder is read once when the app is created. Each
+asset is also served under a name with a hash of its content, e.g.
+css/blue_bootstrap.min.3f1c9a0b2d4e.css, with
+Cache-Control: public, max-age=31536000, immutable. A new version of a file
+gets a new name, so browsers can keep an asset for a year without ever
+revalidating it. index.html is rewritten in memory to link the fingerprinted
+names, and is sent with Cache-Control: no-cache, an ETag and a Last-Modified,
+so a repeat load of the UI costs one 304 for the page and nothing for its
+assets. The original names still work, with the same validators as the page.
+
+No request touches the filesystem. An asset is compressed the first time a
+client asks for an encoding, and kept, so nothing has to be compressed at
+deploy time; gzip and brotli files written by `flask compress-static` at
+build time are loaded with the assets instead, when they are up to date.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from datetime import datetime
+
+from flask import Flask, Response, current_app, request
+from werkzeug.exceptions import NotFound
+from werkzeug.local import LocalProxy
+
+from service.compression import COMPRESSIBLE_MIMETYPES, STATIC_SUFFIXES, compress, encodings
+
+# Cache-Control of the fingerprinted names, of the original names and the page
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# the static links of index.html that are rewritten to fingerprinted names
+STATIC_LINK = re.compile(r'((?:src|href)\s*=\s*")static/([^"?#]+)(")')
+
+
+class Asset:
+    """A static file held in memory with its validators and encodings"""
+
+    __slots__ = ("data", "mimetype", "etag", "last_modified", "fingerprinted", "_encoded", "_lock")
+
+    def __init__(self, name: str, data: bytes, last_modified: datetime):
+        self.data = data
+        self.mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.etag = hashlib.sha1(data).hexdigest()[:16]
+        self.last_modified = last_modified
+        root, extension = os.path.splitext(name)
+        self.fingerprinted = "{}.{}{}".format(root, self.etag[:12], extension)
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    def load_encoded(self, path: str):
+        """Loads the precompressed versions of the file at path that are up to date"""
+        for encoding, suffix in STATIC_SUFFIXES.items():
+            target = path + suffix
+            if os.path.isfile(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                with open(target, "rb") as compressed:
+                    self._encoded[encoding] = compressed.read()
+
+    def encoded(self, encoding: str, level: int) -> bytes:
+        """Returns the data compressed with an encoding, compressing it once"""
+        data = self._encoded.get(encoding)
+        if data is None:
+            with self._lock:
+                data = self._encoded.get(encoding)
+                if data is None:
+                    data = self._encoded[encoding] = compress(self.data, encoding, level)
+        return data
+
+
+class StaticAssets:
+    """The static folder of the app, preloaded and fingerprinted"""
+
+    def __init__(self):
+        self.app: Flask = None
+        self.assets = {}
+        self.fingerprinted = {}
+
+    def init_app(self, app: Flask):
+        """Loads the static folder of the app and serves the static files from memory"""
+        self.app = app
+        self.load()
+        app.view_functions["static"] = self.send
+        app.extensions["static_assets"] = self
+
+    def load(self):
+        """Reads every file of the static folder into memory"""
+        folder = self.app.static_folder
+        assets = {}
+        suffixes = tuple(STATIC_SUFFIXES.values())
+        for root, _, files in os.walk(folder):
+            for name in files:
+                if name.endswith(suffixes):
+                    continue
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, folder).replace(os.sep, "/")
+                with open(path, "rb") as source:
+                    asset = Asset(filename, source.read(),
+                                  datetime.utcfromtimestamp(int(os.path.getmtime(path))))
+                asset.load_encoded(path)
+                assets[filename] = asset
+        if "index.html" in assets:
+            index = assets["index.html"]
+            page = Asset("index.html", self.rewrite(index.data.decode(), assets).encode(), index.last_modified)
+            assets["index.html"] = page
+        self.assets = assets
+        self.fingerprinted = {asset.fingerprinted: asset for asset in assets.values()}
+
+    @staticmethod
+    def rewrite(html: str, assets: dict) -> str:
+        """Returns a page with its static links changed to fingerprinted names"""
+        def fingerprint(match):
+            asset = assets.get(match.group(2))
+            name = asset.fingerprinted if asset is not None else match.group(2)
+            return "{}static/{}{}".format(match.group(1), name, match.group(3))
+        return STATIC_LINK.sub(fingerprint, html)
+
+    def url(self, filename: str) -> str:
+        """Returns the fingerprinted URL of a static file"""
+        return "/static/" + self.assets[filename].fingerprinted
+
+    def send(self, filename: str) -> Response:
+        """Sends a static file from memory, by its original or fingerprinted name"""
+        asset = self.fingerprinted.get(filename)
+        if asset is not None:
+            return self.make_response(asset, IMMUTABLE)
+        asset = self.assets.get(filename)
+        if asset is None:
+            raise NotFound()
+        return self.make_response(asset, REVALIDATE)
+
+    def send_index(self) -> Response:
+        """Sends index.html, with the fingerprinted links of its assets"""
+        return self.send("index.html")
+
+    def make_response(self, asset: Asset, cache_control: str) -> Response:
+        """Makes the response of an asset in the best encoding the client accepts"""
+        config = current_app.config
+        compressible = (config["COMPRESS_ENABLED"] and asset.mimetype in COMPRESSIBLE_MIMETYPES
+                        and len(asset.data) >= config["COMPRESS_MIN_SIZE"])
+        encoding = request.accept_encodings.best_match(encodings()) if compressible else None
+        if encoding is None:
+            response = Response(asset.data, mimetype=asset.mimetype)
+            response.set_etag(asset.etag)
+        else:
+            level = config["COMPRESS_BROTLI_QUALITY"] if encoding == "br" else config["COMPRESS_GZIP_LEVEL"]
+            response = Response(asset.encoded(encoding, level), mimetype=asset.mimetype)
+            response.headers["Content-Encoding"] = encoding
+            # each encoding is a different representation of the asset
+            response.set_etag("{}-{}".format(asset.etag, encoding))
+        if compressible:
+            response.vary.add("Accept-Encoding")
+        response.last_modified = asset.last_modified
+        response.headers["Cache-Control"] = cache_control
+        return response.make_conditional(request)
+
+
+# the static assets of the current app, each app gets its own in create_app()
+static_assets = LocalProxy(lambda: current_app.extensions["static_assets"])
@@ -0,0 +1,76 @@
+"""
+Per-process background threads
+
+The interested counter, the interest rollup and the snapshot each do their
+work every few seconds in a daemon thread. gunicorn forks its workers after
+the app is imported, and a thread does not survive the fork, so the thread is
+started on first use in each worker rather than at init_app time, and started
+again by a worker that finds the one of its parent process.
+"""
+import logging
+import os
+import threading
+from typing import Callable
+
+logger = logging.getLogger("flask.app")
+
+
+class BackgroundThread:
+    """Calls a function every interval seconds in a thread of the current process"""
+
+    def __init__(self, target: Callable, interval: Callable[[], float], name: str,
+                 error: str = None, run_first: bool = False):
+        """
+        :param target: the function to call
+        :param interval: returns the seconds to wait between calls, read
+                         before every wait; no thread is started while it
+                         returns 0 or less
+        :param name: the name of the thread
+        :param error: the message logged when the function raises, which
+                      is then called again after the next interval
+        :param run_first: whether to call the function once before the first wait
+
+        """
+        self.target = target
+        self.interval = interval
+        self.name = name
+        self.error = error or "%s failed, will retry" % name
+        self.run_first = run_first
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def ensure_started(self):
+        """Starts the thread in this process if it isn't running"""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        if self.interval() <= 0:
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops the thread and waits for the call in progress to return"""
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        """Calls the target every interval seconds until stopped"""
+        if self.run_first:
+            self._call()
+        while not self._stop.wait(self.interval()):
+            self._call()
+
+    def _call(self):
+        try:
+            self.target()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception(self.error)
@@ -0,0 +1,149 @@
+"""
+Read-through cache of Recommendation lists
+
+Lists of serialized Recommendations are cached per filter, keyed by the tuple
+(product_id, rec_product_id, type) of GET /recommendations. The cache holds at
+most CACHE_SIZE lists, evicts the least recently used one when full, and
+expires lists CACHE_TTL seconds after they were read from the database.
+Filters matching more rows than a page are cached as TOO_LARGE.
+
+Each list is stored with the DataVersion it was read at, which the request
+reads first for its ETag, and is only served to requests that read the same
+version, so the cache of every worker process stays exact even though it only
+sees its own writes. Writes through the Recommendation model also drop the
+lists whose filter matches a row they touched, to free their space early.
+"""
+import threading
+import time
+from collections import OrderedDict
+from itertools import product
+
+from flask import Flask, current_app
+from werkzeug.local import LocalProxy
+
+# Cached in place of a list with more rows than a page, so that the reads of a
+# large product go straight to the database instead of reading (and dropping)
+# a full page first every time
+TOO_LARGE = object()
+
+
+class RecommendationCache:
+    """Bounded LRU cache with a TTL of Recommendation lists keyed by filter"""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app: Flask):
+        """Configures the cache from the Flask app"""
+        self.max_size = app.config["CACHE_SIZE"]
+        self.ttl = app.config["CACHE_TTL"]
+        self.clear()
+        app.extensions["recommendation_cache"] = self
+
+    @property
+    def enabled(self) -> bool:
+        """True if the cache holds anything at all"""
+        return self.max_size > 0
+
+    @staticmethod
+    def key(product_id=None, rec_product_id=None, type=None):
+        """Returns the cache key of a filter
+
+        :param product_id: the query product, as an int or a string
+        :param rec_product_id: the recommended product, as an int or a string
+        :param type: the name of a RecommendationType
+
+        :return: the key, or None if the filter is not cached
+        :rtype: tuple
+
+        """
+        try:
+            product_id = int(product_id) if product_id else None
+            rec_product_id = int(rec_product_id) if rec_product_id else None
+        except ValueError:
+            return None
+        # only lists scoped to a product are small enough to be worth caching
+        if product_id is None and rec_product_id is None:
+            return None
+        return (product_id, rec_product_id, type or None)
+
+    def get(self, key: tuple, version):
+        """Looks up a list
+
+        :param version: the data version of the filter, read before the lookup
+
+        :return: the list if it was read at that version, otherwise None
+        :rtype: list
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            fresh = entry is not None and entry[0] > time.monotonic()
+            if fresh and entry[1] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            # a newer list is kept for the requests that read a newer version
+            if entry is not None and (not fresh or entry[1] < version):
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key: tuple, value: list, version):
+        """Stores a list read from the database
+
+        :param version: the data version passed to the get() that missed; the
+                        list was read after it, so it is at least that new
+
+        """
+        with self._lock:
+            if not self.enabled:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, product_ids, rec_product_ids, types):
+        """Drops every list whose filter matches a row that was written
+
+        :param product_ids: the query products of the row, before and after the write
+        :param rec_product_ids: the recommended products of the row, before and after
+        :param types: the RecommendationType names of the row, before and after
+
+        """
+        keys = product((None, *product_ids), (None, *rec_product_ids), (None, *types))
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def invalidate_row(self, row):
+        """Drops every list whose filter matches a Recommendation or row of its columns"""
+        type_name = getattr(row.type, "name", row.type)
+        self.invalidate((row.product_id,), (row.rec_product_id,), (type_name,))
+
+    def clear(self):
+        """Drops every list"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Returns the hit, miss and eviction counters and the number of lists held"""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# the cache of the current app, each app gets its own in create_app()
+recommendation_cache = LocalProxy(lambda: current_app.extensions["recommendation_cache"])
@@ -0,0 +1,185 @@
+"""
+Flask CLI commands
+
+Run with the app set, e.g.:
+    FLASK_APP=service:app flask create-db
+    FLASK_APP=service:app flask compress-static
+    FLASK_APP=service:app flask recs bought-together order_lines.csv
+    FLASK_APP=service:app flask recs rollup
+    FLASK_APP=service:app flask recs import recommendations.csv
+    FLASK_APP=service:app flask recs export recommendations.ndjson
+"""
+import resource
+import sys
+import time
+
+import click
+from flask import Flask, current_app
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy.exc import IntegrityError
+
+from service import transfer
+from service.compression import compress_static
+from service.models import DataValidationError, Recommendation, RecommendationType
+from service.rollup import interest_rollup
+
+recs = AppGroup("recs", help="Bulk jobs on the recommendations.")
+
+# Seconds between two progress reports of the imports and exports
+PROGRESS_INTERVAL = 2.0
+
+
+def peak_memory() -> float:
+    """Returns the peak resident memory of this process so far, in MiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def init_app(app: Flask):
+    """Registers the commands on the Flask app"""
+    app.cli.add_command(create_db)
+    app.cli.add_command(compress_static_files)
+    app.cli.add_command(recs)
+
+
+@click.command("create-db")
+@with_appcontext
+def create_db():
+    """Creates the database tables and indexes that are missing"""
+    Recommendation.create_db()
+    click.echo("Database tables created")
+
+
+@click.command("compress-static")
+@with_appcontext
+def compress_static_files():
+    """Writes gzip and brotli versions of the static files, to be served as they are"""
+    written = compress_static(current_app.static_folder, current_app.config["COMPRESS_MIN_SIZE"])
+    for path, size, compressed in written:
+        click.echo("{} {:,} -> {:,} bytes".format(path, size, compressed))
+    click.echo("Compressed {} static files".format(len(written)))
+
+
+@recs.command("bought-together")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(["csv", "parquet"]),
+              help="Format of the file, guessed from its name by default.")
+@click.option("--top-k", default=10, show_default=True, type=click.IntRange(min=1),
+              help="Most products recommended per product.")
+@click.option("--min-support", default=2, show_default=True, type=click.IntRange(min=1),
+              help="Fewest orders a pair of products must be bought together in.")
+@click.option("--replace", is_flag=True,
+              help="Delete the BoughtTogether recommendations of the products that are not pairs any more.")
+@click.option("--dry-run", is_flag=True, help="Count the pairs without writing them.")
+def bought_together(path, file_format, top_k, min_support, replace, dry_run):
+    """Generates BoughtTogether recommendations from the order lines in PATH
+
+    PATH is a CSV (with a header) or Parquet file with order_id and
+    product_id columns, one line per product of an order.
+    """
+    # NumPy and SciPy take a while to import, so only this command pays for them
+    from service import cooccurrence  # pylint: disable=import-outside-toplevel
+
+    start = time.perf_counter()
+    try:
+        orders, products = cooccurrence.read_order_lines(path, file_format)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    product_ids, rec_product_ids, _ = cooccurrence.co_occurrence(orders, products, top_k, min_support)
+    click.echo("Read {} order lines, found {} pairs in {:.1f} s, peak memory {:.0f} MiB".format(
+        len(orders), len(product_ids), time.perf_counter() - start, peak_memory()))
+    if dry_run:
+        return
+    created, deleted = cooccurrence.upsert_bought_together(product_ids, rec_product_ids, replace)
+    click.echo("Created {} and deleted {} BoughtTogether recommendations in {:.1f} s, peak memory {:.0f} MiB".format(
+        created, deleted, time.perf_counter() - start, peak_memory()))
+
+
+@recs.command("rollup")
+@with_appcontext
+def rollup():
+    """Rolls the interest events up into the interested counters"""
+    start = time.perf_counter()
+    rolled = interest_rollup.run()
+    click.echo("Rolled up {} interest events in {:.1f} s".format(rolled, time.perf_counter() - start))
+
+
+@recs.command("import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option("--format", "file_format", type=click.Choice(["csv", "ndjson"]),
+              help="Format of the file, guessed from its name by default.")
+@click.option("--batch-size", default=10000, show_default=True, type=click.IntRange(min=1),
+              help="Rows validated and loaded at a time.")
+@click.option("--keep-ids", is_flag=True, help="Insert the ids of the file instead of new ones.")
+@click.option("--drop-indexes", is_flag=True,
+              help="Drop the secondary indexes during the load and rebuild them at the end.")
+@click.option("--replace", is_flag=True, help="Delete all the Recommendations first.")
+@click.option("--dry-run", is_flag=True, help="Validate the file without writing it.")
+def import_recommendations(path, file_format, batch_size, keep_ids, drop_indexes, replace, dry_run):
+    """Loads the Recommendations of a CSV or NDJSON file in one transaction
+
+    PATH is a CSV file (with a header) or a newline delimited JSON file, "-"
+    for stdin, with product_id, rec_product_id, type and interested, and
+    optionally id, as written by flask recs export. Every row is validated
+    like the body of a POST; the first invalid row aborts the import.
+    """
+    start = time.perf_counter()
+    lines = click.get_text_stream("stdin") if path == "-" else open(path, newline="", encoding="utf-8")
+    try:
+        count = transfer.import_rows(
+            lines, transfer.guess_format(path, file_format), batch_size, keep_ids=keep_ids,
+            drop_indexes=drop_indexes, replace=replace, dry_run=dry_run,
+            progress=_progress("Validated" if dry_run else "Loaded", start))
+    except DataValidationError as error:
+        raise click.ClickException("{}, {}".format(path, error))
+    except IntegrityError as error:
+        raise click.ClickException("{}: {}".format(path, error.orig))
+    finally:
+        if path != "-":
+            lines.close()
+    elapsed = time.perf_counter() - start
+    click.echo("{} {} Recommendations in {:.1f} s ({:,.0f} rows/s)".format(
+        "Validated" if dry_run else "Imported", count, elapsed, count / elapsed if elapsed else 0))
+
+
+@recs.command("export")
+@click.argument("path", type=click.Path(dir_okay=False, writable=True, allow_dash=True))
+@click.option("--format", "file_format", type=click.Choice(["csv", "ndjson"]),
+              help="Format of the file, guessed from its name by default.")
+@click.option("--product-id", type=int, help="Only export the Recommendations of a query product.")
+@click.option("--rec-product-id", type=int, help="Only export the Recommendations of a recommended product.")
+@click.option("--type", "rec_type", type=click.Choice([member.name for member in RecommendationType]),
+              help="Only export the Recommendations of a type.")
+@click.option("--chunk-size", default=10000, show_default=True, type=click.IntRange(min=1),
+              help="Rows fetched from the database and written at a time.")
+def export_recommendations(path, file_format, product_id, rec_product_id, rec_type, chunk_size):
+    """Writes the Recommendations to a CSV or NDJSON file in id order
+
+    PATH is the file to write, "-" for stdout. The progress goes to stderr.
+    """
+    start = time.perf_counter()
+    output = click.get_binary_stream("stdout") if path == "-" else open(path, "wb")
+    try:
+        count = transfer.export_rows(output, transfer.guess_format(path, file_format), product_id,
+                                     rec_product_id, rec_type, chunk_size, progress=_progress("Exported", start))
+    finally:
+        if path != "-":
+            output.close()
+    elapsed = time.perf_counter() - start
+    click.echo("Exported {} Recommendations in {:.1f} s ({:,.0f} rows/s)".format(
+        count, elapsed, count / elapsed if elapsed else 0), err=True)
+
+
+def _progress(verb: str, start: float):
+    """Returns a callback that reports the rows done so far and their rate on
+    stderr, at most once per PROGRESS_INTERVAL seconds"""
+    last = [start]
+
+    def report(count):
+        now = time.perf_counter()
+        if now - last[0] < PROGRESS_INTERVAL:
+            return
+        last[0] = now
+        click.echo("{} {:,} rows ({:,.0f} rows/s)".format(verb, count, count / (now - start)), err=True)
+    return report
@@ -0,0 +1,145 @@
+"""
+Compression of the responses
+
+API responses of a compressible type with a body of at least COMPRESS_MIN_SIZE
+bytes are compressed with the best encoding the client accepts: brotli at
+COMPRESS_BROTLI_QUALITY when the Brotli package is installed, or gzip at
+COMPRESS_GZIP_LEVEL. The default levels are low: on the JSON lists they get
+nearly all of the size reduction of the highest levels for a fraction of the
+CPU time per response (a 120 KB page of 1000 recommendations is 24 KB at gzip
+level 5 in 2 ms, 23 KB at level 9 in 12 ms).
+
+The static files of the admin UI only change with a deploy, so service.assets
+compresses each of them once per worker and keeps the result. A build may
+also run `flask compress-static`, which writes them at the highest levels
+next to the originals (index.html.gz, index.html.br); service.assets then
+loads those instead.
+
+Streamed responses (the NDJSON export) and files are never compressed per
+request.
+"""
+import gzip
+import mimetypes
+import os
+
+from flask import Flask, current_app, request
+
+try:
+    import brotli
+except ImportError:  # optional, responses are only gzipped without it
+    brotli = None
+
+# the types worth compressing; images and fonts already are
+COMPRESSIBLE_MIMETYPES = {
+    "application/json",
+    "application/javascript",
+    "application/x-ndjson",
+    "image/svg+xml",
+    "text/css",
+    "text/html",
+    "text/javascript",
+    "text/plain",
+}
+
+# the suffix of the precompressed static files of each encoding
+STATIC_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def init_compression(app: Flask):
+    """Compresses the responses of the app"""
+    if not app.config["COMPRESS_ENABLED"]:
+        return
+    app.after_request(_compress_response)
+
+
+def encodings() -> list:
+    """Returns the encodings responses can be compressed with, preferred first"""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """Compresses data with an encoding of encodings() at a level (or quality)"""
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    # no timestamp, so the same data always compresses to the same bytes
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def encode_body(body: bytes, mimetype: str, accept_encodings, config) -> tuple:
+    """Returns a response body compressed for a client, and its encoding
+
+    :param body: the uncompressed body
+    :param mimetype: the type of the body
+    :param accept_encodings: the parsed Accept-Encoding header of the request
+    :param config: the config of the app
+
+    :return: the body and the encoding, or the body as it was and None if it
+             is not worth compressing or the client does not accept any encoding
+    :rtype: tuple
+
+    """
+    if mimetype not in COMPRESSIBLE_MIMETYPES or len(body) < config["COMPRESS_MIN_SIZE"]:
+        return body, None
+    encoding = accept_encodings.best_match(encodings())
+    if encoding is None:
+        return body, None
+    level = config["COMPRESS_BROTLI_QUALITY"] if encoding == "br" else config["COMPRESS_GZIP_LEVEL"]
+    return compress(body, encoding, level), encoding
+
+
+def compress_static(folder: str, min_size: int = 0) -> list:
+    """Writes the compressed versions of the compressible files of a folder
+
+    Files whose compressed versions are newer than they are skipped, and so
+    are those that do not get smaller.
+
+    :param folder: the static folder
+    :param min_size: the smallest file worth compressing, in bytes
+
+    :return: the path, size and compressed size of each file written
+    :rtype: list
+
+    """
+    written = []
+    suffixes = tuple(STATIC_SUFFIXES.values())
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.endswith(suffixes) or mimetypes.guess_type(name)[0] not in COMPRESSIBLE_MIMETYPES:
+                continue
+            size = os.path.getsize(path)
+            if size < min_size:
+                continue
+            data = None
+            for encoding in encodings():
+                target = path + STATIC_SUFFIXES[encoding]
+                if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                    continue
+                if data is None:
+                    with open(path, "rb") as source:
+                        data = source.read()
+                compressed = compress(data, encoding, 11 if encoding == "br" else 9)
+                if len(compressed) >= size:
+                    continue
+                with open(target, "wb") as output:
+                    output.write(compressed)
+                written.append((target, size, len(compressed)))
+    return written
+
+
+def _compress_response(response):
+    """Compresses the body of a response when the client accepts it"""
+    if (response.direct_passthrough or response.is_streamed
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or "Content-Encoding" in response.headers):
+        return response
+    # caches must keep the compressed and the uncompressed response apart
+    response.vary.add("Accept-Encoding")
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    body, encoding = encode_body(response.get_data(), response.mimetype,
+                                 request.accept_encodings, current_app.config)
+    if encoding is not None:
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+    return response
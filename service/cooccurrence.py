@@ -0,0 +1,198 @@
+"""
+Co-occurrence pipeline for BoughtTogether recommendations
+
+Reads order lines (order_id, product_id) from a CSV or Parquet file and
+counts, for every pair of products, the orders that contain both. The counts
+are the sparse product x product matrix X.T @ X of the order x product
+incidence matrix X, so the work grows with the number of order lines and
+pairs, not with the square of the catalogue. The top_k products bought most
+often with each product, in at least min_support orders, become its
+BoughtTogether Recommendations.
+
+Run with:
+    FLASK_APP=service:app flask recs bought-together order_lines.csv --top-k 10 --min-support 5
+"""
+import csv
+import io
+import logging
+from array import array
+
+import numpy as np
+from scipy import sparse
+
+from service.cache import recommendation_cache
+from service.models import DataVersion, Recommendation, RecommendationType, db
+
+logger = logging.getLogger("flask.app")
+
+# the columns read from an order line file
+ORDER_ID = "order_id"
+PRODUCT_ID = "product_id"
+
+# product ids per IN list when reading the existing recommendations
+LOOKUP_CHUNK_SIZE = 1000
+# pairs per INSERT or COPY when creating the recommendations
+INSERT_CHUNK_SIZE = 10000
+
+
+def read_order_lines(path: str, file_format: str = None):
+    """Reads the order lines of a CSV or Parquet file
+
+    Order ids may be any string, they are only compared with each other;
+    product ids must be integers.
+
+    :param path: the file to read
+    :param file_format: "csv" or "parquet", guessed from the file name when None
+
+    :return: the order of each line as a small integer code, and its product id
+    :rtype: tuple of two arrays
+
+    """
+    file_format = file_format or ("parquet" if path.endswith((".parquet", ".pq")) else "csv")
+    if file_format == "parquet":
+        return _read_parquet(path)
+    if file_format != "csv":
+        raise ValueError("Unsupported order line format: " + file_format)
+    orders, products = array("q"), array("q")
+    codes = {}
+    with open(path, newline="") as lines:
+        reader = csv.reader(lines)
+        header = next(reader, [])
+        try:
+            order_column, product_column = header.index(ORDER_ID), header.index(PRODUCT_ID)
+        except ValueError:
+            raise ValueError("{} must have {} and {} columns".format(path, ORDER_ID, PRODUCT_ID))
+        for line, row in enumerate(reader, start=2):
+            try:
+                products.append(int(row[product_column]))
+            except (IndexError, ValueError):
+                raise ValueError("{}, line {}: invalid order line {}".format(path, line, row))
+            orders.append(codes.setdefault(row[order_column], len(codes)))
+    return np.frombuffer(orders, dtype=np.int64), np.frombuffer(products, dtype=np.int64)
+
+
+def _read_parquet(path: str):
+    try:
+        import pyarrow.parquet as parquet  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        raise ValueError("Reading Parquet files needs pyarrow (pip install pyarrow)")
+    table = parquet.read_table(path, columns=[ORDER_ID, PRODUCT_ID])
+    _, orders = np.unique(table.column(ORDER_ID).to_numpy(), return_inverse=True)
+    return orders.astype(np.int64), table.column(PRODUCT_ID).to_numpy().astype(np.int64)
+
+
+def co_occurrence(orders, products, top_k: int = 10, min_support: int = 2):
+    """Returns the products bought most often with each product
+
+    :param orders: the order of each order line, as integer codes
+    :param products: the product of each order line
+    :param top_k: the most pairs kept per product
+    :param min_support: the fewest orders a pair must be bought together in
+
+    :return: the product, the product bought with it and the number of
+             orders with both, of each pair; sorted by product, then by
+             count, highest first, then by the other product
+    :rtype: tuple of three arrays
+
+    """
+    product_ids, columns = np.unique(products, return_inverse=True)
+    order_codes, rows = np.unique(orders, return_inverse=True)
+    incidence = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, columns)),
+        shape=(len(order_codes), len(product_ids)),
+    )
+    incidence.data[:] = 1  # a product counts once per order however many lines it has
+    counts = (incidence.T @ incidence).tocoo()
+    keep = (counts.row != counts.col) & (counts.data >= min_support)
+    first, second, count = counts.row[keep], counts.col[keep], counts.data[keep]
+
+    order = np.lexsort((second, -count, first))
+    first, second, count = first[order], second[order], count[order]
+    # the rank of each pair among the pairs of its product
+    starts = np.searchsorted(first, first)
+    keep = np.arange(len(first)) - starts < top_k
+    return product_ids[first[keep]], product_ids[second[keep]], count[keep]
+
+
+def upsert_bought_together(product_ids, rec_product_ids, replace: bool = False) -> tuple:
+    """Creates the BoughtTogether Recommendations of pairs that do not have one
+
+    Existing Recommendations keep their interested counter. The deletes and
+    inserts are one transaction, so readers never see a product without its
+    BoughtTogether Recommendations.
+
+    :param product_ids: the product of each pair
+    :param rec_product_ids: the product bought with it
+    :param replace: also delete the BoughtTogether Recommendations that are
+                    not pairs any more, including those of products that are
+                    in no pair at all
+
+    :return: the number of Recommendations created and deleted
+    :rtype: tuple
+
+    """
+    pairs, first = np.unique(_pair_keys(product_ids, rec_product_ids), return_index=True)
+    product_ids, rec_product_ids = product_ids[first], rec_product_ids[first]
+    # every product is replaced, those missing from the pairs as well
+    ids, existing = _read_existing(None if replace else np.unique(product_ids).tolist())
+    new = ~np.isin(pairs, existing)
+    stale = ids[~np.isin(existing, pairs)] if replace else ids[:0]
+    logger.info("Creating %d and deleting %d BoughtTogether Recommendations", new.sum(), len(stale))
+    try:
+        Recommendation.delete_many(stale.tolist(), commit=False)
+        _insert(db.session.connection(), product_ids[new], rec_product_ids[new])
+        DataVersion.bump(np.unique(product_ids[new]).tolist())
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    recommendation_cache.clear()
+    return int(new.sum()), len(stale)
+
+
+def _pair_keys(product_ids, rec_product_ids):
+    """Packs each pair of 32-bit product ids into one 64-bit integer, so that
+    pairs are compared and sorted as a single array"""
+    return (product_ids.astype(np.int64) << 32) | (rec_product_ids.astype(np.int64) & 0xFFFFFFFF)
+
+
+def _read_existing(query_products: list = None):
+    """Reads the ids and the pair keys of the BoughtTogether Recommendations
+    of the given products, of every product when None"""
+    query = db.session.query(Recommendation.id, Recommendation.product_id, Recommendation.rec_product_id).filter(
+        Recommendation.type == RecommendationType.BoughtTogether)
+    if query_products is None:
+        queries = [query.yield_per(INSERT_CHUNK_SIZE)]
+    else:
+        queries = [query.filter(Recommendation.product_id.in_(query_products[start:start + LOOKUP_CHUNK_SIZE]))
+                   for start in range(0, len(query_products), LOOKUP_CHUNK_SIZE)]
+    columns = array("q"), array("q"), array("q")
+    for rows in queries:
+        for row in rows:
+            for column, value in zip(columns, row):
+                column.append(value)
+    ids, product_ids, rec_product_ids = (np.frombuffer(column, dtype=np.int64) for column in columns)
+    return ids, _pair_keys(product_ids, rec_product_ids)
+
+
+def _insert(connection, product_ids, rec_product_ids):
+    """Inserts BoughtTogether Recommendations straight from the arrays of their
+    pairs, INSERT_CHUNK_SIZE at a time, with COPY on PostgreSQL"""
+    table = Recommendation.__table__
+    for start in range(0, len(product_ids), INSERT_CHUNK_SIZE):
+        chunk = zip(product_ids[start:start + INSERT_CHUNK_SIZE].tolist(),
+                    rec_product_ids[start:start + INSERT_CHUNK_SIZE].tolist())
+        if connection.dialect.name != "postgresql":
+            connection.execute(table.insert(), [
+                {"product_id": product_id, "rec_product_id": rec_product_id,
+                 "type": RecommendationType.BoughtTogether, "interested": 0, "trending": 0.0}
+                for product_id, rec_product_id in chunk])
+            continue
+        line = "%d\t%d\t{}\t0\t0\n".format(RecommendationType.BoughtTogether.name)
+        buffer = io.StringIO("".join(line % pair for pair in chunk))
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert("COPY {} (product_id, rec_product_id, type, interested, trending) "
+                               "FROM STDIN".format(table.name), buffer)
+        finally:
+            cursor.close()
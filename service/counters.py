@@ -0,0 +1,107 @@
+"""
+Write coalescing for the interested counter
+
+With INTERESTED_COALESCE turned on, PUT /recommendations/{id}/interested does
+not write to the database. The increments are added up per Recommendation in
+this process and written in one batched UPDATE when INTERESTED_FLUSH_THRESHOLD
+clicks are pending, or every INTERESTED_FLUSH_INTERVAL seconds, whichever
+comes first. A hot product then costs one UPDATE per interval instead of one
+per click, at the price of counts in the database lagging by up to one interval.
+With INTEREST_EVENTS also on, the batches are appended as interest events.
+"""
+import atexit
+import logging
+import threading
+from collections import Counter
+
+from flask import Flask, current_app
+from werkzeug.local import LocalProxy
+
+from service.background import BackgroundThread
+from service.models import Recommendation
+from service.rollup import interest_rollup
+
+logger = logging.getLogger("flask.app")
+
+
+class InterestedCounter:
+    """Buffers interested increments in process and writes them in batches"""
+
+    def __init__(self, flush_interval: float = 1.0, flush_threshold: int = 1000):
+        self.app: Flask = None
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending = Counter()
+        self._total = 0
+        self._lock = threading.Lock()
+        self._flusher = BackgroundThread(
+            self.flush, lambda: self.flush_interval, "interested-counter-flush")
+
+    def init_app(self, app: Flask):
+        """Configures the counter from the Flask app"""
+        self.app = app
+        self.flush_interval = app.config["INTERESTED_FLUSH_INTERVAL"]
+        self.flush_threshold = app.config["INTERESTED_FLUSH_THRESHOLD"]
+        app.extensions["interested_counter"] = self
+        atexit.register(self.stop)
+
+    def add(self, id: int, count: int = 1) -> int:
+        """Buffers an increment
+
+        :param id: the id of the Recommendation
+        :param count: the amount to add to its interested counter
+
+        :return: the increment pending for the Recommendation
+        :rtype: int
+
+        """
+        self._flusher.ensure_started()
+        with self._lock:
+            self._pending[id] += count
+            self._total += count
+            pending = self._pending[id]
+            full = self._total >= self.flush_threshold
+        if full:
+            self.flush()
+        return pending
+
+    def pending(self, id: int) -> int:
+        """Returns the increment buffered for a Recommendation"""
+        with self._lock:
+            return self._pending.get(id, 0)
+
+    def flush(self) -> int:
+        """Writes the buffered increments to the database
+
+        :return: the number of Recommendations that were written
+        :rtype: int
+
+        """
+        with self._lock:
+            counts, self._pending, self._total = dict(self._pending), Counter(), 0
+        if not counts:
+            return 0
+        try:
+            with self.app.app_context():
+                if self.app.config["INTEREST_EVENTS"]:
+                    interest_rollup.append(counts)
+                else:
+                    Recommendation.increment_interested(counts)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Flushing %d interested counters failed, will retry", len(counts))
+            with self._lock:
+                self._pending.update(counts)
+                self._total += sum(counts.values())
+            return 0
+        logger.debug("Flushed %d interested counters", len(counts))
+        return len(counts)
+
+    def stop(self):
+        """Stops the background flushes and writes what is still buffered"""
+        self._flusher.stop()
+        if self.app is not None:
+            self.flush()
+
+
+# the counter of the current app, each app gets its own in create_app()
+interested_counter = LocalProxy(lambda: current_app.extensions["interested_counter"])
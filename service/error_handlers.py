@@ -1,29 +1,46 @@
 """
 Module: error_handlers
 """
-from flask import jsonify
+from flask import Flask, current_app, jsonify
 
 from service.models import DataValidationError
-from . import app, status
+from . import status
+
+
+def init_app(app: Flask):
+    """Registers the error handlers on the Flask app"""
+    app.register_error_handler(DataValidationError, request_validation_error)
+    app.register_error_handler(status.HTTP_400_BAD_REQUEST, bad_request)
+    app.extensions["api"].errorhandler(DataValidationError)(api_validation_error)
 
 
 ######################################################################
 # Error Handlers
 ######################################################################
-@app.errorhandler(DataValidationError)
 def request_validation_error(error):
     """Handles Value Errors from bad data"""
     return bad_request(error)
 
 
-@app.errorhandler(status.HTTP_400_BAD_REQUEST)
+def api_validation_error(error):
+    """Handles Value Errors from bad data raised in the API resources"""
+    # flask-restx only hands errors to the app's handlers when exceptions
+    # propagate, i.e. in testing and debug mode
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        {"status": status.HTTP_400_BAD_REQUEST, "error": "Bad Request", "message": message},
+        status.HTTP_400_BAD_REQUEST,
+    )
+
+
 def bad_request(error):
     """Handles bad reuests with 400_BAD_REQUEST"""
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(
             status=status.HTTP_400_BAD_REQUEST, error="Bad Request", message=message
         ),
         status.HTTP_400_BAD_REQUEST,
-    )
\ No newline at end of file
+    )
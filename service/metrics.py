@@ -0,0 +1,152 @@
+"""
+Prometheus metrics for the Recommendation Service
+
+GET /metrics exposes, in the Prometheus text format:
+- request latency histograms per route, method and status code
+- the number of requests in flight
+- database statement counts and latency histograms per kind of statement
+- connection pool gauges: connections checked out and overflow connections
+
+Recording a sample is an in-memory update, so the hooks cost next to nothing
+per request. When gunicorn runs several workers each worker is its own
+process; gunicorn.conf.py points PROMETHEUS_MULTIPROC_DIR at a directory where
+every worker writes its samples, and /metrics adds them all up.
+"""
+import os
+import time
+import weakref
+
+from flask import Flask, Response, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+REQUEST_LATENCY = Histogram(
+    "recommendations_http_request_duration_seconds",
+    "Time spent handling a request",
+    ["method", "route", "status"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "recommendations_http_requests_in_flight",
+    "Requests being handled",
+    multiprocess_mode="livesum",
+)
+DB_QUERY_LATENCY = Histogram(
+    "recommendations_db_query_duration_seconds",
+    "Time spent executing a database statement",
+    ["statement"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+DB_QUERY_ERRORS = Counter(
+    "recommendations_db_query_errors_total",
+    "Database statements that raised an error",
+    ["statement"],
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "recommendations_db_pool_checked_out",
+    "Database connections checked out of the pool",
+    multiprocess_mode="livesum",
+)
+DB_POOL_OVERFLOW = Gauge(
+    "recommendations_db_pool_overflow",
+    "Database connections open beyond the pool size",
+    multiprocess_mode="livesum",
+)
+
+# statement kinds are used as label values, anything else is "OTHER"
+STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE")
+
+# the pools of the engines that have connected, to read their overflow from
+_pools = weakref.WeakSet()
+
+
+def init_metrics(app: Flask):
+    """Records the metrics of the app and exposes them on GET /metrics"""
+    app.before_request(_start_request)
+    app.after_request(_record_request)
+    app.teardown_request(_end_request)
+    app.add_url_rule("/metrics", "metrics", metrics)
+
+
+def metrics():
+    """Returns the metrics in the Prometheus text format"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ or "prometheus_multiproc_dir" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+
+
+def _record_request(response):
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_LATENCY.labels(request.method, route, str(response.status_code)).observe(
+            time.perf_counter() - start)
+    return response
+
+
+def _end_request(error=None):
+    # runs even when the request failed before after_request
+    REQUESTS_IN_FLIGHT.dec()
+
+
+######################################################################
+#  D A T A B A S E   H O O K S
+######################################################################
+def _statement_kind(statement: str) -> str:
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return kind if kind in STATEMENTS else "OTHER"
+
+
+@event.listens_for(Engine, "engine_connect")
+def _remember_pool(conn, branch):
+    _pools.add(conn.engine.pool)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info["metrics_query_start"].pop()
+    DB_QUERY_LATENCY.labels(_statement_kind(statement)).observe(time.perf_counter() - start)
+
+
+@event.listens_for(Engine, "handle_error")
+def _record_query_error(context):
+    starts = context.connection.info.get("metrics_query_start") if context.connection else None
+    if starts:
+        starts.pop()
+    DB_QUERY_ERRORS.labels(_statement_kind(context.statement or "")).inc()
+
+
+@event.listens_for(Pool, "checkout")
+def _record_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_CHECKED_OUT.inc()
+    _record_overflow()
+
+
+@event.listens_for(Pool, "checkin")
+def _record_checkin(dbapi_connection, connection_record):
+    DB_POOL_CHECKED_OUT.dec()
+    _record_overflow()
+
+
+def _record_overflow():
+    # only QueuePool has overflow connections
+    DB_POOL_OVERFLOW.set(sum(max(0, pool.overflow()) for pool in list(_pools)
+                             if hasattr(pool, "overflow")))
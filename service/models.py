@@ -8,6 +8,9 @@ All of the models are stored in this module
 Models
 ------
 Recommendation - A table that contains product recommendations for given product
+DataVersion - A table of counters that are bumped whenever recommendations change
+InterestEvent - An append-only log of interested clicks not yet rolled up
+InterestAggregate - Interested clicks per Recommendation per hour or day
 
 Attributes:
 -----------
@@ -15,23 +18,57 @@ product_id (int) - the id of the query product
 rec_product_id (int) - the id of the recommended product
 type (RecommendationType) - the type of the recommendation
 interested (int) - counter of "interested"
+trending (float) - time-decayed score of the "interested" events
 
 """
+import base64
+import binascii
+import json
 import logging
+import math
+import sqlite3
+import time
+from collections import Counter
+from datetime import datetime
 from enum import Enum
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, current_app
+from sqlalchemy.engine import Engine
+
+from service.cache import recommendation_cache
+from service.replicas import RoutingSQLAlchemy, engine_options
 
 logger = logging.getLogger("flask.app")
 
-# Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# Create the SQLAlchemy object to be initialized later in init_app(), its
+# sessions read from a replica in GET requests when replicas are configured
+db = RoutingSQLAlchemy()
+
+
+def init_app(app):
+    """Initializes SQLAlchemy for the app without connecting to the database"""
+    Recommendation.app = app
+    # the options of the primary, whichever database the app is configured with
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        app.config["SQLALCHEMY_DATABASE_URI"], app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+    db.init_app(app)
 
 
 def init_db(app):
     """Initialies the SQLAlchemy app"""
     Recommendation.init_db(app)
 
+
+def shutdown_session(exception=None):
+    """Ends the session of a request and returns its connection to the pool
+
+    Flask-SQLAlchemy ends sessions when the app context is popped, but the
+    app context that init_db() pushes for the tests is never popped, so
+    sessions used on that thread would otherwise hold their connection and
+    identity map from one request to the next.
+    """
+    db.session.remove()
+
+
 class DatabaseConnectionError(Exception):
     """Custom Exception when database connection fails"""
 
@@ -40,6 +77,33 @@ class DataValidationError(Exception):
     """Custom Exception with data validation fails"""
 
 
+# Sort orders of a list of Recommendations: the columns that make up the sort
+# key (most significant first) and whether they are sorted in descending order
+SORT_ORDERS = {
+    "id": (("id",), False),
+    "interested": (("interested", "id"), True),
+    "trending": (("trending", "id"), True),
+}
+
+# Trending scores are stored as the log of the decayed interest relative to
+# this fixed time (2021-01-01 UTC): log(sum(count * exp(rate * (t - epoch))))
+# over the interested events. Scaling by exp(-rate * (now - epoch)) gives the
+# score decayed to now, but it is the same factor for every row, so the
+# stored value already sorts in trending order at any time.
+TRENDING_EPOCH = 1609459200
+
+# Lower bound of the exp() argument when two trending scores are added:
+# PostgreSQL raises an underflow error below about exp(-708) where the others
+# return 0, and log(1 + exp(-700)) already adds nothing to a double
+TRENDING_EXP_MIN = -700
+
+
+# Ids per statement of the bulk writes: the IN lists of delete_many, and the
+# UPDATEs of increment_interested on databases other than PostgreSQL, whose
+# CASE expression is evaluated once per branch for every row
+WRITE_CHUNK_SIZE = 500
+
+
 class RecommendationType(Enum):
     """Enumeration of valid Recommendation Types"""
     Generic = 0
@@ -49,6 +113,143 @@ class RecommendationType(Enum):
     Complementary = 4
 
 
+class DataVersion(db.Model):
+    """
+    Class that represents the version of a set of Recommendations
+
+    Every write to the recommendation table bumps, in the same transaction,
+    the version of each query product whose recommendations it touched:
+    interested increments bump the product's interest scope, every other
+    write its product scope, so clicks and edits never wait on each other's
+    rows. Each write also bumps one of TABLE_SHARDS rows of the whole table,
+    picked by product, so no row is shared by all writers. The version of a
+    product is the sum of its two scopes and the version of the whole table
+    the sum of its shards, so each one grows with every write it covers.
+    Clients can then tell whether their copy of a list is current from two
+    rows of this table (or, for unfiltered lists, TABLE_SHARDS rows).
+    """
+
+    # the scope of the whole table, the sum of its shards
+    TABLE_SCOPE = "recommendation"
+    TABLE_SHARDS = 16
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    scope = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<DataVersion of [%s] is [%d]>" % (self.scope, self.version)
+
+    @staticmethod
+    def product_scope(product_id: int) -> str:
+        """Returns the scope of the Recommendations of a query product"""
+        return "product:%d" % int(product_id)
+
+    @staticmethod
+    def interest_scope(product_id: int) -> str:
+        """Returns the scope of the interested counters of the Recommendations of a query product"""
+        return "interest:%d" % int(product_id)
+
+    @classmethod
+    def table_shard(cls, product_id: int) -> str:
+        """Returns the shard of the table scope that the writes of a query product bump"""
+        return "%s:%d" % (cls.TABLE_SCOPE, int(product_id) % cls.TABLE_SHARDS)
+
+    @classmethod
+    def rows_of(cls, scope: str) -> list:
+        """Returns the scopes whose rows add up to the version of a scope"""
+        if scope == cls.TABLE_SCOPE:
+            return ["%s:%d" % (scope, shard) for shard in range(cls.TABLE_SHARDS)]
+        if scope.startswith("product:"):
+            return [scope, "interest:" + scope[len("product:"):]]
+        return [scope]
+
+    @classmethod
+    def get(cls, scope: str) -> int:
+        """Returns the version of a scope, 0 if it was never written"""
+        return db.session.execute(cls.get_statement(scope)).scalar()
+
+    @classmethod
+    def get_with_pending(cls, scope: str, id: int) -> tuple:
+        """Returns the version of a scope and the interested events of a
+        Recommendation that are not rolled up yet, read in one statement"""
+        return tuple(db.session.execute(
+            db.select([cls.get_statement(scope).as_scalar(), InterestEvent.pending(id)])).first())
+
+    @classmethod
+    def get_many(cls, scopes: list) -> dict:
+        """Returns the versions of many product scopes in one query, 0 for those never written"""
+        rows = {row: scope for scope in scopes for row in cls.rows_of(scope)}
+        versions = dict.fromkeys(scopes, 0)
+        for row, version in db.session.query(cls.scope, cls.version).filter(cls.scope.in_(list(rows))):
+            versions[rows[row]] += version
+        return versions
+
+    @classmethod
+    def get_statement(cls, scope: str):
+        """Returns a Core SELECT of the version of a scope, for executing outside of the ORM session"""
+        # PostgreSQL sums bigints as numeric
+        statement = db.select([db.cast(db.func.coalesce(db.func.sum(cls.version), 0), db.BigInteger)])
+        return statement.where(cls.scope.in_(cls.rows_of(scope)))
+
+    @classmethod
+    def add_up(cls, versions: dict) -> dict:
+        """Returns the versions of the product scopes and the table from the
+        versions of all the rows of the table"""
+        totals = {cls.TABLE_SCOPE: 0}
+        for scope, version in versions.items():
+            if scope.startswith(cls.TABLE_SCOPE + ":"):
+                scope = cls.TABLE_SCOPE
+            elif scope.startswith("interest:"):
+                scope = "product:" + scope[len("interest:"):]
+            totals[scope] = totals.get(scope, 0) + version
+        return totals
+
+    @classmethod
+    def bump(cls, product_ids, interest: bool = False):
+        """Bumps the version of the given query products
+
+        Must be called in the transaction of the write it records, so the new
+        versions become visible together with the data.
+
+        :param interest: whether the write only changed interested counters
+        """
+        scope = cls.interest_scope if interest else cls.product_scope
+        product_ids = set(product_ids)
+        # a fixed order keeps concurrent writers from deadlocking on the rows
+        scopes = sorted({scope(id) for id in product_ids} | {cls.table_shard(id) for id in product_ids})
+        if not scopes:
+            return
+        db.session.execute(
+            db.text(
+                "INSERT INTO data_version (scope, version) VALUES (:scope, 1) "
+                "ON CONFLICT (scope) DO UPDATE SET version = data_version.version + 1"
+            ),
+            [{"scope": scope} for scope in scopes],
+        )
+
+    @classmethod
+    def bump_all(cls):
+        """Bumps the version of every query product, and so of the table"""
+        db.session.query(cls).update({cls.version: cls.version + 1}, synchronize_session=False)
+
+    @classmethod
+    def upgrade_db(cls):
+        """Starts the table shards of a data_version table written before the
+        table version was sharded from the sum of all of its rows, so the
+        table version never goes back to one an ETag was already made from"""
+        shards = cls.rows_of(cls.TABLE_SCOPE)
+        with db.engine.begin() as conn:
+            if conn.execute(db.select([db.func.count()]).where(cls.scope.in_(shards))).scalar():
+                return
+            total = conn.execute(db.select([db.func.coalesce(db.func.sum(cls.version), 0)])).scalar()
+            if total:
+                logger.info("Starting the table version at %d", total)
+                conn.execute(cls.__table__.insert().values(scope=shards[0], version=total))
+
+
 class Recommendation(db.Model):
     """
     Class that represents a Recommendation
@@ -68,6 +269,20 @@ class Recommendation(db.Model):
         db.Enum(RecommendationType), nullable=False, server_default=(RecommendationType.Generic.name)
     )
     interested = db.Column(db.Integer, nullable=False, default=0)
+    trending = db.Column(db.Float, nullable=False, default=0, server_default="0")
+
+    # Composite indexes matching the filter combinations of find_rec_by_filter
+    # and the ranked (most interested or trending first) reads, of a product or
+    # of the whole table, whose ties are broken by id so the index is the whole
+    # sort order
+    __table_args__ = (
+        db.Index("ix_recommendation_interested", interested.desc(), id.desc()),
+        db.Index("ix_recommendation_trending", trending.desc(), id.desc()),
+        db.Index("ix_recommendation_product_id_type", product_id, type),
+        db.Index("ix_recommendation_rec_product_id_type", rec_product_id, type),
+        db.Index("ix_recommendation_product_id_interested", product_id, interested.desc(), id.desc()),
+        db.Index("ix_recommendation_product_id_trending", product_id, trending.desc(), id.desc()),
+    )
 
     ##################################################
     # INSTANCE METHODS
@@ -83,7 +298,10 @@ class Recommendation(db.Model):
         logger.info("Creating %s", self.id)
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
+        filters = self._filter_values()
+        DataVersion.bump(filters[0])
         db.session.commit()
+        recommendation_cache.invalidate(*filters)
 
     def update(self):
         """
@@ -92,22 +310,50 @@ class Recommendation(db.Model):
         logger.info("Saving %s", self.id)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
+        filters = self._filter_values()
+        DataVersion.bump(filters[0])
         db.session.commit()
+        recommendation_cache.invalidate(*filters)
 
     def delete(self):
         """Removes a Recommendation from the data store"""
         logger.info("Deleting %s", self.id)
+        filters = self._filter_values()
         db.session.delete(self)
+        InterestEvent.discard([self.id])
+        DataVersion.bump(filters[0])
         db.session.commit()
+        recommendation_cache.invalidate(*filters)
+
+    def _filter_values(self) -> tuple:
+        """Returns the product_ids, rec_product_ids and type names of this
+        Recommendation as they are in the database and as they will be after
+        the pending changes are committed"""
+        state = db.inspect(self)
+        filters = []
+        for name in ("product_id", "rec_product_id", "type"):
+            history = state.attrs[name].history
+            values = (*history.added, *history.unchanged, *history.deleted)
+            filters.append({getattr(value, "name", value) for value in values if value is not None})
+        return tuple(filters)
 
     def serialize(self) -> dict:
         """Serializes a Recommendation into a dictionary"""
+        return self.serialize_row(self)
+
+    @staticmethod
+    def serialize_row(row) -> dict:
+        """Serializes a Recommendation or a row of its columns into a dictionary
+
+        The trending score is left out: its stored value only means something
+        next to the others, as the key of sort=trending.
+        """
         return {
-            "id": self.id,
-            "product_id": self.product_id,
-            "rec_product_id": self.rec_product_id,
-            "type": self.type.name,  # convert enum to string
-            "interested": self.interested
+            "id": row.id,
+            "product_id": row.product_id,
+            "rec_product_id": row.rec_product_id,
+            "type": row.type.name,  # convert enum to string
+            "interested": row.interested,
         }
 
     def deserialize(self, data: dict):
@@ -115,24 +361,42 @@ class Recommendation(db.Model):
         Deserializes a Recommendation from a dictionary
         Args:
             data (dict): A dictionary containing the Recommendation data
+        """
+        for name, value in self.validate(data).items():
+            setattr(self, name, value)
+        return self
+
+    @staticmethod
+    def validate(data: dict) -> dict:
+        """Validates the dictionary of a Recommendation and returns its column values
+
+        The rules of deserialize, without a Recommendation: the bulk import
+        applies them to every row of a file.
+
+        :param data: a dictionary containing the Recommendation data
+        :type data: dict
+
+        :return: the product_id, rec_product_id, interested and type
+        :rtype: dict
+
         """
         try:
             if isinstance(data['product_id'], int):
-                self.product_id = data["product_id"]
+                product_id = data["product_id"]
             else:
                 raise DataValidationError(
                     "Invalid Query Product ID: " + data['product_id'])
             if isinstance(data['rec_product_id'], int):
-                self.rec_product_id = data["rec_product_id"]
+                rec_product_id = data["rec_product_id"]
             else:
                 raise DataValidationError(
                     "Invalid Query Product ID: " + data['product_id'])
             if isinstance(data['interested'], int):
-                self.interested = data["interested"]
+                interested = data["interested"]
             else:
                 raise DataValidationError(
                     "Invalid Interested Count: " + data['interested'])
-            self.type = getattr(RecommendationType, data["type"])
+            type = getattr(RecommendationType, data["type"])
 
         except AttributeError as error:
             raise DataValidationError(
@@ -144,7 +408,12 @@ class Recommendation(db.Model):
             raise DataValidationError(
                 "Invalid Recommendation: body of request contained bad or no data"
             )
-        return self
+        return {
+            "product_id": product_id,
+            "rec_product_id": rec_product_id,
+            "interested": interested,
+            "type": type,
+        }
 
     ##################################################
     # CLASS METHODS
@@ -152,18 +421,65 @@ class Recommendation(db.Model):
 
     @classmethod
     def init_db(cls, app: Flask):
-        """Initializes the database session
+        """Initializes the database session and creates the tables
+
+        Used by the tests and the benchmarks, the service itself only runs
+        init_app() and leaves the tables to `flask create-db`.
 
         :param app: the Flask app
         :type data: Flask
 
         """
         logger.info("Initializing database")
-        cls.app = app
         # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
+        init_app(app)
         app.app_context().push()
+        cls.create_db()
+
+    @classmethod
+    def create_db(cls):
+        """Creates the tables and indexes that are missing"""
         db.create_all()  # make our sqlalchemy tables
+        cls.upgrade_db()
+        DataVersion.upgrade_db()
+
+    @classmethod
+    def upgrade_db(cls):
+        """Brings an existing table up to date with the current schema
+
+        db.create_all() only creates missing tables, so tables created by an
+        earlier version of the service never get the columns and indexes that
+        were declared since. This adds any column that is declared but missing
+        and has a server default to fill the existing rows with, then creates
+        any index that is declared but missing, and rebuilds any index whose
+        columns changed.
+
+        :return: the names of the columns and indexes that were created or rebuilt
+        :rtype: list
+
+        """
+        inspector = db.inspect(db.engine)
+        existing = {column["name"] for column in inspector.get_columns(cls.__tablename__)}
+        created = []
+        for column in cls.__table__.columns:
+            if column.name not in existing and column.server_default is not None:
+                logger.info("Adding column %s", column.name)
+                db.engine.execute("ALTER TABLE {} ADD COLUMN {} {} NOT NULL DEFAULT {}".format(
+                    cls.__tablename__, column.name, column.type.compile(dialect=db.engine.dialect),
+                    column.server_default.arg))
+                created.append(column.name)
+        existing = {index["name"]: index["column_names"] for index in inspector.get_indexes(cls.__tablename__)}
+        for index in cls.__table__.indexes:
+            if index.name not in existing:
+                logger.info("Creating index %s", index.name)
+            elif existing[index.name] != [column.name for column in index.columns]:
+                logger.info("Rebuilding index %s", index.name)
+                index.drop(bind=db.engine)
+            else:
+                continue
+            index.create(bind=db.engine)
+            created.append(index.name)
+        return created
 
     @classmethod
     def all(cls) -> list:
@@ -175,6 +491,174 @@ class Recommendation(db.Model):
     def remove_all(cls):
         """Removes all documents from the database (use for testing)"""
         cls.query.delete()
+        InterestEvent.query.delete()
+        InterestAggregate.query.delete()
+        DataVersion.bump_all()
+        recommendation_cache.clear()
+
+    @classmethod
+    def create_many(cls, recommendations: list, chunk_size: int = 1000, commit: bool = True):
+        """
+        Creates many Recommendations in the database in one transaction
+
+        On PostgreSQL the ids are taken from the sequence up front and the rows
+        go in as multi-row INSERTs of chunk_size rows; other databases insert
+        them with the session's bulk insert. With commit False the transaction
+        is left open, and the caller commits it and invalidates the cache.
+        """
+        logger.info("Creating %d Recommendations", len(recommendations))
+        if not recommendations:
+            return
+        rows = [
+            {
+                "product_id": rec.product_id,
+                "rec_product_id": rec.rec_product_id,
+                "type": rec.type,
+                "interested": rec.interested or 0,
+                "trending": rec.trending or 0.0,
+            }
+            for rec in recommendations
+        ]
+        if db.session.get_bind().dialect.name == "postgresql":
+            sequence = db.func.nextval(cls.__tablename__ + "_id_seq")
+            ids = db.session.query(sequence).select_from(
+                db.func.generate_series(1, len(rows))).all()
+            for row, (id,) in zip(rows, ids):
+                row["id"] = id
+            for start in range(0, len(rows), chunk_size):
+                db.session.execute(cls.__table__.insert().values(rows[start:start + chunk_size]))
+        else:
+            db.session.bulk_insert_mappings(cls, rows, return_defaults=True)
+        DataVersion.bump(row["product_id"] for row in rows)
+        if commit:
+            db.session.commit()
+        for rec, row in zip(recommendations, rows):
+            rec.id = row["id"]
+            rec.interested = row["interested"]
+            rec.trending = row["trending"]
+            if commit:
+                recommendation_cache.invalidate_row(rec)
+
+    @classmethod
+    def delete_many(cls, ids: list, commit: bool = True) -> int:
+        """
+        Removes many Recommendations from the database in one transaction
+
+        :param ids: the ids of the Recommendations to remove
+        :type ids: list
+        :param commit: whether to commit, otherwise the caller commits the
+                       transaction and invalidates the cache
+        :type commit: bool
+
+        :return: the number of Recommendations that were found and removed
+        :rtype: int
+
+        """
+        logger.info("Deleting %d Recommendations", len(ids))
+        if not ids:
+            return 0
+        table = cls.__table__
+        rows = []
+        for start in range(0, len(ids), WRITE_CHUNK_SIZE):
+            chunk = ids[start:start + WRITE_CHUNK_SIZE]
+            rows += db.session.execute(db.select(
+                [table.c.product_id, table.c.rec_product_id, table.c.type]).where(table.c.id.in_(chunk))).fetchall()
+            db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+            InterestEvent.discard(chunk)
+        if rows:
+            DataVersion.bump(row.product_id for row in rows)
+        if commit:
+            db.session.commit()
+            for row in rows:
+                recommendation_cache.invalidate_row(row)
+        return len(rows)
+
+    @classmethod
+    def increment_interested(cls, counts: dict, scores: dict = None) -> list:
+        """
+        Adds to the interested counters and trending scores of Recommendations
+        in one statement
+
+        The increments are applied by the database (interested = interested + n)
+        so concurrent increments are never lost, and no row is read first. On
+        PostgreSQL the increments are joined to the table as arrays, so one
+        UPDATE costs the same per row however many ids it has; other databases
+        look the increment up in a CASE of at most WRITE_CHUNK_SIZE ids per
+        UPDATE, all in one transaction.
+
+        The events decay with a half-life of TRENDING_HALF_LIFE seconds: n
+        events now add n * exp(rate * (now - TRENDING_EPOCH)) to the decayed
+        interest, which is kept as its log (see TRENDING_EPOCH) so that it
+        never overflows however long the service runs. Adding in log space is
+        trending = log(exp(trending) + exp(score)), worked out without the
+        exponentials as max + log(1 + exp(-|trending - score|)), with the
+        exponent clamped to TRENDING_EXP_MIN.
+
+        :param counts: the increment for each Recommendation id
+        :type counts: dict
+        :param scores: the log of the decayed weight of each increment (see
+                       trending_offset), defaults to increments made now
+        :type scores: dict
+
+        :return: the updated rows, one per id that was found
+        :rtype: list
+
+        """
+        logger.info("Incrementing interested for %d Recommendations", len(counts))
+        if not counts:
+            return []
+        if scores is None:
+            offset = cls.trending_offset()
+            scores = {id: offset + math.log(count) for id, count in counts.items()}
+        table = cls.__table__
+        columns = [table.c.id, table.c.product_id, table.c.rec_product_id, table.c.type,
+                   table.c.interested, table.c.trending]
+        if db.session.get_bind().dialect.name == "postgresql":
+            statement = db.text(
+                "UPDATE recommendation SET interested = recommendation.interested + increment.count, "
+                "trending = GREATEST(recommendation.trending, increment.score) "
+                "+ ln(1 + exp(GREATEST(-abs(recommendation.trending - increment.score), :exp_min))) "
+                "FROM unnest(CAST(:ids AS integer[]), CAST(:counts AS integer[]), "
+                "CAST(:scores AS double precision[])) AS increment (id, count, score) "
+                "WHERE recommendation.id = increment.id "
+                "RETURNING recommendation.id, recommendation.product_id, recommendation.rec_product_id, "
+                "recommendation.type, recommendation.interested, recommendation.trending"
+            ).columns(*columns)
+            rows = db.session.execute(statement, {
+                "ids": list(counts), "counts": list(counts.values()), "scores": [scores[id] for id in counts],
+                "exp_min": TRENDING_EXP_MIN,
+            }).fetchall()
+        else:
+            rows = []
+            ids = list(counts)
+            for start in range(0, len(ids), WRITE_CHUNK_SIZE):
+                chunk = ids[start:start + WRITE_CHUNK_SIZE]
+                score = db.case({id: scores[id] for id in chunk}, value=table.c.id)
+                gap = -db.func.abs(table.c.trending - score)
+                db.session.execute(table.update().where(table.c.id.in_(chunk)).values(
+                    interested=table.c.interested + db.case({id: counts[id] for id in chunk}, value=table.c.id),
+                    trending=db.case([(table.c.trending > score, table.c.trending)], else_=score)
+                    + db.func.ln(1 + db.func.exp(db.case([(gap > TRENDING_EXP_MIN, gap)], else_=TRENDING_EXP_MIN)))))
+                rows += db.session.execute(db.select(columns).where(table.c.id.in_(chunk))).fetchall()
+        DataVersion.bump((row.product_id for row in rows), interest=True)
+        db.session.commit()
+        for row in rows:
+            recommendation_cache.invalidate_row(row)
+        return rows
+
+    @staticmethod
+    def trending_offset(now: float = None) -> float:
+        """Returns the log of the weight of an event at a time, in the units
+        of the trending scores
+
+        :param now: the time of the event in seconds since the Unix epoch,
+                    defaults to the current time
+
+        """
+        if now is None:
+            now = time.time()
+        rate = math.log(2) / current_app.config["TRENDING_HALF_LIFE"]
+        return rate * (now - TRENDING_EPOCH)
 
     @classmethod
     def find(cls, id: int):
@@ -190,6 +674,35 @@ class Recommendation(db.Model):
         logger.info("Processing lookup for id %s ...", id)
         return cls.query.get(id)
 
+    @classmethod
+    def find_ids(cls, ids) -> list:
+        """Returns which of the given ids are the ids of Recommendations"""
+        logger.info("Processing lookup of %d ids ...", len(ids))
+        return [id for id, in db.session.query(cls.id).filter(cls.id.in_(list(ids)))]
+
+    @classmethod
+    def find_exact(cls, ids) -> list:
+        """Returns the rows of Recommendations with the interested events that
+        are not rolled up yet added to their interested counter
+
+        The counter and the events are read in one statement, and a rollup
+        moves events into the counter in one transaction, so every event is
+        counted exactly once.
+
+        :param ids: the ids of the Recommendations to find
+
+        :return: a row per id that was found, with the columns of serialize_row
+                 and the pending interested events
+        :rtype: list
+
+        """
+        table = cls.__table__
+        pending = InterestEvent.pending(table.c.id)
+        return db.session.execute(db.select([
+            table.c.id, table.c.product_id, table.c.rec_product_id, table.c.type,
+            (table.c.interested + pending).label("interested"), table.c.trending, pending.label("pending"),
+        ]).where(table.c.id.in_(list(ids)))).fetchall()
+
     @classmethod
     def find_or_404(cls, id: int):
         """Find a Recommendation by it's id
@@ -222,13 +735,430 @@ class Recommendation(db.Model):
         logger.info(
             "Processing find recommendation products of a type query for %s %s %s...", product_id, rec_product_id, type)
 
-        query = cls.query
+        return cls.query.filter(*cls.filter_clauses(product_id, rec_product_id, type))
 
-        if product_id:
-            query = query.filter(cls.product_id == product_id)
-        if rec_product_id:
-            query = query.filter(cls.rec_product_id == rec_product_id)
+    @classmethod
+    def filter_clauses(cls, product_id=None, rec_product_id=None, type=None) -> list:
+        """Returns the WHERE clauses of the filter of find_rec_by_filter
+
+        Filters that are None or empty are left out.
+        """
+        clauses = []
+        if product_id not in (None, ""):
+            clauses.append(cls.product_id == product_id)
+        if rec_product_id not in (None, ""):
+            clauses.append(cls.rec_product_id == rec_product_id)
         if type:
-            query = query.filter(cls.type == type)
+            clauses.append(cls.type == type)
+        return clauses
+
+    @classmethod
+    def find_by_products(cls, product_ids: list, limit: int, sort: str = None,
+                         rec_product_id: int = None, type: RecommendationType = None) -> dict:
+        """Returns the first Recommendations of each of many query products
+
+        All of the products are read in one query: a window function numbers
+        the rows of each product in the sort order and only the first limit
+        rows of each are returned.
+
+        :param product_ids: the query products
+        :param limit: the maximum number of Recommendations per product
+        :param sort: the name of the sort order, defaults to "id"
+        :param rec_product_id: only return the Recommendations of this recommended product
+        :param type: only return the Recommendations of this type
+
+        :return: the serialized Recommendations of each product, in the order of product_ids
+        :rtype: dict
+
+        """
+        logger.info("Processing lookup of %d products for %s %s...", len(product_ids), rec_product_id, type)
+        columns, descending = cls.sort_order(sort)
+        rank = db.func.row_number().over(
+            partition_by=cls.product_id,
+            order_by=[col.desc() if descending else col for col in columns],
+        ).label("rank")
+        ranked = (
+            db.select([cls.__table__, rank])
+            .where(db.and_(cls.product_id.in_(product_ids),
+                           *cls.filter_clauses(None, rec_product_id, type)))
+            .alias("ranked")
+        )
+        statement = (
+            db.select([ranked.c[name] for name in ("id", "product_id", "rec_product_id", "type", "interested")])
+            .where(ranked.c.rank <= limit)
+            .order_by(ranked.c.product_id, ranked.c.rank)
+        )
+        results = {product_id: [] for product_id in product_ids}
+        for row in db.session.execute(statement):
+            results[row.product_id].append(cls.serialize_row(row))
+        return results
+
+    @classmethod
+    def stream(cls, product_id: int = None, rec_product_id: int = None, type: RecommendationType = None,
+               chunk_size: int = 1000):
+        """Yields the Recommendations matching a filter as dictionaries
+
+        The rows are read through a server-side cursor, chunk_size at a time,
+        as plain column tuples rather than ORM instances, so memory use does
+        not depend on the number of rows.
+
+        :param chunk_size: the number of rows fetched from the database at a time
+        :type chunk_size: int
+
+        :return: a generator of serialized Recommendations in id order
+        :rtype: generator
+
+        """
+        logger.info("Processing stream of Recommendations for %s %s %s...", product_id, rec_product_id, type)
+        query = cls.find_rec_by_filter(product_id, rec_product_id, type).with_entities(
+            cls.id, cls.product_id, cls.rec_product_id, cls.type, cls.interested)
+        for row in query.order_by(cls.id).yield_per(chunk_size):
+            yield cls.serialize_row(row)
+
+    @classmethod
+    def sort_order(cls, sort: str = None):
+        """Returns the key columns of a sort order and whether it is descending
+
+        :param sort: the name of the sort order, defaults to "id"
+        :type sort: str
+
+        :return: the sort key columns and the descending flag
+        :rtype: tuple
+
+        """
+        try:
+            names, descending = SORT_ORDERS[sort or "id"]
+        except KeyError:
+            raise DataValidationError("Invalid sort order: " + str(sort))
+        return tuple(getattr(cls, name) for name in names), descending
+
+    @classmethod
+    def keyset_clause(cls, columns: tuple, after: tuple, descending: bool):
+        """Returns the clause selecting the rows that sort after a key
+
+        :param columns: the sort key columns
+        :param after: the sort key of the last row already returned
+        :param descending: True if the sort order is descending
+
+        """
+        clauses = []
+        for i, column in enumerate(columns):
+            equal = [col == value for col, value in zip(columns[:i], after[:i])]
+            past = column < after[i] if descending else column > after[i]
+            clauses.append(db.and_(*equal, past))
+        return db.or_(*clauses)
+
+    @classmethod
+    def find_page(cls, query, limit: int, after: tuple = None, sort: str = None):
+        """Returns one page of a query using keyset pagination
+
+        Rows are located through the sort key of the last row of the previous
+        page instead of an OFFSET, so every page costs the same to fetch
+        however deep it is.
+
+        :param query: the query to paginate, e.g. from find_rec_by_filter
+        :param limit: the maximum number of Recommendations on the page
+        :param after: the sort key of the last row of the previous page
+        :param sort: the name of the sort order, defaults to "id"
+
+        :return: the page, and the sort key of its last row or None if there
+                 are no more pages
+        :rtype: tuple
+
+        """
+        logger.info("Processing page of %s Recommendations after %s sorted by %s", limit, after, sort)
+        columns, descending = cls.sort_order(sort)
+        if after is not None:
+            query = query.filter(cls.keyset_clause(columns, after, descending))
+        query = query.order_by(*[col.desc() if descending else col for col in columns])
+        # fetch one extra row to find out whether there is a next page
+        page = query.limit(limit + 1).all()
+        if len(page) <= limit:
+            return page, None
+        page = page[:limit]
+        return page, tuple(getattr(page[-1], col.key) for col in columns)
+
+    @classmethod
+    def find_statement(cls, id: int):
+        """Returns a Core SELECT of a Recommendation by its id, for executing outside of the ORM session"""
+        return db.select([cls.__table__]).where(cls.id == id)
+
+    @classmethod
+    def page_statement(cls, limit: int, after: tuple = None, sort: str = None,
+                       product_id: int = None, rec_product_id: int = None, type: RecommendationType = None):
+        """Returns a Core SELECT of one page of a filter
+
+        The same page as find_page(find_rec_by_filter(...)), for executing
+        outside of the ORM session, e.g. by an async driver. Like find_page it
+        selects limit + 1 rows to tell whether there is a next page.
+
+        """
+        columns, descending = cls.sort_order(sort)
+        clauses = cls.filter_clauses(product_id, rec_product_id, type)
+        if after is not None:
+            clauses.append(cls.keyset_clause(columns, after, descending))
+        return (
+            db.select([cls.__table__])
+            .where(db.and_(*clauses))
+            .order_by(*[col.desc() if descending else col for col in columns])
+            .limit(limit + 1)
+        )
+
+    @classmethod
+    def paginate_rows(cls, rows: list, limit: int, after: tuple = None, sort: str = None):
+        """Returns one page of a list of serialized Recommendations
+
+        The in-memory counterpart of find_page for lists that are already
+        loaded, with the same ordering and cursors. Serialized rows have no
+        trending score, so they cannot be paged by sort=trending.
+
+        :param rows: serialized Recommendations in any order
+        :param limit: the maximum number of Recommendations on the page
+        :param after: the sort key of the last row of the previous page
+        :param sort: the name of the sort order, defaults to "id"
+
+        :return: the page, and the sort key of its last row or None if there
+                 are no more pages
+        :rtype: tuple
+
+        """
+        columns, descending = cls.sort_order(sort)
+
+        def sort_key(row):
+            return tuple(row[col.key] for col in columns)
+
+        rows = sorted(rows, key=sort_key, reverse=descending)
+        if after is not None:
+            rows = [row for row in rows
+                    if (sort_key(row) < after if descending else sort_key(row) > after)]
+        if len(rows) <= limit:
+            return rows, None
+        page = rows[:limit]
+        return page, sort_key(page[-1])
+
+    @staticmethod
+    def encode_cursor(key: tuple) -> str:
+        """Encodes a sort key as an opaque pagination cursor"""
+        return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+    @classmethod
+    def decode_cursor(cls, cursor: str, sort: str = None) -> tuple:
+        """Decodes a pagination cursor back into a sort key
+
+        :param cursor: a cursor from encode_cursor
+        :param sort: the name of the sort order the cursor was made for
+
+        :return: the sort key
+        :rtype: tuple
+
+        """
+        columns, _ = cls.sort_order(sort)
+        try:
+            key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (binascii.Error, ValueError) as error:
+            raise DataValidationError("Invalid cursor: " + cursor) from error
+        if (not isinstance(key, list) or len(key) != len(columns)
+                or not all(isinstance(value, (int, float)) and not isinstance(value, bool)
+                           for value in key)):
+            raise DataValidationError("Invalid cursor: " + cursor)
+        return tuple(key)
+
+
+class InterestEvent(db.Model):
+    """
+    Class that represents interested clicks that are not rolled up yet
+
+    With INTEREST_EVENTS turned on, clicks are appended to this table instead
+    of updating their Recommendation, so the hottest rows are not rewritten
+    (and left behind as dead tuples on PostgreSQL) once per click. rollup()
+    periodically folds the events into Recommendation.interested and deletes
+    them; find_exact() adds the events still here to the counter.
+    """
+
+    __tablename__ = "interest_event"
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    # SQLite only generates the ids of INTEGER primary keys
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    # no foreign key, so an INSERT never locks or reads the Recommendation
+    recommendation_id = db.Column(db.Integer, nullable=False, index=True)
+    count = db.Column(db.Integer, nullable=False, default=1)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<InterestEvent of [%d] with count=[%d]>" % (self.recommendation_id, self.count)
+
+    @classmethod
+    def pending(cls, recommendation_id):
+        """Returns a scalar subquery of the clicks on a Recommendation that are
+        not rolled up yet, for an id or a column to correlate with"""
+        return db.select([db.func.coalesce(db.func.sum(cls.count), 0)]).where(
+            cls.recommendation_id == recommendation_id).as_scalar()
+
+    @classmethod
+    def append(cls, counts: dict):
+        """Appends the interested clicks of Recommendations to the log
+
+        On PostgreSQL the events go in as multi-row INSERTs of WRITE_CHUNK_SIZE
+        rows; other databases insert them with executemany. Nothing else is
+        written, the data versions are bumped when the events are rolled up.
+
+        :param counts: the number of clicks for each Recommendation id
+        :type counts: dict
+
+        """
+        logger.info("Appending interest events for %d Recommendations", len(counts))
+        if not counts:
+            return
+        now = datetime.utcnow()
+        rows = [{"recommendation_id": id, "count": count, "created_at": now} for id, count in counts.items()]
+        if db.session.get_bind().dialect.name == "postgresql":
+            for start in range(0, len(rows), WRITE_CHUNK_SIZE):
+                db.session.execute(cls.__table__.insert().values(rows[start:start + WRITE_CHUNK_SIZE]))
+        else:
+            db.session.execute(cls.__table__.insert(), rows)
+        db.session.commit()
+
+    @classmethod
+    def discard(cls, recommendation_ids: list):
+        """Deletes the events of Recommendations that are being deleted, in
+        the transaction of the delete, when INTEREST_EVENTS is on"""
+        if not current_app.config["INTEREST_EVENTS"]:
+            return
+        db.session.execute(cls.__table__.delete().where(
+            cls.recommendation_id.in_(list(recommendation_ids))))
+
+    @classmethod
+    def rollup(cls, limit: int, periods: tuple = ()) -> int:
+        """Folds the oldest events into the interested counters and deletes them
+
+        Up to limit events are deleted, and what the DELETE returns is added to
+        Recommendation.interested (and to its trending score, at the time they
+        were clicked) and to the aggregates of the given periods, all in one
+        transaction. An event is only ever returned to the worker that deleted
+        it, so workers rolling up at the same time never count one twice: on
+        PostgreSQL they skip the events another one has locked, on SQLite
+        (3.35 or later, for RETURNING) the DELETE waits for the write lock.
+
+        :param limit: the most events to roll up
+        :param periods: the InterestAggregate periods to add the events to,
+                        e.g. ("hour", "day")
+
+        :return: the number of events rolled up
+        :rtype: int
+
+        """
+        table = cls.__table__
+        lock = " FOR UPDATE SKIP LOCKED" if db.session.get_bind().dialect.name == "postgresql" else ""
+        events = db.session.execute(db.text(
+            "DELETE FROM interest_event WHERE id IN "
+            "(SELECT id FROM interest_event ORDER BY id LIMIT :limit" + lock + ") "
+            "RETURNING id, recommendation_id, count, created_at"
+        ).columns(table.c.id, table.c.recommendation_id, table.c.count, table.c.created_at),
+            {"limit": limit}).fetchall()
+        if not events:
+            db.session.rollback()
+            return 0
+        logger.info("Rolling up %d interest events", len(events))
+        counts = Counter()
+        scores = {}
+        for event in events:
+            counts[event.recommendation_id] += event.count
+            score = Recommendation.trending_offset(
+                (event.created_at - datetime(1970, 1, 1)).total_seconds()) + math.log(event.count)
+            previous = scores.get(event.recommendation_id)
+            scores[event.recommendation_id] = score if previous is None else _logaddexp(previous, score)
+        if periods:
+            InterestAggregate.add(events, periods)
+        # commits the whole rollup
+        Recommendation.increment_interested(dict(counts), scores)
+        return len(events)
+
+
+class InterestAggregate(db.Model):
+    """
+    Class that represents the interested clicks of a Recommendation in an
+    hour or a day, filled in by InterestEvent.rollup() when
+    INTEREST_AGGREGATES names the period
+    """
+
+    __tablename__ = "interest_aggregate"
+
+    # the periods and how to find the one a time is in
+    PERIODS = {
+        "hour": lambda time: time.replace(minute=0, second=0, microsecond=0),
+        "day": lambda time: time.replace(hour=0, minute=0, second=0, microsecond=0),
+    }
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    recommendation_id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(8), primary_key=True)
+    period_start = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<InterestAggregate of [%d] in [%s %s] is [%d]>" % (
+            self.recommendation_id, self.period, self.period_start, self.count)
+
+    @classmethod
+    def add(cls, events: list, periods: tuple):
+        """Adds interest events to the aggregates of their periods
+
+        :param events: rows with the recommendation_id, count and created_at
+                       of interest events
+        :param periods: the names of the periods, keys of PERIODS
+
+        """
+        counts = Counter()
+        for period in periods:
+            try:
+                truncate = cls.PERIODS[period]
+            except KeyError:
+                raise DataValidationError("Invalid aggregate period: " + str(period))
+            for event in events:
+                counts[event.recommendation_id, period, truncate(event.created_at)] += event.count
+        db.session.execute(
+            db.text(
+                "INSERT INTO interest_aggregate (recommendation_id, period, period_start, count) "
+                "VALUES (:recommendation_id, :period, :period_start, :count) "
+                "ON CONFLICT (recommendation_id, period, period_start) "
+                "DO UPDATE SET count = interest_aggregate.count + excluded.count"
+            ).bindparams(db.bindparam("period_start", type_=db.DateTime)),
+            [{"recommendation_id": id, "period": period, "period_start": start, "count": count}
+             for (id, period, start), count in sorted(counts.items())],
+        )
+
+    @classmethod
+    def find_by_recommendation(cls, recommendation_id: int, period: str) -> list:
+        """Returns the aggregates of a Recommendation in a period, oldest first"""
+        return cls.query.filter(cls.recommendation_id == recommendation_id, cls.period == period) \
+            .order_by(cls.period_start).all()
+
+
+def _logaddexp(a: float, b: float) -> float:
+    """Returns log(exp(a) + exp(b)) without computing the exponentials"""
+    return max(a, b) + math.log1p(math.exp(-abs(a - b)))
+
+
+@db.event.listens_for(Engine, "connect")
+def _register_math_functions(dbapi_connection, connection_record):
+    """Gives SQLite the ln() and exp() that the trending scores are updated
+    with, in case it was built without its math functions"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function("ln", 1, math.log, deterministic=True)
+        dbapi_connection.create_function("exp", 1, math.exp, deterministic=True)
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    """No-op listener; registering it with active_history does the work"""
+
 
-        return query
+# Load the old value of the filter columns before they are overwritten, even
+# when a commit expired them, so that a write knows every cached list and
+# data version it changes
+for _attribute in (Recommendation.product_id, Recommendation.rec_product_id, Recommendation.type):
+    db.event.listen(_attribute, "set", _keep_old_value, active_history=True)
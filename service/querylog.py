@@ -0,0 +1,159 @@
+"""
+SQL statement instrumentation
+
+Every statement sent to the database is timed by SQLAlchemy engine events.
+For each request this records the number of statements, the total time spent
+in the database and the slowest statement, logs them at debug level and,
+with SERVER_TIMING on or in debug mode, returns them in a Server-Timing
+header. Statements slower than
+SLOW_QUERY_THRESHOLD seconds are logged as warnings with their parameters
+redacted.
+
+query_budget() is meant for the tests: it fails when the code it wraps runs
+more statements than allowed, which catches N+1 queries before they ship.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Flask, current_app, g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("flask.app")
+
+# longest part of a statement written to the slow query log
+STATEMENT_LOG_LENGTH = 1000
+
+# the budgets of the query_budget() blocks running in each thread
+_local = threading.local()
+
+
+class QueryStats:
+    """The statements a request sent to the database"""
+
+    __slots__ = ("count", "duration", "slowest", "slowest_statement")
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = None
+
+    def record(self, statement: str, duration: float):
+        """Adds a statement that took duration seconds"""
+        self.count += 1
+        self.duration += duration
+        if duration > self.slowest:
+            self.slowest = duration
+            self.slowest_statement = statement
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a query_budget() block runs too many statements"""
+
+
+def init_querylog(app: Flask):
+    """Records the statements of each request of the app"""
+    app.before_request(_start_request)
+    app.after_request(_end_request)
+
+
+def slow_query_threshold() -> float:
+    """Returns the seconds a statement of the current app may take before it
+    is logged, 0 if the slow query log is off"""
+    return current_app.config.get("SLOW_QUERY_THRESHOLD", 0.0) if has_app_context() else 0.0
+
+
+def current_stats() -> QueryStats:
+    """Returns the statements of the current request so far, or None"""
+    return g.get("query_stats") if has_app_context() else None
+
+
+@contextmanager
+def query_budget(max_statements: int):
+    """Fails if the block runs more than max_statements statements in this thread
+
+    Use it in the tests to pin the number of statements of a route:
+
+        with query_budget(2):
+            self.app.put("/recommendations/1/interested")
+
+    :raises QueryBudgetExceeded: listing the statements that were run
+
+    """
+    stats = QueryStats()
+    statements = []
+    budgets = _local.__dict__.setdefault("budgets", [])
+    budgets.append((stats, statements))
+    try:
+        yield stats
+    finally:
+        budgets.pop()
+    if stats.count > max_statements:
+        raise QueryBudgetExceeded("{} statements run, the budget is {}:\n{}".format(
+            stats.count, max_statements, "\n".join(statements)))
+
+
+def redact(statement: str) -> str:
+    """Returns a statement fit for the log
+
+    Parameters are never part of the statement text, they are sent separately
+    as bind parameters and are left out of the log altogether; long
+    statements such as multi-row inserts are cut short.
+
+    """
+    statement = " ".join(statement.split())
+    if len(statement) > STATEMENT_LOG_LENGTH:
+        statement = statement[:STATEMENT_LOG_LENGTH] + "..."
+    return statement
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def _start_request():
+    g.query_stats = QueryStats()
+
+
+def _end_request(response):
+    stats = g.pop("query_stats", None)
+    if stats is None:
+        return response
+    if current_app.config["SERVER_TIMING"] or current_app.debug:
+        response.headers.add(
+            "Server-Timing", 'db;dur={:.3f};desc="statements={}"'.format(stats.duration * 1000, stats.count))
+    if stats.count and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%d statements in %.1f ms, slowest %.1f ms: %s", stats.count,
+                     stats.duration * 1000, stats.slowest * 1000, redact(stats.slowest_statement))
+    return response
+
+
+######################################################################
+#  D A T A B A S E   H O O K S
+######################################################################
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("querylog_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["querylog_start"].pop()
+    stats = current_stats()
+    if stats is not None:
+        stats.record(statement, duration)
+    for budget, statements in getattr(_local, "budgets", ()):
+        budget.record(statement, duration)
+        statements.append(redact(statement))
+    if 0 < slow_query_threshold() <= duration:
+        logger.warning("Slow query took %.1f ms (parameters redacted): %s",
+                       duration * 1000, redact(statement))
+
+
+@event.listens_for(Engine, "handle_error")
+def _failed_statement(context):
+    starts = context.connection.info.get("querylog_start") if context.connection else None
+    if starts:
+        starts.pop()
@@ -0,0 +1,217 @@
+"""
+Read replica routing
+
+With DATABASE_REPLICA_URIS set, the statements of GET and HEAD requests run
+on one of the read replicas, picked round-robin, while every other request,
+and everything outside of a request (the interested counter flushes, the
+CLI), runs on the primary database. A request sticks to the replica it
+started on, so all of its reads see the same snapshot.
+
+Read-your-writes: a request that changes data sets a cookie that sends the
+client's reads to the primary for REPLICA_STICKY_SECONDS, long enough for the
+replicas to catch up. These reads also skip the list cache and the snapshot,
+which may hold rows from before the write, and the cache is never filled from
+a replica, which may lag behind the write that invalidated it.
+
+A replica that cannot be connected to is skipped for REPLICA_RETRY_INTERVAL
+seconds; when no replica is up, reads go to the primary. A statement that
+fails on a replica is run again, once, on the primary, and the rest of the
+request reads from the primary too.
+"""
+import itertools
+import logging
+import time
+
+from flask import Flask, current_app, g, has_request_context, request
+from flask_sqlalchemy import BaseQuery, SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, exc, orm
+from werkzeug.local import LocalProxy
+
+logger = logging.getLogger("flask.app")
+
+# set on the responses to requests that changed data
+STICKY_COOKIE = "recommendations_read_primary"
+
+READ_METHODS = ("GET", "HEAD")
+
+# engine options that only apply to pools with a fixed size
+POOL_SIZE_OPTIONS = ("pool_size", "max_overflow", "pool_timeout")
+
+
+class ReplicaRouter:
+    """Picks the read replica, if any, that the statements of a request run on"""
+
+    def __init__(self, sticky_seconds: int = 5, retry_interval: float = 30.0):
+        self.sticky_seconds = sticky_seconds
+        self.retry_interval = retry_interval
+        self.engines = []
+        self._down_until = {}
+        self._turn = itertools.count()
+
+    def init_app(self, app: Flask):
+        """Connects to the replicas of the Flask app
+
+        Must be set up before the session teardown of the app, so that the
+        replica connection of a request is closed after its session.
+        """
+        self.sticky_seconds = app.config["REPLICA_STICKY_SECONDS"]
+        self.retry_interval = app.config["REPLICA_RETRY_INTERVAL"]
+        self.engines = [
+            create_engine(uri, **engine_options(uri, app.config["SQLALCHEMY_ENGINE_OPTIONS"]))
+            for uri in app.config["SQLALCHEMY_REPLICA_URIS"]
+        ]
+        self._down_until = {}
+        app.extensions["replica_router"] = self
+        app.before_request(self._start_request)
+        app.after_request(self._set_sticky_cookie)
+        app.teardown_request(self._close_connection)
+
+    def connection(self):
+        """Returns the replica connection of the current request
+
+        :return: the connection, or None if the request reads from the primary
+        :rtype: Connection
+
+        """
+        if not has_request_context() or not g.get("read_replica"):
+            return None
+        conn = g.get("replica_connection")
+        if conn is None:
+            conn = self._connect()
+            if conn is None:
+                g.read_replica = False
+                return None
+            g.replica_connection = conn
+        return conn
+
+    def is_sticky(self) -> bool:
+        """True if the current request must read its own writes from the primary"""
+        return bool(self.engines) and has_request_context() and STICKY_COOKIE in request.cookies
+
+    def reads_replica(self) -> bool:
+        """True if the statements of the current request run on a replica"""
+        return has_request_context() and bool(g.get("read_replica"))
+
+    def fail_over(self, error: exc.DBAPIError):
+        """Sends the rest of the current request to the primary after a
+        statement failed on its replica
+
+        :return: True if the statement ran on a replica and can be retried
+        :rtype: bool
+
+        """
+        if not has_request_context() or g.get("replica_connection") is None:
+            return False
+        conn = g.pop("replica_connection")
+        g.read_replica = False
+        logger.warning("Read replica %r failed, reading from the primary: %s", conn.engine.url, error)
+        if error.connection_invalidated:
+            self.mark_down(conn.engine)
+        conn.close()
+        return True
+
+    def mark_down(self, engine):
+        """Skips a replica for retry_interval seconds"""
+        self._down_until[engine] = time.monotonic() + self.retry_interval
+
+    def _connect(self):
+        """Connects to the next replica that is up, None if all are down"""
+        start = next(self._turn)
+        for i in range(len(self.engines)):
+            engine = self.engines[(start + i) % len(self.engines)]
+            if self._down_until.get(engine, 0) > time.monotonic():
+                continue
+            try:
+                return engine.connect()
+            except exc.DBAPIError as error:
+                logger.warning("Read replica %r is down, skipping it for %s s: %s",
+                               engine.url, self.retry_interval, error)
+                self.mark_down(engine)
+        return None
+
+    ######################################################################
+    #  R E Q U E S T   H O O K S
+    ######################################################################
+    def _start_request(self):
+        g.read_replica = bool(self.engines and request.method in READ_METHODS
+                              and STICKY_COOKIE not in request.cookies)
+
+    def _set_sticky_cookie(self, response):
+        if self.engines and request.method not in READ_METHODS and response.status_code < 400:
+            response.set_cookie(STICKY_COOKIE, "1", max_age=self.sticky_seconds, httponly=True)
+        return response
+
+    def _close_connection(self, exception=None):
+        conn = g.pop("replica_connection", None)
+        if conn is not None:
+            conn.close()
+
+
+class RoutingSession(SignallingSession):
+    """A Flask-SQLAlchemy session that reads from the replica of the request"""
+
+    def get_bind(self, mapper=None, clause=None):
+        # a flush writes, so it always goes to the primary
+        router = current_router()
+        if router is not None and not self._flushing:
+            conn = router.connection()
+            if conn is not None:
+                return conn
+        return super().get_bind(mapper, clause)
+
+    def execute(self, clause, params=None, mapper=None, bind=None, **kw):
+        try:
+            return super().execute(clause, params, mapper, bind, **kw)
+        except exc.DBAPIError as error:
+            if not self.fail_over(error):
+                raise
+        return super().execute(clause, params, mapper, bind, **kw)
+
+    def fail_over(self, error: exc.DBAPIError) -> bool:
+        """Moves the session to the primary after a statement failed on the
+        replica, True if the statement can be retried"""
+        router = current_router()
+        if router is None or self._flushing or not router.reads_replica():
+            return False
+        # the transaction still holds the broken replica connection
+        self.rollback()
+        return router.fail_over(error)
+
+
+class RoutingQuery(BaseQuery):
+    """A query that is run again on the primary if it fails on the replica"""
+
+    def __iter__(self):
+        try:
+            return super().__iter__()
+        except exc.DBAPIError as error:
+            if not self.session.fail_over(error):
+                raise
+        return super().__iter__()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with sessions that read from the replica of the request"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("query_class", RoutingQuery)
+        super().__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def current_router():
+    """Returns the ReplicaRouter of the current app, None if it has none"""
+    return current_app.extensions.get("replica_router")
+
+
+def engine_options(uri: str, options: dict) -> dict:
+    """Returns the engine options that apply to a database URI"""
+    if uri.startswith("sqlite"):
+        return {key: value for key, value in options.items() if key not in POOL_SIZE_OPTIONS}
+    return dict(options)
+
+
+# the router of the current app, each app gets its own in create_app()
+replica_router = LocalProxy(lambda: current_app.extensions["replica_router"])
@@ -0,0 +1,87 @@
+"""
+Append-only interest events and their rollup
+
+With INTEREST_EVENTS turned on, PUT /recommendations/{id}/interested and
+PUT /recommendations/interested append a row per click (or per batch of
+clicks, with INTERESTED_COALESCE) to the interest_event table instead of
+updating the Recommendation. Appending never rewrites a row, so the hottest
+Recommendations stop leaving a dead tuple behind on every click.
+
+A background thread in each worker rolls the events up every
+INTEREST_ROLLUP_INTERVAL seconds: at most INTEREST_ROLLUP_BATCH_SIZE events per
+transaction are added to Recommendation.interested (and to the hourly or daily
+aggregates named in INTEREST_AGGREGATES) and deleted. The counters read by the
+list routes lag by up to one interval; GET and PUT of a single Recommendation
+add the events that are not rolled up yet, so their counts are exact.
+
+Run a rollup by hand with:
+    FLASK_APP=service:app flask recs rollup
+"""
+import atexit
+import logging
+
+from flask import Flask, current_app
+from werkzeug.local import LocalProxy
+
+from service.background import BackgroundThread
+from service.models import InterestEvent
+
+logger = logging.getLogger("flask.app")
+
+
+class InterestRollup:
+    """Appends interest events and periodically rolls them up"""
+
+    def __init__(self, interval: float = 60.0, batch_size: int = 10000, periods: tuple = ()):
+        self.app: Flask = None
+        self.interval = interval
+        self.batch_size = batch_size
+        self.periods = periods
+        self._roller = BackgroundThread(
+            self.run, lambda: self.interval, "interest-rollup",
+            error="Rolling up interest events failed, will retry")
+
+    def init_app(self, app: Flask):
+        """Configures the rollup from the Flask app"""
+        self.app = app
+        self.interval = app.config["INTEREST_ROLLUP_INTERVAL"]
+        self.batch_size = app.config["INTEREST_ROLLUP_BATCH_SIZE"]
+        self.periods = app.config["INTEREST_AGGREGATES"]
+        app.extensions["interest_rollup"] = self
+        atexit.register(self.stop)
+
+    def append(self, counts: dict):
+        """Appends the clicks of Recommendations as interest events
+
+        :param counts: the number of clicks for each Recommendation id
+        :type counts: dict
+
+        """
+        self._roller.ensure_started()
+        InterestEvent.append(counts)
+
+    def run(self) -> int:
+        """Rolls up the events until there are none left
+
+        :return: the number of events rolled up
+        :rtype: int
+
+        """
+        total = 0
+        with self.app.app_context():
+            while True:
+                rolled = InterestEvent.rollup(self.batch_size, self.periods)
+                total += rolled
+                if rolled < self.batch_size:
+                    break
+        if total:
+            logger.debug("Rolled up %d interest events", total)
+        return total
+
+    def stop(self):
+        """Stops the background rollups"""
+        self._roller.stop()
+
+
+# the rollup of the current app, each app gets its own in create_app()
+interest_rollup = LocalProxy(lambda: current_app.extensions["interest_rollup"])
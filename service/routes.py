@@ -4,40 +4,50 @@ RECOMMENDATIONS SERVICE
 Paths:
 ------
 GET / - Root Resource
-GET /recommendations - Return a list of all recommendations for all products
+GET /recommendations - Return a page of the recommendations for all products
+GET /recommendations/batch - Return the recommendations of many products at once
+GET /recommendations/export - Stream all recommendations as newline delimited JSON
+GET /products/{product_id}/recommendations/top - Return the most interesting recommendations of a product
+PUT /recommendations/interested - Increment the interested counters of many recommendations
 POST /recommendation - Add a recommendation for products
+POST /recommendations/batch - Add many recommendations in one transaction
 """
-from flask import request, abort
-from flask_restx import Api, Resource, fields
+import hashlib
+from collections import Counter
+
+import orjson
+from flask import Response, current_app, make_response, request, abort, stream_with_context, url_for
+from flask_restx import Api, Namespace, Resource, fields
 from werkzeug.exceptions import NotFound
+from werkzeug.http import quote_etag
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
-from service.models import Recommendation
+from service.models import Recommendation, RecommendationType, DataVersion, DataValidationError
+from service.assets import static_assets
+from service.counters import interested_counter
+from service.rollup import interest_rollup
+from service.cache import TOO_LARGE, recommendation_cache
+from service.replicas import replica_router
 # Import Flask application
-from . import app, status
+from . import status
+
+# the range of the ids of the database, which are 32-bit integers
+ID_MIN, ID_MAX = -2 ** 31, 2 ** 31 - 1
 
 
 ######################################################################
 # GET INDEX
 ######################################################################
-@app.route("/")
 def index():
-    return app.send_static_file('index.html')
+    return static_assets.send_index()
 
 
 # ######################################################################
-# # Configure Swagger before initializing it
+# # The resources, added to the Api of each app by init_app(), with the
+# # endpoint names they had as resources of the Api itself
 # ######################################################################
-api = Api(
-    app,
-    version='1.0.0',
-    title='Recommendations REST API Service',
-    description='This is a sample server for the recommendation service.',
-    default='recommendation',
-    default_label='Recommendation Management',
-    doc='/apidocs'
-)
+api = Namespace('recommendation', description='Recommendation Management', path='/')
 
 # Model definition starts
 create_recommendation_model = api.model(
@@ -63,10 +73,24 @@ recommendation_model = api.inherit(
 
 # Model definition ends
 
+
+# Handlers return the dictionaries from Recommendation.serialize(), which
+# already have exactly the fields of recommendation_model, so instead of
+# running them through marshal_with the response is encoded in one pass
+def output_json(data, code, headers=None):
+    """Makes a Flask response with a JSON encoded body"""
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+    if current_app.debug:
+        option |= orjson.OPT_INDENT_2
+    resp = make_response(orjson.dumps(data, option=option), code)
+    resp.headers.extend(headers or {})
+    return resp
+
+
 ######################################################################
 #  PATH: /recommendations/{id}
 ######################################################################
-@api.route('/recommendations/<int:id>')
+@api.route('/recommendations/<int:id>', endpoint='recommendation_resource')
 @api.param('id', 'Recommendation identifier')
 class RecommendationResource(Resource):
     """
@@ -81,18 +105,37 @@ class RecommendationResource(Resource):
     # RETRIEVE A Recommendation
     # ------------------------------------------------------------------
     @api.response(404, 'Recommendation not found')
-    @api.marshal_with(recommendation_model)
+    @api.response(304, 'Recommendation not modified since the ETag in If-None-Match')
+    @api.response(200, 'Success', recommendation_model)
     def get(self, id):
         """
         Retrieve a single recommendation
         This endpoint will return a recommendation based on it's id
         """
-        app.logger.info("Request to Retrieve a recommendation with id [%s]", id)
+        current_app.logger.info("Request to Retrieve a recommendation with id [%s]", id)
+        # the ETag names the query product of the Recommendation, so a client
+        # that is up to date is told so without reading the Recommendation
+        product_id = etag_product_id(request.if_none_match)
+        if product_id is not None:
+            etag, not_modified = check_etag(DataVersion.product_scope(product_id),
+                                            item_version(id, product_id), product_id)
+            if not_modified:
+                return '', status.HTTP_304_NOT_MODIFIED, {'ETag': etag}
+        if current_app.config["INTEREST_EVENTS"]:
+            # appending interest events changes the counter without bumping
+            # the data version, so the ETag is also made from the events
+            row = find_exact(id)
+            scope = DataVersion.product_scope(row.product_id)
+            etag, _ = check_etag(scope, "{}+{}".format(DataVersion.get(scope), row.pending), row.product_id)
+            return Recommendation.serialize_row(row), status.HTTP_200_OK, {'ETag': etag}
         recommendation = Recommendation.find(id)
         if not recommendation:
             abort(status.HTTP_404_NOT_FOUND, "Recommndation with id '{}' was not found.".format(id))
-        app.logger.info("Returning recommendation: %s", recommendation.id)
-        return recommendation.serialize(), status.HTTP_200_OK
+        # the version of its product covers every write to the Recommendation
+        etag, _ = check_etag(DataVersion.product_scope(recommendation.product_id),
+                             product_id=recommendation.product_id)
+        current_app.logger.info("Returning recommendation: %s", recommendation.id)
+        return recommendation.serialize(), status.HTTP_200_OK, {'ETag': etag}
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING Recommendation
@@ -100,17 +143,17 @@ class RecommendationResource(Resource):
     @api.response(404, 'Recommendation not found')
     @api.response(400, 'The posted recommndation data was not valid')
     @api.expect(create_recommendation_model)
-    @api.marshal_with(recommendation_model)
+    @api.response(200, 'Success', recommendation_model)
     def put(self, id):
         """
         Update a recommendation
         This endpoint will update a recommendation based the body that is posted
         """
-        app.logger.info('Request to Update a recommendation with id [%s]', id)
+        current_app.logger.info('Request to Update a recommendation with id [%s]', id)
         recommendation = Recommendation.find(id)
         if not recommendation:
             abort(status.HTTP_404_NOT_FOUND, "Recommendation with id '{}' was not found.".format(id))
-        app.logger.debug('Payload = %s', api.payload)
+        current_app.logger.debug('Payload = %s', api.payload)
         data = api.payload
         recommendation.deserialize(data)
         recommendation.id = id
@@ -126,11 +169,11 @@ class RecommendationResource(Resource):
         Delete a Recommendation
         This endpoint will delete a Recommendation based the id specified in the path
         """
-        app.logger.info('Request to Delete a recommendation with id [%s]', id)
+        current_app.logger.info('Request to Delete a recommendation with id [%s]', id)
         recommendation = Recommendation.find(id)
         if recommendation:
             recommendation.delete()
-            app.logger.info('Recommendation with id [%s] was deleted', id)
+            current_app.logger.info('Recommendation with id [%s] was deleted', id)
 
         return '', status.HTTP_204_NO_CONTENT
 
@@ -138,55 +181,93 @@ class RecommendationResource(Resource):
 ######################################################################
 #  PATH: /recommendations
 ######################################################################
-@api.route('/recommendations', strict_slashes=False)
+@api.route('/recommendations', endpoint='recommendation_collection', strict_slashes=False)
 class RecommendationCollection(Resource):
     """ Handles all interactions with collections of Recommendations """
 
     # ------------------------------------------------------------------
     # LIST ALL RECOMMENDATION
     # ------------------------------------------------------------------
-    @api.marshal_list_with(recommendation_model)
+    @api.doc(params={
+        'product_id': 'Filter by the query product',
+        'rec_product_id': 'Filter by the recommended product',
+        'type': 'Filter by the recommendation type',
+        'sort': 'Sort order: id (default), interested (most interested first) or trending '
+                '(most interested lately first)',
+        'limit': 'Maximum number of recommendations to return',
+        'cursor': 'Cursor of the page to return, from the Link header of the previous page',
+    })
+    @api.response(400, 'The pagination parameters were not valid')
+    @api.response(304, 'List not modified since the ETag in If-None-Match')
+    @api.response(200, 'Success', [recommendation_model])
     def get(self):
-        """ Returns all of the Recommendations """
-        app.logger.info('Request to list Recommendations...')
-        recommendations = []
+        """
+        Returns all of the Recommendations
+        The list is paginated: when there are more recommendations a Link header
+        with rel="next" points at the next page. With INTEREST_EVENTS on, the
+        interested counters are the rolled-up ones, which lag the clicks by up to
+        INTEREST_ROLLUP_INTERVAL seconds, and so does the ETag
+        """
+        current_app.logger.info('Request to list Recommendations...')
         product_id = request.args.get('product_id')
         rec_product_id = request.args.get("rec_product_id")
         rec_type = request.args.get("type")
+        sort = request.args.get("sort")
+        limit = get_page_size()
+        cursor = request.args.get("cursor")
+        after = Recommendation.decode_cursor(cursor, sort) if cursor else None
+        scope = version_scope(product_id)
+        version = DataVersion.get(scope)
+        etag, not_modified = check_etag(scope, version)
+        if not_modified:
+            return '', status.HTTP_304_NOT_MODIFIED, {'ETag': etag}
 
-        if product_id or rec_product_id or rec_type:
-            recommendations = Recommendation.find_rec_by_filter(
+        page = find_snapshot_page(scope, version, limit, after, sort,
+                                  product_id, rec_product_id, rec_type)
+        # the cached lists have no trending score to sort by
+        cached = find_cached(product_id, rec_product_id, rec_type, version) \
+            if page is None and sort != "trending" else None
+        if page is not None:
+            results, last_key = page
+        elif cached is not None:
+            results, last_key = Recommendation.paginate_rows(cached, limit, after, sort)
+        else:
+            query = Recommendation.find_rec_by_filter(
                 product_id=product_id,
                 rec_product_id=rec_product_id,
                 type=rec_type
             )
-        else:
-            recommendations = Recommendation.all()
-
-        results = [recommendation.serialize()
-                   for recommendation in recommendations]
-        app.logger.info("Returning %d recommendations", len(results))
-        return results, status.HTTP_200_OK
+            recommendations, last_key = Recommendation.find_page(query, limit, after, sort)
+            results = [recommendation.serialize()
+                       for recommendation in recommendations]
+        headers = {'ETag': etag}
+        if last_key is not None:
+            args = request.args.to_dict()
+            args["cursor"] = Recommendation.encode_cursor(last_key)
+            next_url = url_for(RecommendationCollection.endpoint, _external=True, **args)
+            headers["Link"] = '<{}>; rel="next"'.format(next_url)
+        current_app.logger.info("Returning %d recommendations", len(results))
+        return results, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW RECOMMENDATION
     # ------------------------------------------------------------------
     @api.expect(create_recommendation_model)
     @api.response(400, 'The posted data was not valid')
-    @api.marshal_with(recommendation_model, code=201)
+    @api.response(201, 'Recommendation created', recommendation_model)
     def post(self):
         """
         Creates a Recommendation
         This endpoint will create a Recommendation based the data in the body that is posted
         """
-        app.logger.info('Request to Create a Recommendation')
+        current_app.logger.info('Request to Create a Recommendation')
         check_content_type("application/json")
         recommendation = Recommendation()
-        app.logger.debug('Payload = %s', api.payload)
+        current_app.logger.debug('Payload = %s', api.payload)
         recommendation.deserialize(api.payload)
         recommendation.create()
-        app.logger.info('Recommendation with new id [%s] created!', recommendation.id)
-        location_url = api.url_for(RecommendationResource, id=recommendation.id, _external=True)
+        current_app.logger.info('Recommendation with new id [%s] created!', recommendation.id)
+        location_url = url_for(RecommendationResource.endpoint, id=recommendation.id, _external=True)
         return recommendation.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
     # ------------------------------------------------------------------
@@ -198,20 +279,180 @@ class RecommendationCollection(Resource):
         Delete all Recommendation
         This endpoint will delete all Recommendation only if the system is under test
         """
-        app.logger.info('Request to Delete all recommendations...')
-        if "TESTING" in app.config and app.config["TESTING"]:
+        current_app.logger.info('Request to Delete all recommendations...')
+        if "TESTING" in current_app.config and current_app.config["TESTING"]:
             Recommendation.remove_all()
-            app.logger.info("Removed all Recommendations from the database")
+            current_app.logger.info("Removed all Recommendations from the database")
         else:
-            app.logger.warning("Request to clear database while system not under test")
+            current_app.logger.warning("Request to clear database while system not under test")
 
         return '', status.HTTP_204_NO_CONTENT
 
 
+######################################################################
+#  PATH: /recommendations/batch
+######################################################################
+@api.route('/recommendations/batch', endpoint='recommendation_batch')
+class RecommendationBatch(Resource):
+    """ Handles batches of Recommendations """
+
+    @api.doc(params={
+        'product_id': 'Comma separated query products, e.g. 1,2,3',
+        'rec_product_id': 'Filter by the recommended product',
+        'type': 'Filter by the recommendation type',
+        'sort': 'Sort order: id (default), interested (most interested first) or trending '
+                '(most interested lately first)',
+        'limit': 'Maximum number of recommendations to return per product',
+    })
+    @api.response(400, 'The parameters were not valid')
+    @api.response(304, 'Lists not modified since the ETag in If-None-Match')
+    @api.response(200, 'Success')
+    def get(self):
+        """
+        Returns the Recommendations of many products
+        The response maps each query product to its list of recommendations, each
+        capped at limit; all of the products are read in a single query. With
+        INTEREST_EVENTS on, the interested counters are the rolled-up ones, which
+        lag the clicks by up to INTEREST_ROLLUP_INTERVAL seconds, and so does the ETag
+        """
+        product_ids = get_product_ids()
+        current_app.logger.info('Request for the recommendations of %d products', len(product_ids))
+        rec_product_id = request.args.get("rec_product_id")
+        rec_type = request.args.get("type")
+        sort = request.args.get("sort")
+        limit = get_page_size("limit", current_app.config["TOP_N_DEFAULT"])
+        try:
+            rec_product_id = int(rec_product_id) if rec_product_id else None
+        except ValueError:
+            abort(status.HTTP_400_BAD_REQUEST, "rec_product_id must be an integer")
+        if rec_type and rec_type not in RecommendationType.__members__:
+            abort(status.HTTP_400_BAD_REQUEST, "Invalid Recommendation Type: " + rec_type)
+        scopes = [DataVersion.product_scope(product_id) for product_id in product_ids]
+        versions = DataVersion.get_many(scopes)
+        etag, not_modified = check_etag(",".join(scopes), ",".join(str(versions[scope]) for scope in scopes))
+        if not_modified:
+            return '', status.HTTP_304_NOT_MODIFIED, {'ETag': etag}
+
+        results = Recommendation.find_by_products(
+            product_ids, limit, sort, rec_product_id, rec_type and RecommendationType[rec_type])
+        current_app.logger.info("Returning the recommendations of %d products", len(results))
+        return results, status.HTTP_200_OK, {'ETag': etag}
+
+    @api.expect([create_recommendation_model])
+    @api.response(201, 'Recommendations created')
+    @api.response(400, 'The posted data was not valid')
+    @api.response(413, 'The batch was too large')
+    def post(self):
+        """
+        Creates many Recommendations
+        Every recommendation in the posted list is validated on its own; the valid
+        ones are created in a single transaction. The response lists, in order,
+        the id of each created recommendation or the error that rejected it.
+        """
+        current_app.logger.info('Request to Create a batch of Recommendations')
+        check_content_type("application/json")
+        data = api.payload
+        if not isinstance(data, list):
+            abort(status.HTTP_400_BAD_REQUEST, "Body must be a list of recommendations")
+        if len(data) > current_app.config["BATCH_SIZE_MAX"]:
+            abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                  "Batch is limited to {} recommendations".format(current_app.config["BATCH_SIZE_MAX"]))
+
+        results = []
+        recommendations = []
+        for item in data:
+            try:
+                recommendation = Recommendation().deserialize(item)
+            except DataValidationError as error:
+                results.append({"error": str(error)})
+            else:
+                results.append(recommendation)
+                recommendations.append(recommendation)
+        Recommendation.create_many(recommendations)
+
+        results = [result if isinstance(result, dict) else {"id": result.id}
+                   for result in results]
+        current_app.logger.info('Created %d of %d Recommendations', len(recommendations), len(data))
+        if data and not recommendations:
+            return results, status.HTTP_400_BAD_REQUEST
+        return results, status.HTTP_201_CREATED
+
+
+######################################################################
+#  PATH: /recommendations/export
+######################################################################
+@api.route('/recommendations/export', endpoint='recommendation_export')
+class RecommendationExport(Resource):
+    """ Streams collections of Recommendations """
+
+    @api.doc(params={
+        'product_id': 'Filter by the query product',
+        'rec_product_id': 'Filter by the recommended product',
+        'type': 'Filter by the recommendation type',
+    })
+    @api.produces(['application/x-ndjson'])
+    def get(self):
+        """
+        Exports the Recommendations as newline delimited JSON
+        The recommendations are streamed one JSON object per line in id order,
+        so the whole table can be dumped without paginating
+        """
+        current_app.logger.info('Request to export Recommendations...')
+        recommendations = Recommendation.stream(
+            product_id=request.args.get('product_id'),
+            rec_product_id=request.args.get('rec_product_id'),
+            type=request.args.get('type'),
+            chunk_size=current_app.config["EXPORT_CHUNK_SIZE"]
+        )
+        return Response(
+            stream_with_context(generate_ndjson(recommendations, current_app.config["EXPORT_CHUNK_SIZE"])),
+            status=status.HTTP_200_OK,
+            mimetype="application/x-ndjson"
+        )
+
+
+######################################################################
+#  PATH: /recommendations/interested
+######################################################################
+@api.route('/recommendations/interested', endpoint='interested_collection')
+class InterestedCollection(Resource):
+    """ Action on many Recommendations """
+
+    @api.doc(description=(
+        'The body is a list of clicks: either ids, repeated once per click, e.g. [1, 1, 2], '
+        'or objects with the id and the number of clicks, e.g. [{"id": 1, "count": 2}], '
+        'at most INTERESTED_COUNT_MAX'))
+    @api.response(200, 'Counters incremented')
+    @api.response(400, 'The posted data was not valid')
+    @api.response(413, 'The batch was too large')
+    def put(self):
+        """
+        Increment the interested counters of many recommendations
+        All of the increments are applied in one transaction; the response gives
+        the number of recommendations updated and the ids that were not found
+        """
+        current_app.logger.info('Request to increment interested counters in bulk')
+        check_content_type('application/json')
+        counts = get_interested_counts(api.payload)
+        if current_app.config["INTERESTED_COALESCE"]:
+            found = Recommendation.find_ids(counts)
+            for id in found:
+                interested_counter.add(id, counts[id])
+        elif current_app.config["INTEREST_EVENTS"]:
+            found = Recommendation.find_ids(counts)
+            interest_rollup.append({id: counts[id] for id in found})
+        else:
+            found = [row.id for row in Recommendation.increment_interested(counts)]
+        not_found = sorted(set(counts) - set(found))
+        current_app.logger.info("Interested counts of %d recommendations updated, %d not found",
+                                len(found), len(not_found))
+        return {"updated": len(found), "not_found": not_found}, status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /recommendations/{id}/interested
 ######################################################################
-@api.route('/recommendations/<id>/interested')
+@api.route('/recommendations/<id>/interested', endpoint='interested_resource')
 @api.param('id', 'The Recommendation identifier')
 class InterestedResource(Resource):
     """ Action on a Recommendation """
@@ -223,19 +464,93 @@ class InterestedResource(Resource):
         Increment a recommendation's interesed field
         This endpoint will increment the interested counter by one when interested button is clicked
         """
-        app.logger.info(
+        current_app.logger.info(
             'Increment intrested field for recommendation with id: %s', id)
         check_content_type('application/json')
-        recommendation = Recommendation.find(id)
-        if not recommendation:
+        try:
+            id = int(id)
+        except ValueError:
+            raise NotFound("Recommendation with id '{}' was not found.".format(id))
+
+        if current_app.config["INTERESTED_COALESCE"]:
+            if current_app.config["INTEREST_EVENTS"]:
+                result = Recommendation.serialize_row(find_exact(id))
+            else:
+                recommendation = Recommendation.find(id)
+                if not recommendation:
+                    raise NotFound(
+                        "Recommendation with id '{}' was not found.".format(id))
+                result = recommendation.serialize()
+            result["interested"] += interested_counter.add(id)
+            current_app.logger.info(
+                "Interested count with recommendation ID [%s] buffered.", id)
+            return result, status.HTTP_200_OK
+
+        if current_app.config["INTEREST_EVENTS"]:
+            result = Recommendation.serialize_row(find_exact(id))
+            interest_rollup.append({id: 1})
+            result["interested"] += 1
+            current_app.logger.info(
+                "Interested event of recommendation ID [%s] appended.", id)
+            return result, status.HTTP_200_OK
+
+        rows = Recommendation.increment_interested({id: 1})
+        if not rows:
             raise NotFound(
                 "Recommendation with id '{}' was not found.".format(id))
-        recommendation.interested += 1
-        recommendation.update()
 
-        app.logger.info(
-            "Interested count with recommendation ID [%s] updated.", recommendation.id)
-        return recommendation.serialize(), status.HTTP_200_OK
+        current_app.logger.info(
+            "Interested count with recommendation ID [%s] updated.", id)
+        return Recommendation.serialize_row(rows[0]), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products/{product_id}/recommendations/top
+######################################################################
+@api.route('/products/<int:product_id>/recommendations/top', endpoint='top_recommendation_collection')
+@api.param('product_id', 'The query product identifier')
+class TopRecommendationCollection(Resource):
+    """ Ranked Recommendations of a product """
+
+    @api.doc(params={
+        'n': 'Number of recommendations to return',
+        'type': 'Only return recommendations of this type',
+    })
+    @api.response(400, 'The parameters were not valid')
+    @api.response(304, 'List not modified since the ETag in If-None-Match')
+    @api.response(200, 'Success', [recommendation_model])
+    def get(self, product_id):
+        """
+        Returns the top recommendations of a product
+        The recommendations are ranked by their interested counter, highest first.
+        With INTEREST_EVENTS on, the counters are the rolled-up ones, which lag the
+        clicks by up to INTEREST_ROLLUP_INTERVAL seconds, and so does the ETag
+        """
+        current_app.logger.info('Request for the top recommendations of product [%s]', product_id)
+        n = get_page_size("n", current_app.config["TOP_N_DEFAULT"])
+        rec_type = request.args.get("type")
+        if rec_type and rec_type not in RecommendationType.__members__:
+            abort(status.HTTP_400_BAD_REQUEST, "Invalid Recommendation Type: " + rec_type)
+        scope = DataVersion.product_scope(product_id)
+        version = DataVersion.get(scope)
+        etag, not_modified = check_etag(scope, version)
+        if not_modified:
+            return '', status.HTTP_304_NOT_MODIFIED, {'ETag': etag}
+
+        page = find_snapshot_page(scope, version, n, sort="interested",
+                                  product_id=product_id, rec_type=rec_type)
+        cached = find_cached(product_id, None, rec_type, version) if page is None else None
+        if page is not None:
+            results, _ = page
+        elif cached is not None:
+            results, _ = Recommendation.paginate_rows(cached, n, sort="interested")
+        else:
+            # an index range scan of (product_id, interested DESC, id DESC) for n rows
+            query = Recommendation.find_rec_by_filter(product_id=product_id, type=rec_type)
+            recommendations, _ = Recommendation.find_page(query, n, sort="interested")
+            results = [recommendation.serialize() for recommendation in recommendations]
+        current_app.logger.info("Returning %d recommendations", len(results))
+        return results, status.HTTP_200_OK, {'ETag': etag}
 
 
 ######################################################################
@@ -243,13 +558,195 @@ class InterestedResource(Resource):
 ######################################################################
 
 
+def find_cached(product_id, rec_product_id, rec_type, version):
+    """Returns the serialized Recommendations matching a filter through the
+    cache, or None if the filter is not cached
+
+    :param version: the data version of the filter, read before the call
+
+    """
+    key = recommendation_cache.key(product_id, rec_product_id, rec_type)
+    if key is None or not recommendation_cache.enabled or replica_router.is_sticky():
+        return None
+    if rec_type and rec_type not in RecommendationType.__members__:
+        return None
+    rows = recommendation_cache.get(key, version)
+    if rows is None:
+        query = Recommendation.find_rec_by_filter(
+            product_id=product_id,
+            rec_product_id=rec_product_id,
+            type=rec_type
+        )
+        recommendations, more = Recommendation.find_page(query, current_app.config["PAGE_SIZE_MAX"])
+        if more is not None:
+            rows = TOO_LARGE  # too many to keep in the cache
+        else:
+            rows = [recommendation.serialize() for recommendation in recommendations]
+        # a replica may not have the write that invalidated the list yet
+        if not replica_router.reads_replica():
+            recommendation_cache.set(key, rows, version)
+    return rows if rows is not TOO_LARGE else None
+
+
+def find_snapshot_page(scope, version, limit, after=None, sort=None,
+                       product_id=None, rec_product_id=None, rec_type=None):
+    """Returns a page of the Recommendations matching a filter from the
+    columnar snapshot, or None if it is off or behind the data version"""
+    snapshot = current_app.extensions.get("recommendation_snapshot")
+    if snapshot is None or replica_router.is_sticky() or not snapshot.is_current(scope, version):
+        return None
+    try:
+        product_id = int(product_id) if product_id not in (None, "") else None
+        rec_product_id = int(rec_product_id) if rec_product_id not in (None, "") else None
+        rec_type = RecommendationType[rec_type] if rec_type else None
+    except (KeyError, ValueError):
+        return None  # left to the database, as without the snapshot
+    return snapshot.find_page(limit, after, sort, product_id, rec_product_id, rec_type)
+
+
+def version_scope(product_id):
+    """Returns the DataVersion scope that covers a list filtered by product_id"""
+    try:
+        return DataVersion.product_scope(product_id)
+    except (TypeError, ValueError):
+        return DataVersion.TABLE_SCOPE
+
+
+def find_exact(id):
+    """Returns the row of a Recommendation with the interest events that are
+    not rolled up yet in its counter, or aborts with 404"""
+    try:
+        rows = Recommendation.find_exact([int(id)])
+    except ValueError:
+        rows = []
+    if not rows:
+        raise NotFound("Recommendation with id '{}' was not found.".format(id))
+    return rows[0]
+
+
+def item_version(id, product_id):
+    """Returns the version of a Recommendation if it belongs to a query
+    product, read from the data version alone (and with INTEREST_EVENTS on
+    the events not rolled up yet, in the same statement)"""
+    scope = DataVersion.product_scope(product_id)
+    if not current_app.config["INTEREST_EVENTS"]:
+        return DataVersion.get(scope)
+    return "{}+{}".format(*DataVersion.get_with_pending(scope, id))
+
+
+def make_etag(scope, version, full_path, product_id=None):
+    """Returns the ETag of a response from the data version of scope alone;
+    the ETag of a single Recommendation starts with its query product"""
+    etag = hashlib.sha1("{}:{}:{}".format(scope, version, full_path).encode()).hexdigest()[:32]
+    return etag if product_id is None else "{}-{}".format(product_id, etag)
+
+
+def etag_product_id(etags):
+    """Returns the query product named by an ETag of a single Recommendation
+    in If-None-Match, None if there is none"""
+    for etag in etags.as_set(include_weak=True):
+        product_id, _, digest = etag.partition("-")
+        try:
+            if len(digest) == 32:
+                return int(product_id)
+        except ValueError:
+            pass
+    return None
+
+
+def check_etag(scope, version=None, product_id=None):
+    """Returns the ETag of the response to this request and whether the client
+    already has it, from the data version of scope alone"""
+    if version is None:
+        version = DataVersion.get(scope)
+    etag = make_etag(scope, version, request.full_path, product_id)
+    return quote_etag(etag, weak=True), request.if_none_match.contains_weak(etag)
+
+
+def get_product_ids():
+    """Returns the distinct query products of the product_id parameters, in order"""
+    product_ids = {}
+    for value in request.args.getlist("product_id"):
+        for product_id in value.split(","):
+            try:
+                product_ids[int(product_id)] = None
+            except ValueError:
+                abort(status.HTTP_400_BAD_REQUEST, "Invalid product_id: " + product_id)
+    if not product_ids:
+        abort(status.HTTP_400_BAD_REQUEST, "product_id is required")
+    if len(product_ids) > current_app.config["BATCH_LOOKUP_MAX"]:
+        abort(status.HTTP_400_BAD_REQUEST,
+              "Lookups are limited to {} products".format(current_app.config["BATCH_LOOKUP_MAX"]))
+    return list(product_ids)
+
+
+def get_interested_counts(data):
+    """Returns the increment of each id of a bulk interested body"""
+    if not isinstance(data, list):
+        abort(status.HTTP_400_BAD_REQUEST, "Body must be a list of clicks")
+    if len(data) > current_app.config["BATCH_SIZE_MAX"]:
+        abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+              "Batch is limited to {} clicks".format(current_app.config["BATCH_SIZE_MAX"]))
+    counts = Counter()
+    for item in data:
+        id, count = (item.get("id"), item.get("count", 1)) if isinstance(item, dict) else (item, 1)
+        # bool is an int, but not an id; ids are 32-bit integers in the database
+        if not isinstance(id, int) or isinstance(id, bool) or not ID_MIN <= id <= ID_MAX \
+                or not isinstance(count, int) or isinstance(count, bool) \
+                or not 1 <= count <= current_app.config["INTERESTED_COUNT_MAX"]:
+            abort(status.HTTP_400_BAD_REQUEST, "Invalid click: {}".format(orjson.dumps(item).decode()))
+        counts[id] += count
+    return dict(counts)
+
+
+def get_page_size(name="limit", default=None):
+    """Returns the page size asked for, capped at the server maximum"""
+    limit = request.args.get(name)
+    if limit is None:
+        return default or current_app.config["PAGE_SIZE_DEFAULT"]
+    try:
+        limit = int(limit)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        abort(status.HTTP_400_BAD_REQUEST, "{} must be a positive integer".format(name))
+    return min(limit, current_app.config["PAGE_SIZE_MAX"])
+
+
+def generate_ndjson(rows, chunk_size):
+    """Encodes dictionaries as lines of JSON, yielding chunk_size lines at a time"""
+    lines = []
+    for row in rows:
+        lines.append(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE))
+        if len(lines) == chunk_size:
+            yield b"".join(lines)
+            lines = []
+    if lines:
+        yield b"".join(lines)
+
+
 def check_content_type(media_type):
     """Checks that the media type is correct"""
     content_type = request.headers.get("Content-Type")
     if content_type and content_type == media_type:
         return
-    app.logger.error("Invalid Content-Type: %s", content_type)
+    current_app.logger.error("Invalid Content-Type: %s", content_type)
     abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
         "Content-Type must be {}".format(media_type),
     )
+
+
+def init_app(app):
+    """Registers the routes on the Flask app"""
+    app.add_url_rule("/", "index", index)
+    rest_api = Api(
+        version='1.0.0',
+        title='Recommendations REST API Service',
+        description='This is a sample server for the recommendation service.',
+        doc='/apidocs'
+    )
+    rest_api.representation('application/json')(output_json)
+    rest_api.add_namespace(api)
+    rest_api.init_app(app)
+    app.extensions["api"] = rest_api
@@ -0,0 +1,258 @@
+"""
+Columnar in-memory snapshot of the recommendation table
+
+With SNAPSHOT_ENABLED turned on, each worker keeps a copy of the whole table
+as six NumPy arrays (id, product_id, rec_product_id, type as its small
+integer value, interested and trending) sorted by product_id, with an offset index of
+where each product's rows start. GET /recommendations and the top route are
+then answered with vectorised lookups instead of SQL and ORM objects, at a
+few bytes per row: a fraction of the memory of the ORM instances.
+
+The snapshot is loaded and refreshed every SNAPSHOT_REFRESH_INTERVAL seconds
+in a background thread; reads go to SQL until it is loaded. Writes bump the
+DataVersion of the products they touch, so a refresh reloads only the rows of
+the products whose version changed. The snapshot remembers the versions its rows were read at, and a request is
+only answered from it when the version of the data it reads is the one in
+the database: a snapshot that is behind falls back to SQL, never to stale
+data.
+"""
+import atexit
+import logging
+import threading
+import time
+
+import numpy as np
+from flask import Flask
+
+from service.background import BackgroundThread
+from service.models import DataVersion, Recommendation, RecommendationType, db
+
+logger = logging.getLogger("flask.app")
+
+# the columns of the snapshot and the type they are stored as
+COLUMNS = (
+    ("id", np.int32),
+    ("product_id", np.int32),
+    ("rec_product_id", np.int32),
+    ("type", np.int8),
+    ("interested", np.int32),
+    ("trending", np.float64),
+)
+
+# RecommendationType names by their value
+TYPE_NAMES = {member.value: member.name for member in RecommendationType}
+
+PRODUCT_SCOPE_PREFIX = DataVersion.product_scope(0)[:-1]
+
+# a refresh reads the whole table again when more than this share of the
+# products changed, rather than one batch of products at a time
+FULL_RELOAD_FRACTION = 0.25
+
+# product ids per IN list when reloading changed products
+RELOAD_CHUNK_SIZE = 1000
+
+
+class SnapshotData:
+    """The arrays of one snapshot, never changed once built"""
+
+    __slots__ = ("columns", "products", "starts", "versions")
+
+    def __init__(self, columns: dict, versions: dict):
+        order = np.lexsort((columns["id"], columns["product_id"]))
+        self.columns = {name: values[order] for name, values in columns.items()}
+        # the rows of products[i] are starts[i]:starts[i + 1]
+        self.products, starts = np.unique(self.columns["product_id"], return_index=True)
+        self.starts = np.append(starts, len(order))
+        self.versions = versions
+
+    def __len__(self):
+        return len(self.columns["id"])
+
+    @property
+    def nbytes(self) -> int:
+        """The memory held by the arrays"""
+        return (sum(values.nbytes for values in self.columns.values())
+                + self.products.nbytes + self.starts.nbytes)
+
+    def select(self, product_id: int = None, rec_product_id: int = None,
+               type: RecommendationType = None):
+        """Returns the positions of the rows matching a filter of find_rec_by_filter"""
+        if product_id is not None:
+            i = np.searchsorted(self.products, product_id)
+            if i == len(self.products) or self.products[i] != product_id:
+                return np.empty(0, dtype=np.intp)
+            index = np.arange(self.starts[i], self.starts[i + 1])
+        else:
+            index = np.arange(len(self))
+        if rec_product_id is not None:
+            index = index[self.columns["rec_product_id"][index] == rec_product_id]
+        if type is not None:
+            index = index[self.columns["type"][index] == type.value]
+        return index
+
+    def serialize(self, index) -> list:
+        """Serializes the rows at the given positions into dictionaries"""
+        values = [self.columns[name][index].tolist() for name, _ in COLUMNS]
+        return [
+            {
+                "id": id,
+                "product_id": product_id,
+                "rec_product_id": rec_product_id,
+                "type": TYPE_NAMES[type],
+                "interested": interested,
+            }
+            for id, product_id, rec_product_id, type, interested, _ in zip(*values)
+        ]
+
+
+class RecommendationSnapshot:
+    """Columnar copy of the recommendation table, refreshed in the background"""
+
+    def __init__(self, refresh_interval: float = 5.0):
+        self.app: Flask = None
+        self.refresh_interval = refresh_interval
+        self.chunk_size = 10000
+        self._data: SnapshotData = None
+        self._refresh_lock = threading.Lock()
+        self._refresher = BackgroundThread(
+            self.refresh, lambda: self.refresh_interval, "recommendation-snapshot-refresh",
+            error="Refreshing the recommendation snapshot failed, will retry", run_first=True)
+
+    def init_app(self, app: Flask):
+        """Configures the snapshot from the Flask app and serves its reads from it"""
+        self.app = app
+        self.refresh_interval = app.config["SNAPSHOT_REFRESH_INTERVAL"]
+        self.chunk_size = app.config["EXPORT_CHUNK_SIZE"]
+        self._data = None
+        app.extensions["recommendation_snapshot"] = self
+        atexit.register(self.stop)
+
+    def is_current(self, scope: str, version: int) -> bool:
+        """True if the snapshot holds the data of a DataVersion scope at version"""
+        self._refresher.ensure_started()
+        data = self._data
+        return data is not None and data.versions.get(scope, 0) == version
+
+    def find_page(self, limit: int, after: tuple = None, sort: str = None, product_id: int = None,
+                  rec_product_id: int = None, type: RecommendationType = None):
+        """Returns one page of a filter, as find_page(find_rec_by_filter(...))
+
+        :return: the serialized page, and the sort key of its last row or None
+                 if there are no more pages
+        :rtype: tuple
+
+        """
+        columns, descending = Recommendation.sort_order(sort)
+        data = self._data
+        index = data.select(product_id, rec_product_id, type)
+        keys = [data.columns[col.key][index] for col in columns]
+        if after is not None:
+            mask = np.zeros(len(index), dtype=bool)
+            equal = np.ones(len(index), dtype=bool)
+            for key, value in zip(keys, after):
+                mask |= equal & ((key < value) if descending else (key > value))
+                equal &= key == value
+            index, keys = index[mask], [key[mask] for key in keys]
+        if len(index) > limit + 1:
+            # only the rows up to the (limit + 1)th value of the first key can
+            # make the page, which spares sorting all of a long list
+            first = -keys[0].astype(np.float64) if descending else keys[0]
+            kth = np.partition(first, limit)[limit]
+            mask = first <= kth
+            index, keys = index[mask], [key[mask] for key in keys]
+        order = np.lexsort(keys[::-1])
+        if descending:
+            order = order[::-1]
+        page = data.serialize(index[order[:limit]])
+        if len(order) <= limit:
+            return page, None
+        return page, tuple(key[order[limit - 1]].item() for key in keys)
+
+    def refresh(self) -> int:
+        """Brings the snapshot up to date with the database
+
+        :return: the number of rows read from the database
+        :rtype: int
+
+        """
+        with self._refresh_lock:
+            start = time.perf_counter()
+            old = self._data
+            # straight from the engine of the primary, the session of the
+            # thread is left alone
+            with db.get_engine(self.app).connect() as conn:
+                # versions first: rows read after them are at least as new
+                versions = DataVersion.add_up(dict(
+                    conn.execute(db.select([DataVersion.scope, DataVersion.version])).fetchall()))
+                changed = self._changed_products(old, versions)
+                if changed is None:
+                    columns = self._read(conn, self._statement())
+                    self._data = SnapshotData(columns, versions)
+                elif changed or versions != old.versions:
+                    columns = self._read_products(conn, changed)
+                    keep = ~np.isin(old.columns["product_id"], changed)
+                    self._data = SnapshotData(
+                        {name: np.concatenate([old.columns[name][keep], columns[name]])
+                         for name, _ in COLUMNS},
+                        versions,
+                    )
+                else:
+                    return 0
+        rows = len(columns["id"])
+        logger.info("Snapshot read %d rows of %s products in %.1f ms, holds %d rows in %d bytes",
+                    rows, "all" if changed is None else len(changed),
+                    (time.perf_counter() - start) * 1000, len(self._data), self._data.nbytes)
+        return rows
+
+    def stats(self) -> dict:
+        """Returns the number of rows and products held and the memory they take"""
+        data = self._data
+        if data is None:
+            return {"rows": 0, "products": 0, "bytes": 0}
+        return {"rows": len(data), "products": len(data.products), "bytes": data.nbytes}
+
+    def stop(self):
+        """Stops the background refreshes"""
+        self._refresher.stop()
+
+    @staticmethod
+    def _changed_products(old: SnapshotData, versions: dict):
+        """Returns the products whose version changed, None if it takes a full reload"""
+        if old is None or not len(old):
+            return None
+        if any(scope not in versions for scope in old.versions):
+            return None  # the versions were reset, e.g. the tables were recreated
+        changed = [int(scope[len(PRODUCT_SCOPE_PREFIX):]) for scope, version in versions.items()
+                   if scope.startswith(PRODUCT_SCOPE_PREFIX) and old.versions.get(scope) != version]
+        if len(changed) > FULL_RELOAD_FRACTION * len(old.products):
+            return None
+        return changed
+
+    @staticmethod
+    def _statement():
+        table = Recommendation.__table__
+        return db.select([table.c[name] for name, _ in COLUMNS])
+
+    def _read_products(self, conn, product_ids: list) -> dict:
+        """Reads the rows of the given products"""
+        parts = []
+        for start in range(0, len(product_ids), RELOAD_CHUNK_SIZE):
+            chunk = product_ids[start:start + RELOAD_CHUNK_SIZE]
+            parts.append(self._read(conn, self._statement().where(
+                Recommendation.product_id.in_(chunk))))
+        return {name: np.concatenate([part[name] for part in parts] or [np.empty(0, dtype)])
+                for name, dtype in COLUMNS}
+
+    def _read(self, conn, statement) -> dict:
+        """Reads the rows of a statement into arrays, chunk_size rows at a time"""
+        parts = {name: [] for name, _ in COLUMNS}
+        result = conn.execution_options(stream_results=True).execute(statement)
+        while True:
+            rows = result.fetchmany(self.chunk_size)
+            if not rows:
+                break
+            ids, product_ids, rec_product_ids, types, interested, trending = zip(*rows)
+            values = (ids, product_ids, rec_product_ids, [type.value for type in types], interested, trending)
+            for (name, dtype), column in zip(COLUMNS, values):
+                parts[name].append(np.array(column, dtype=dtype))
+        return {name: np.concatenate(parts[name] or [np.empty(0, dtype)]) for name, dtype in COLUMNS}
@@ -0,0 +1,235 @@
+"""
+Bulk import and export of the recommendations
+
+Streams CSV (with a header) or newline delimited JSON files of any size in
+and out of the recommendation table, batch_size rows at a time, so memory use
+does not depend on the size of the file. Every row is validated by
+Recommendation.validate, like a POST of the REST API, and the first
+invalid row aborts the whole import. On PostgreSQL each batch is loaded with
+COPY; other databases get a batched (executemany) INSERT. The whole import is
+one transaction, optionally with the secondary indexes dropped during the
+load and rebuilt once at the end, which is much cheaper than maintaining
+them row by row.
+
+Exports are read through a server-side cursor by Recommendation.stream().
+
+Run with:
+    FLASK_APP=service:app flask recs import recommendations.csv --drop-indexes
+    FLASK_APP=service:app flask recs export recommendations.ndjson
+"""
+import csv
+import io
+import logging
+
+import orjson
+
+from service.cache import recommendation_cache
+from service.models import DataValidationError, DataVersion, Recommendation, db
+
+logger = logging.getLogger("flask.app")
+
+# the columns of a CSV export, and of the file a COPY reads
+COLUMNS = ("id", "product_id", "rec_product_id", "type", "interested")
+
+# the integer columns of a CSV file, converted before validation
+INTEGER_COLUMNS = ("id", "product_id", "rec_product_id", "interested")
+
+
+def guess_format(path: str, file_format: str = None) -> str:
+    """Returns the format of a file, "ndjson" for .ndjson and .jsonl names, "csv" otherwise"""
+    if file_format:
+        return file_format
+    return "ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv"
+
+
+def read_rows(lines, file_format: str):
+    """Yields the line number and the dictionary of each row of a file
+
+    The values of a CSV file are strings; those of the integer columns are
+    converted when they are integers, the others are left for validation to
+    reject.
+
+    :param lines: the open file
+    :param file_format: "csv" or "ndjson"
+
+    """
+    if file_format == "ndjson":
+        for line, text in enumerate(lines, start=1):
+            if not text.strip():
+                continue
+            try:
+                yield line, orjson.loads(text)
+            except ValueError as error:
+                raise DataValidationError("Invalid JSON: {}".format(error)) from error
+        return
+    if file_format != "csv":
+        raise DataValidationError("Unsupported file format: " + file_format)
+    for line, row in enumerate(csv.DictReader(lines), start=2):
+        for column in INTEGER_COLUMNS:
+            value = row.get(column)
+            if value is None:
+                continue
+            try:
+                row[column] = int(value)
+            except ValueError:
+                pass  # left for validation to reject
+        yield line, row
+
+
+def validate_row(data, keep_ids: bool = False) -> dict:
+    """Validates a row like the body of a POST and returns the values to insert
+
+    :param data: the row as it was read from the file
+    :param keep_ids: whether the row must have an id, which is kept
+
+    :return: the column values of the row
+    :rtype: dict
+
+    """
+    # the rules of deserialize, without setting the instrumented attributes
+    # of a Recommendation, which would cost more than the load
+    row = Recommendation.validate(data)
+    if keep_ids:
+        if not isinstance(data.get("id"), int) or data["id"] < 1:
+            raise DataValidationError("Invalid Recommendation ID: {}".format(data.get("id")))
+        row["id"] = data["id"]
+    return row
+
+
+def import_rows(lines, file_format: str, batch_size: int = 10000, keep_ids: bool = False,
+                drop_indexes: bool = False, replace: bool = False, dry_run: bool = False,
+                progress=None) -> int:
+    """Validates the rows of a file and inserts them in one transaction
+
+    :param lines: the open file
+    :param file_format: "csv" or "ndjson"
+    :param batch_size: the number of rows validated and loaded at a time
+    :param keep_ids: whether to insert the ids of the file rather than new ones
+    :param drop_indexes: whether to drop the secondary indexes during the load
+    :param replace: whether to delete all the Recommendations first
+    :param dry_run: whether to only validate the file
+    :param progress: called with the number of rows done after each batch
+
+    :return: the number of rows imported (or validated)
+    :rtype: int
+
+    :raises DataValidationError: naming the line of the first invalid row
+
+    """
+    columns = COLUMNS[0 if keep_ids else 1:]
+    table = Recommendation.__table__
+    product_ids = set()
+    count = 0
+    try:
+        connection = None if dry_run else db.session.connection()
+        if connection is not None and replace:
+            Recommendation.remove_all()
+        if connection is not None and drop_indexes:
+            for index in table.indexes:
+                index.drop(bind=connection)
+        batch = []
+        for line, data in read_rows(lines, file_format):
+            try:
+                batch.append(validate_row(data, keep_ids))
+            except DataValidationError as error:
+                raise DataValidationError("line {}: {}".format(line, error)) from error
+            if len(batch) == batch_size:
+                count += _load(connection, columns, batch, product_ids)
+                batch = []
+                if progress is not None:
+                    progress(count)
+        if batch:
+            count += _load(connection, columns, batch, product_ids)
+            if progress is not None:
+                progress(count)
+        if connection is None:
+            return count
+        if drop_indexes:
+            for index in table.indexes:
+                logger.info("Rebuilding index %s", index.name)
+                index.create(bind=connection)
+        if keep_ids and connection.dialect.name == "postgresql":
+            # new Recommendations must not be given the ids that were imported
+            connection.execute("SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                               "coalesce((SELECT max(id) FROM {0}), 0) + 1, false)".format(table.name))
+        DataVersion.bump(product_ids)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        if drop_indexes and not dry_run:
+            # SQLite drops indexes outside of the transaction
+            Recommendation.upgrade_db()
+        raise
+    recommendation_cache.clear()
+    return count
+
+
+def _load(connection, columns: tuple, batch: list, product_ids: set) -> int:
+    """Inserts a batch of validated rows, with COPY on PostgreSQL"""
+    product_ids.update(row["product_id"] for row in batch)
+    if connection is None:
+        return len(batch)
+    if connection.dialect.name != "postgresql":
+        connection.execute(Recommendation.__table__.insert(), batch)
+        return len(batch)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for row in batch:
+        writer.writerow([row[column].name if column == "type" else row[column] for column in columns])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+            Recommendation.__tablename__, ", ".join(columns)), buffer)
+    finally:
+        cursor.close()
+    return len(batch)
+
+
+def export_rows(output, file_format: str, product_id: int = None, rec_product_id: int = None,
+                type: str = None, chunk_size: int = 10000, progress=None) -> int:
+    """Writes the Recommendations matching a filter to a file in id order
+
+    :param output: the open file, in binary mode
+    :param file_format: "csv" or "ndjson"
+    :param chunk_size: the number of rows fetched from the database and written at a time
+    :param progress: called with the number of rows done after each chunk
+
+    :return: the number of rows written
+    :rtype: int
+
+    """
+    if file_format not in ("csv", "ndjson"):
+        raise DataValidationError("Unsupported file format: " + file_format)
+    rows = Recommendation.stream(product_id, rec_product_id, type, chunk_size=chunk_size)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if file_format == "csv":
+        writer.writerow(COLUMNS)
+    lines = []
+    count = 0
+    for row in rows:
+        if file_format == "csv":
+            writer.writerow([row[column] for column in COLUMNS])
+        else:
+            lines.append(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE))
+        count += 1
+        if count % chunk_size == 0:
+            lines = _flush(output, buffer, lines)
+            if progress is not None:
+                progress(count)
+    _flush(output, buffer, lines)
+    if progress is not None and count % chunk_size:
+        progress(count)
+    return count
+
+
+def _flush(output, buffer: io.StringIO, lines: list) -> list:
+    """Writes the pending CSV or JSON lines to the output and returns a new list of lines"""
+    if buffer.tell():
+        output.write(buffer.getvalue().encode())
+        buffer.seek(0)
+        buffer.truncate()
+    if lines:
+        output.write(b"".join(lines))
+    return []
@@ -0,0 +1,77 @@
+"""
+Test cases for the per-process background threads
+Test cases can be run with:
+    nosetests
+    coverage report -m
+While debugging just these tests it's convinient to use this:
+    nosetests --stop tests/test_background.py:TestBackgroundThread
+"""
+import threading
+import unittest
+from unittest import mock
+from service.background import BackgroundThread
+
+
+######################################################################
+#  B A C K G R O U N D   T H R E A D   T E S T   C A S E S
+######################################################################
+class TestBackgroundThread(unittest.TestCase):
+    """Test Cases for the BackgroundThread"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.called = threading.Event()
+        self.thread = None
+
+    def tearDown(self):
+        """This runs after each test"""
+        if self.thread is not None:
+            self.thread.stop()
+
+    def _start(self, interval=3600, target=None, **kwargs):
+        """Starts a BackgroundThread calling target, or setting self.called"""
+        self.thread = BackgroundThread(target or self.called.set, lambda: interval, "test", **kwargs)
+        self.thread.ensure_started()
+        return self.thread
+
+    def test_started_once_per_process(self):
+        """Start one thread per process"""
+        thread = self._start()
+        first = thread._thread
+        thread.ensure_started()
+        self.assertIs(thread._thread, first)
+        with mock.patch("service.background.os.getpid", return_value=-1):
+            thread.ensure_started()  # as in a forked worker
+        self.assertIsNot(thread._thread, first)
+        thread.stop()
+        self.assertFalse(first.is_alive())
+        self.assertIsNone(thread._thread)
+
+    def test_no_interval_no_thread(self):
+        """Leave the work to the caller when the interval is 0"""
+        self.assertIsNone(self._start(interval=0)._thread)
+
+    def test_runs_every_interval(self):
+        """Call the target after each interval"""
+        self._start(interval=0.01)
+        self.assertTrue(self.called.wait(5))
+
+    def test_run_first(self):
+        """Call the target before the first interval"""
+        self._start(run_first=True)
+        self.assertTrue(self.called.wait(5))
+
+    def test_errors_are_retried(self):
+        """Log an error of the target and call it again"""
+        calls = []
+
+        def target():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError("failed")
+            self.called.set()
+
+        with mock.patch("service.background.logger") as logger:
+            self._start(interval=0.01, target=target, error="Testing failed")
+            self.assertTrue(self.called.wait(5))
+        logger.exception.assert_called_once_with("Testing failed")
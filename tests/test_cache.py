@@ -0,0 +1,107 @@
+"""
+Test cases for the Recommendation list cache
+Test cases can be run with:
+    nosetests
+    coverage report -m
+While debugging just these tests it's convinient to use this:
+    nosetests --stop tests/test_cache.py:TestRecommendationCache
+"""
+import unittest
+from unittest import mock
+from service.cache import RecommendationCache
+
+
+######################################################################
+#  R E C O M M E N D A T I O N   C A C H E   T E S T   C A S E S
+######################################################################
+class TestRecommendationCache(unittest.TestCase):
+    """Test Cases for the RecommendationCache"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.cache = RecommendationCache(max_size=2, ttl=10)
+
+    def _store(self, key, value, version=1):
+        """Stores a value the way a read-through caller would"""
+        self.cache.get(key, version)
+        self.cache.set(key, value, version)
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+
+    def test_key(self):
+        """Build cache keys from request arguments"""
+        self.assertEqual(RecommendationCache.key("1"), (1, None, None))
+        self.assertEqual(RecommendationCache.key(None, "2", "UpSell"), (None, 2, "UpSell"))
+        self.assertEqual(RecommendationCache.key("1", "", ""), (1, None, None))
+        self.assertIsNone(RecommendationCache.key())
+        self.assertIsNone(RecommendationCache.key(type="UpSell"))
+        self.assertIsNone(RecommendationCache.key("one"))
+
+    def test_hit_and_miss(self):
+        """Count hits and misses"""
+        key = (1, None, None)
+        self.assertIsNone(self.cache.get(key, 1))
+        self._store(key, ["a"])
+        self.assertEqual(self.cache.get(key, 1), ["a"])
+        self.assertEqual(self.cache.stats(), {"size": 1, "hits": 1, "misses": 2, "evictions": 0})
+
+    def test_lru_eviction(self):
+        """Evict the least recently used list"""
+        self._store((1, None, None), ["a"])
+        self._store((2, None, None), ["b"])
+        self.cache.get((1, None, None), 1)
+        self._store((3, None, None), ["c"])
+        self.assertIsNone(self.cache.get((2, None, None), 1))
+        self.assertEqual(self.cache.get((1, None, None), 1), ["a"])
+        self.assertEqual(self.cache.get((3, None, None), 1), ["c"])
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_ttl(self):
+        """Expire lists after the TTL"""
+        with mock.patch("service.cache.time.monotonic", return_value=100.0):
+            self._store((1, None, None), ["a"])
+        with mock.patch("service.cache.time.monotonic", return_value=109.0):
+            self.assertEqual(self.cache.get((1, None, None), 1), ["a"])
+        with mock.patch("service.cache.time.monotonic", return_value=111.0):
+            self.assertIsNone(self.cache.get((1, None, None), 1))
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_invalidate_matching_filters(self):
+        """Invalidate only the lists whose filter matches a written row"""
+        self.cache.max_size = 10
+        for key in [(1, None, None), (1, None, "UpSell"), (1, 5, None), (None, 5, "UpSell"),
+                    (1, None, "Generic"), (2, None, None), (None, 6, None)]:
+            self._store(key, [key])
+        self.cache.invalidate((1,), (5,), ("UpSell",))
+        for key in [(1, None, None), (1, None, "UpSell"), (1, 5, None), (None, 5, "UpSell")]:
+            self.assertIsNone(self.cache.get(key, 1), key)
+        for key in [(1, None, "Generic"), (2, None, None), (None, 6, None)]:
+            self.assertEqual(self.cache.get(key, 1), [key])
+
+    def test_invalidate_before_and_after(self):
+        """Invalidate the lists of both the old and new values of a row"""
+        self._store((1, None, None), ["a"])
+        self._store((2, None, None), ["b"])
+        self.cache.invalidate((1, 2), (5,), ("UpSell",))
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_other_version_is_missed(self):
+        """Serve a list only to the requests that read the version it was read at"""
+        key = (1, None, None)
+        self._store(key, ["a"], version=5)
+        # a write by another worker, which this cache never heard of
+        self.assertIsNone(self.cache.get(key, 6))
+        self.assertIsNone(self.cache.get(key, 5))
+        self._store(key, ["b"], version=6)
+        # a lagging replica does not drop the newer list
+        self.assertIsNone(self.cache.get(key, 5))
+        self.assertEqual(self.cache.get(key, 6), ["b"])
+
+    def test_disabled(self):
+        """Keep nothing when the size is 0"""
+        self.cache.max_size = 0
+        self.assertFalse(self.cache.enabled)
+        self._store((1, None, None), ["a"])
+        self.assertIsNone(self.cache.get((1, None, None), 1))
@@ -8,10 +8,14 @@ While debugging just these tests it's convinient to use this:
 """
 import os
 import logging
+import math
 from types import resolve_bases
 import unittest
+from unittest import mock
 from werkzeug.exceptions import NotFound
-from service.models import Recommendation, RecommendationType, DataValidationError, db
+from service.models import (
+    TRENDING_EPOCH, Recommendation, RecommendationType, DataVersion, DataValidationError, db
+)
 from service import app
 from .factories import RecommendationFactory
 
@@ -85,6 +89,162 @@ class TestRecommendationModel(unittest.TestCase):
         recs = Recommendation.all()
         self.assertEqual(len(recs), 1)
 
+    def test_create_many_recommendations(self):
+        """Create many Recommendations in one transaction"""
+        recs = RecommendationFactory.create_batch(5)
+        Recommendation.create_many(recs, chunk_size=2)
+        self.assertEqual([rec.id for rec in recs], [1, 2, 3, 4, 5])
+        found = Recommendation.all()
+        self.assertEqual(len(found), 5)
+        for rec in recs:
+            stored = Recommendation.find(rec.id)
+            self.assertEqual(stored.product_id, rec.product_id)
+            self.assertEqual(stored.rec_product_id, rec.rec_product_id)
+            self.assertEqual(stored.type, rec.type)
+
+    def test_create_many_no_recommendations(self):
+        """Create an empty batch of Recommendations"""
+        Recommendation.create_many([])
+        self.assertEqual(Recommendation.all(), [])
+
+    def test_increment_interested(self):
+        """Increment the interested counters of Recommendations"""
+        recs = RecommendationFactory.create_batch(3)
+        Recommendation.create_many(recs)
+        rows = Recommendation.increment_interested({recs[0].id: 1, recs[2].id: 5, 99: 1})
+        self.assertEqual(sorted((row.id, row.interested) for row in rows),
+                         [(recs[0].id, 1), (recs[2].id, 5)])
+        db.session.expire_all()
+        self.assertEqual(Recommendation.find(recs[0].id).interested, 1)
+        self.assertEqual(Recommendation.find(recs[1].id).interested, 0)
+        self.assertEqual(Recommendation.find(recs[2].id).interested, 5)
+        self.assertEqual(Recommendation.increment_interested({}), [])
+
+    def test_delete_many(self):
+        """Delete many Recommendations in one transaction"""
+        recs = RecommendationFactory.create_batch(5)
+        Recommendation.create_many(recs)
+        version = DataVersion.get(DataVersion.product_scope(recs[0].product_id))
+        with mock.patch("service.models.WRITE_CHUNK_SIZE", 2):
+            self.assertEqual(Recommendation.delete_many([rec.id for rec in recs[:3]] + [99]), 3)
+        self.assertEqual(sorted(rec.id for rec in Recommendation.all()), sorted(rec.id for rec in recs[3:]))
+        self.assertEqual(DataVersion.get(DataVersion.product_scope(recs[0].product_id)), version + 1)
+        self.assertEqual(Recommendation.delete_many([]), 0)
+
+    def test_increment_interested_in_chunks(self):
+        """Increment more interested counters than fit in one UPDATE"""
+        recs = RecommendationFactory.create_batch(5)
+        Recommendation.create_many(recs)
+        counts = {rec.id: i + 1 for i, rec in enumerate(recs)}
+        with mock.patch("service.models.WRITE_CHUNK_SIZE", 2):
+            rows = Recommendation.increment_interested({**counts, 99: 1})
+        self.assertEqual(sorted((row.id, row.interested) for row in rows), sorted(counts.items()))
+
+    def test_increment_interested_trending(self):
+        """Decay the interested events of the trending score"""
+        recs = RecommendationFactory.create_batch(3)
+        Recommendation.create_many(recs)
+        day = 24 * 3600
+        start = TRENDING_EPOCH + 365 * day
+        with mock.patch.dict(app.config, {"TRENDING_HALF_LIFE": day}):
+            with mock.patch("service.models.time.time", return_value=start):
+                Recommendation.increment_interested({recs[0].id: 8})
+            with mock.patch("service.models.time.time", return_value=start + 2 * day):
+                rows = Recommendation.increment_interested({recs[1].id: 3, recs[2].id: 1})
+                Recommendation.increment_interested({recs[2].id: 1})
+            offset = Recommendation.trending_offset(start + 2 * day)
+        trending = {row.id: row.trending for row in rows}
+        db.session.expire_all()
+        stored = {rec.id: rec.trending for rec in Recommendation.all()}
+        # 8 clicks two half-lives ago weigh as much as 2 now
+        self.assertAlmostEqual(stored[recs[0].id], offset + math.log(2))
+        self.assertAlmostEqual(stored[recs[1].id], offset + math.log(3))
+        self.assertAlmostEqual(stored[recs[2].id], offset + math.log(2))
+        self.assertEqual(trending[recs[1].id], stored[recs[1].id])
+        query = Recommendation.find_rec_by_filter()
+        page, _ = Recommendation.find_page(query, 3, sort="trending")
+        self.assertEqual(page[0].id, recs[1].id)
+        self.assertEqual(page[0].interested, 3)
+        self.assertEqual(page[1].interested + page[2].interested, 10)
+
+    def test_increment_interested_trending_short_half_life(self):
+        """Add far apart trending scores on PostgreSQL, whose exp() underflows"""
+        if db.session.get_bind().dialect.name != "postgresql":
+            self.skipTest("exp() only raises on underflow on PostgreSQL")
+        rec = RecommendationFactory()
+        rec.create()
+        with mock.patch.dict(app.config, {"TRENDING_HALF_LIFE": 60}):
+            with mock.patch("service.models.time.time", return_value=TRENDING_EPOCH + 365 * 24 * 3600):
+                rows = Recommendation.increment_interested({rec.id: 1})
+                offset = Recommendation.trending_offset()
+        self.assertGreater(offset, 100000)
+        self.assertEqual(rows[0].interested, 1)
+        self.assertAlmostEqual(rows[0].trending, offset)
+
+    def test_increment_interested_trending_in_chunks(self):
+        """Update the trending scores the same way in one UPDATE or many"""
+        recs = RecommendationFactory.create_batch(5)
+        Recommendation.create_many(recs)
+        counts = {rec.id: i + 1 for i, rec in enumerate(recs)}
+        with mock.patch("service.models.time.time", return_value=TRENDING_EPOCH + 1000):
+            with mock.patch("service.models.WRITE_CHUNK_SIZE", 2):
+                rows = Recommendation.increment_interested(counts)
+            offset = Recommendation.trending_offset()
+        for row in rows:
+            self.assertAlmostEqual(row.trending, math.log(1 + counts[row.id] * math.exp(offset)))
+
+    def test_writes_bump_data_versions(self):
+        """Bump the product versions, and so the table version, on every write"""
+        product_scope = DataVersion.product_scope(1)
+        self.assertEqual(DataVersion.get(product_scope), 0)
+        rec = Recommendation(product_id=1, rec_product_id=2, type=RecommendationType.Generic)
+        rec.create()
+        self.assertEqual(DataVersion.get(product_scope), 1)
+        self.assertEqual(DataVersion.get(DataVersion.TABLE_SCOPE), 1)
+
+        rec.product_id = 3
+        rec.update()
+        self.assertEqual(DataVersion.get(product_scope), 2)
+        self.assertEqual(DataVersion.get(DataVersion.product_scope(3)), 1)
+
+        Recommendation.increment_interested({rec.id: 1})
+        self.assertEqual(DataVersion.get(product_scope), 2)
+        self.assertEqual(DataVersion.get(DataVersion.product_scope(3)), 2)
+        self.assertEqual(DataVersion.get(DataVersion.interest_scope(3)), 1)
+
+        Recommendation.create_many([Recommendation(product_id=1, rec_product_id=2,
+                                                   type=RecommendationType.Generic)])
+        self.assertEqual(DataVersion.get(product_scope), 3)
+
+        Recommendation.find(rec.id).delete()
+        self.assertEqual(DataVersion.get(DataVersion.product_scope(3)), 3)
+        self.assertEqual(DataVersion.get(DataVersion.TABLE_SCOPE), 6)
+        self.assertEqual(DataVersion.get_many([product_scope, DataVersion.product_scope(3)]),
+                         {product_scope: 3, DataVersion.product_scope(3): 3})
+        # no row is written by every writer
+        self.assertEqual(DataVersion.query.filter_by(scope=DataVersion.TABLE_SCOPE).count(), 0)
+
+    def test_table_version_is_sharded(self):
+        """Bump one shard of the table version per product"""
+        DataVersion.bump(range(40))
+        self.assertEqual(DataVersion.get(DataVersion.TABLE_SCOPE), DataVersion.TABLE_SHARDS)
+        DataVersion.bump([1], interest=True)
+        self.assertEqual(DataVersion.get(DataVersion.TABLE_SCOPE), DataVersion.TABLE_SHARDS + 1)
+        self.assertEqual(DataVersion.add_up({scope: version for scope, version in
+                                             db.session.query(DataVersion.scope, DataVersion.version)}),
+                         {DataVersion.TABLE_SCOPE: DataVersion.TABLE_SHARDS + 1,
+                          **{DataVersion.product_scope(id): 1 + (id == 1) for id in range(40)}})
+
+    def test_upgrade_db_starts_table_version(self):
+        """Start the table version of an unsharded data_version from its sum"""
+        db.session.add_all([DataVersion(scope=DataVersion.product_scope(1), version=5),
+                            DataVersion(scope=DataVersion.interest_scope(1), version=2)])
+        db.session.commit()
+        DataVersion.upgrade_db()
+        self.assertEqual(DataVersion.get(DataVersion.TABLE_SCOPE), 7)
+        DataVersion.upgrade_db()
+        self.assertEqual(DataVersion.get(DataVersion.TABLE_SCOPE), 7)
+
     def test_update_a_recommendation(self):
         """Update a Recommendation"""
         rec = RecommendationFactory()
@@ -105,6 +265,17 @@ class TestRecommendationModel(unittest.TestCase):
         self.assertEqual(recs[0].id, 1)
         self.assertEqual(recs[0].rec_product_id, 201)
 
+    def test_update_invalidates_old_and_new_product(self):
+        """Invalidate the cached lists of the old and new product of a moved Recommendation"""
+        rec = RecommendationFactory()
+        old_product_id = rec.product_id
+        rec.create()  # the commit expires the attributes
+        rec.product_id = old_product_id + 1000
+        with mock.patch("service.models.recommendation_cache") as cache:
+            rec.update()
+        product_ids = cache.invalidate.call_args[0][0]
+        self.assertEqual(product_ids, {old_product_id, old_product_id + 1000})
+
     def test_bad_update(self):
         """Test error on invalid update"""
         rec = RecommendationFactory()
@@ -209,6 +380,18 @@ class TestRecommendationModel(unittest.TestCase):
         rec = Recommendation()
         self.assertRaises(DataValidationError, rec.deserialize, data)
 
+    def test_validate(self):
+        """Validate a Recommendation dictionary without a Recommendation"""
+        data = RecommendationFactory().serialize()
+        self.assertEqual(Recommendation.validate(data), {
+            "product_id": data["product_id"],
+            "rec_product_id": data["rec_product_id"],
+            "interested": data["interested"],
+            "type": RecommendationType[data["type"]],
+        })
+        data["interested"] = "1234"  # wrong datatype
+        self.assertRaises(DataValidationError, Recommendation.validate, data)
+
     def test_find_rec(self):
         """Find a Recommendation by ID"""
         recs = RecommendationFactory.create_batch(3)
@@ -320,3 +503,196 @@ class TestRecommendationModel(unittest.TestCase):
         recs = [rec for rec in res]
         self.assertEqual(recs[0].rec_product_id, 3)
         self.assertEqual(recs[0].type, RecommendationType.UpSell)
+
+    def test_find_page(self):
+        """Page through Recommendations by id"""
+        for rec in RecommendationFactory.create_batch(5):
+            rec.create()
+        query = Recommendation.find_rec_by_filter()
+        page, last_key = Recommendation.find_page(query, 2)
+        self.assertEqual([rec.id for rec in page], [1, 2])
+        self.assertEqual(last_key, (2,))
+        page, last_key = Recommendation.find_page(query, 2, after=last_key)
+        self.assertEqual([rec.id for rec in page], [3, 4])
+        page, last_key = Recommendation.find_page(query, 2, after=last_key)
+        self.assertEqual([rec.id for rec in page], [5])
+        self.assertIsNone(last_key)
+
+    def test_find_page_sorted_by_interested(self):
+        """Page through Recommendations by interested count"""
+        for interested in [3, 7, 3, 0, 7]:
+            Recommendation(product_id=1, rec_product_id=2, interested=interested,
+                           type=RecommendationType.Generic).create()
+        query = Recommendation.find_rec_by_filter(product_id=1)
+        ids = []
+        last_key = None
+        while True:
+            page, last_key = Recommendation.find_page(query, 2, last_key, "interested")
+            ids.extend(rec.id for rec in page)
+            if last_key is None:
+                break
+        self.assertEqual(ids, [5, 2, 3, 1, 4])
+
+    def test_paginate_rows(self):
+        """Page through a list of serialized Recommendations"""
+        rows = [{"id": id, "interested": interested}
+                for id, interested in [(1, 3), (2, 7), (3, 3), (4, 0), (5, 7)]]
+        page, last_key = Recommendation.paginate_rows(rows, 2, sort="interested")
+        self.assertEqual([row["id"] for row in page], [5, 2])
+        page, last_key = Recommendation.paginate_rows(rows, 2, last_key, "interested")
+        self.assertEqual([row["id"] for row in page], [3, 1])
+        page, last_key = Recommendation.paginate_rows(rows, 2, last_key, "interested")
+        self.assertEqual([row["id"] for row in page], [4])
+        self.assertIsNone(last_key)
+        page, last_key = Recommendation.paginate_rows(rows, 4, (2,))
+        self.assertEqual([row["id"] for row in page], [3, 4, 5])
+        self.assertIsNone(last_key)
+
+    def test_find_page_bad_sort(self):
+        """Page through Recommendations with an unknown sort order"""
+        query = Recommendation.find_rec_by_filter()
+        self.assertRaises(DataValidationError, Recommendation.find_page, query, 2, None, "name")
+
+    def test_cursor_round_trip(self):
+        """Encode and decode a pagination cursor"""
+        cursor = Recommendation.encode_cursor((7, 42))
+        self.assertEqual(Recommendation.decode_cursor(cursor, "interested"), (7, 42))
+
+    def test_decode_bad_cursor(self):
+        """Decode cursors that are not valid"""
+        self.assertRaises(DataValidationError, Recommendation.decode_cursor, "not a cursor")
+        cursor = Recommendation.encode_cursor((7, 42))
+        self.assertRaises(DataValidationError, Recommendation.decode_cursor, cursor, "id")
+        cursor = Recommendation.encode_cursor(("7",))
+        self.assertRaises(DataValidationError, Recommendation.decode_cursor, cursor)
+
+    ######################################################################
+    #  Q U E R Y   P L A N   T E S T   C A S E S
+    ######################################################################
+
+    def _explain(self, query):
+        """Returns the query plan of a query or Core statement as a single string"""
+        engine = db.session.get_bind()
+        sql = str(getattr(query, "statement", query).compile(
+            dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+        if engine.dialect.name == "sqlite":
+            rows = db.session.execute("EXPLAIN QUERY PLAN " + sql)
+            return "\n".join(str(row[-1]) for row in rows)
+        # the planner prefers a sequential scan over an index on a table
+        # this small, so rule it out to see which index would be used
+        db.session.execute("SET LOCAL enable_seqscan = off")
+        rows = db.session.execute("EXPLAIN " + sql)
+        return "\n".join(str(row[0]) for row in rows)
+
+    def test_table_version_reads_its_shards(self):
+        """Read the version of the whole table from its shards alone"""
+        plan = self._explain(DataVersion.get_statement(DataVersion.TABLE_SCOPE))
+        self.assertNotIn("SCAN data_version" if db.engine.dialect.name == "sqlite" else "Seq Scan", plan)
+
+    def test_indexes_created(self):
+        """Create the filter indexes with the table"""
+        indexes = {index["name"] for index in db.inspect(db.engine).get_indexes("recommendation")}
+        self.assertIn("ix_recommendation_product_id_type", indexes)
+        self.assertIn("ix_recommendation_rec_product_id_type", indexes)
+        self.assertIn("ix_recommendation_product_id_interested", indexes)
+
+    def test_upgrade_db_adds_missing_indexes(self):
+        """Add missing indexes to a table created without them"""
+        db.session.remove()
+        for index in Recommendation.__table__.indexes:
+            index.drop(bind=db.engine)
+        created = Recommendation.upgrade_db()
+        self.assertEqual(
+            sorted(created), sorted(index.name for index in Recommendation.__table__.indexes))
+        self.assertEqual(Recommendation.upgrade_db(), [])
+
+    def test_upgrade_db_adds_missing_columns(self):
+        """Add missing columns with their default to a table created without them"""
+        Recommendation(product_id=1, rec_product_id=2, type=RecommendationType.Generic).create()
+        db.session.remove()
+        for index in Recommendation.__table__.indexes:
+            index.drop(bind=db.engine)
+        db.engine.execute("ALTER TABLE recommendation DROP COLUMN trending")
+        created = Recommendation.upgrade_db()
+        self.assertEqual(created[0], "trending")
+        self.assertIn("ix_recommendation_product_id_trending", created)
+        self.assertEqual(Recommendation.all()[0].trending, 0)
+        self.assertEqual(Recommendation.upgrade_db(), [])
+
+    def test_filter_by_product_id_uses_index(self):
+        """Filter by Query Product ID with an index"""
+        plan = self._explain(Recommendation.find_rec_by_filter(product_id=1))
+        self.assertIn("ix_recommendation_product_id_", plan)
+
+    def test_filter_by_product_id_and_type_uses_index(self):
+        """Filter by Query Product ID and Type with an index"""
+        plan = self._explain(Recommendation.find_rec_by_filter(
+            product_id=1, type=RecommendationType.UpSell))
+        self.assertIn("ix_recommendation_product_id_type", plan)
+
+    def test_filter_by_rec_product_id_uses_index(self):
+        """Filter by Recommended Product ID with an index"""
+        plan = self._explain(Recommendation.find_rec_by_filter(rec_product_id=1))
+        self.assertIn("ix_recommendation_rec_product_id_type", plan)
+
+    def test_filter_by_rec_product_id_and_type_uses_index(self):
+        """Filter by Recommended Product ID and Type with an index"""
+        plan = self._explain(Recommendation.find_rec_by_filter(
+            rec_product_id=1, type=RecommendationType.UpSell))
+        self.assertIn("ix_recommendation_rec_product_id_type", plan)
+
+    def test_filter_by_both_product_ids_uses_index(self):
+        """Filter by Query and Recommended Product ID with an index"""
+        plan = self._explain(Recommendation.find_rec_by_filter(product_id=1, rec_product_id=2))
+        self.assertIn("ix_recommendation_", plan)
+
+    def test_ranked_product_query_uses_index(self):
+        """Rank the Recommendations of a product by interest with an index"""
+        query = Recommendation.find_rec_by_filter(product_id=1).order_by(
+            Recommendation.interested.desc())
+        plan = self._explain(query)
+        self.assertIn("ix_recommendation_product_id_interested", plan)
+        if db.engine.dialect.name == "sqlite":
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_ranked_page_uses_index_for_ties(self):
+        """Read a page of the most interested Recommendations, ties by id, from the index alone"""
+        for sort in ("interested", "trending"):
+            plan = self._explain(Recommendation.page_statement(10, sort=sort, product_id=1))
+            self.assertIn("ix_recommendation_product_id_" + sort, plan)
+            # no sort of the rows that tie on the score
+            self.assertNotIn("TEMP B-TREE" if db.engine.dialect.name == "sqlite" else "Sort", plan, sort)
+
+    def test_ranked_table_page_uses_index(self):
+        """Read a page of the most interested Recommendations of all products from an index"""
+        for after in (None, (5, 100)):
+            plan = self._explain(Recommendation.page_statement(10, after, sort="interested"))
+            self.assertIn("ix_recommendation_interested", plan)
+            self.assertNotIn("TEMP B-TREE" if db.engine.dialect.name == "sqlite" else "Sort", plan)
+
+    def test_trending_table_page_uses_index(self):
+        """Read a page of the trending Recommendations of all products from an index"""
+        for after in (None, (1.5, 100)):
+            plan = self._explain(Recommendation.page_statement(10, after, sort="trending"))
+            self.assertIn("ix_recommendation_trending", plan)
+            self.assertNotIn("TEMP B-TREE" if db.engine.dialect.name == "sqlite" else "Sort", plan)
+
+    def test_upgrade_db_rebuilds_changed_indexes(self):
+        """Rebuild an index declared with other columns than the existing one"""
+        db.session.remove()
+        db.engine.execute("DROP INDEX ix_recommendation_product_id_interested")
+        db.engine.execute("CREATE INDEX ix_recommendation_product_id_interested "
+                          "ON recommendation (product_id, interested DESC)")
+        self.assertEqual(Recommendation.upgrade_db(), ["ix_recommendation_product_id_interested"])
+        indexes = {index["name"]: index["column_names"]
+                   for index in db.inspect(db.engine).get_indexes("recommendation")}
+        self.assertEqual(indexes["ix_recommendation_product_id_interested"], ["product_id", "interested", "id"])
+        self.assertEqual(Recommendation.upgrade_db(), [])
+
+    def test_trending_product_query_uses_index(self):
+        """Rank the Recommendations of a product by trending score with an index"""
+        columns, _ = Recommendation.sort_order("trending")
+        query = Recommendation.find_rec_by_filter(product_id=1).order_by(
+            *[column.desc() for column in columns]).limit(10)
+        plan = self._explain(query)
+        self.assertIn("ix_recommendation_product_id_trending", plan)
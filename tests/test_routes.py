@@ -6,13 +6,22 @@ Test cases can be run with the following:
 """
 import os
 import logging
+import subprocess
+import sys
+import tempfile
 import unittest
 from unittest import mock
 
+import json
 from urllib.parse import quote_plus
 from service import status  # HTTP Status Codes
-from service.models import Recommendation, db, init_db, DataValidationError
-from service.routes import app
+from service.models import Recommendation, RecommendationType, db, init_db, DataValidationError
+from flask_restx import marshal
+from prometheus_client import Counter, values
+from service import app
+from service.routes import recommendation_model
+from service.counters import interested_counter
+from service.cache import recommendation_cache
 from .factories import RecommendationFactory
 
 # Disable all but ciritcal errors during normal test run
@@ -51,6 +60,7 @@ class TestYourResourceServer(unittest.TestCase):
         """Runs before each test"""
         db.drop_all()  # clean up the last tests
         db.create_all()  # create new tables
+        recommendation_cache.clear()
         self.app = app.test_client()
 
     def tearDown(self):
@@ -241,11 +251,78 @@ class TestYourResourceServer(unittest.TestCase):
         self.assertEqual(updated_recommendation["interested"], 1)
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_increment_interested_counter_coalesced(self):
+        """Increment of interested counter with write coalescing"""
+        test_recommendation = self._create_recommendations(1)[0]
+        url = '/recommendations/{}/interested'.format(test_recommendation.id)
+        app.config["INTERESTED_COALESCE"] = True
+        interested_counter.flush_interval = 3600  # only flush when asked to
+        try:
+            for expected in [1, 2]:
+                resp = self.app.put(url, content_type=CONTENT_TYPE_JSON)
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                self.assertEqual(resp.get_json()["interested"], expected)
+            resp = self.app.put('/recommendations/0/interested', content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        finally:
+            app.config["INTERESTED_COALESCE"] = False
+            interested_counter.flush_interval = app.config["INTERESTED_FLUSH_INTERVAL"]
+        self.assertEqual(Recommendation.find(test_recommendation.id).interested, 0)
+        interested_counter.flush()
+        resp = self.app.get('/recommendations/{}'.format(test_recommendation.id))
+        self.assertEqual(resp.get_json()["interested"], 2)
+
+    def test_increment_interested_in_bulk(self):
+        """Increment the interested counters of many Recommendations"""
+        recs = self._create_recommendations(3)
+        body = [recs[0].id, recs[0].id, {"id": recs[1].id, "count": 5}, recs[0].id, 9999, {"id": 9998}]
+        resp = self.app.put('/recommendations/interested', json=body)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"updated": 2, "not_found": [9998, 9999]})
+        interested = [self.app.get('/recommendations/{}'.format(rec.id)).get_json()["interested"]
+                      for rec in recs]
+        self.assertEqual(interested, [3, 5, 0])
+
+    def test_increment_interested_in_bulk_coalesced(self):
+        """Increment the interested counters of many Recommendations with write coalescing"""
+        recs = self._create_recommendations(2)
+        app.config["INTERESTED_COALESCE"] = True
+        interested_counter.flush_interval = 3600  # only flush when asked to
+        try:
+            resp = self.app.put('/recommendations/interested', json=[recs[0].id, recs[1].id, recs[1].id, 9999])
+        finally:
+            app.config["INTERESTED_COALESCE"] = False
+            interested_counter.flush_interval = app.config["INTERESTED_FLUSH_INTERVAL"]
+        self.assertEqual(resp.get_json(), {"updated": 2, "not_found": [9999]})
+        self.assertEqual(interested_counter.pending(recs[1].id), 2)
+        interested_counter.flush()
+        resp = self.app.get('/recommendations/{}'.format(recs[1].id))
+        self.assertEqual(resp.get_json()["interested"], 2)
+
+    def test_increment_interested_in_bulk_bad_data(self):
+        """Increment interested counters in bulk with bad data"""
+        for body in ({"id": 1}, ["1"], [True], [{"count": 2}], [{"id": 1, "count": 0}], [{"id": 1, "count": "2"}],
+                     [2 ** 31], [-2 ** 31 - 1], [{"id": 2 ** 63}], [{"id": 1, "count": 2 ** 31}],
+                     [{"id": 1, "count": app.config["INTERESTED_COUNT_MAX"] + 1}]):
+            resp = self.app.put('/recommendations/interested', json=body)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, body)
+        app.config["BATCH_SIZE_MAX"], batch_size_max = 2, app.config["BATCH_SIZE_MAX"]
+        try:
+            resp = self.app.put('/recommendations/interested', json=[1, 2, 3])
+        finally:
+            app.config["BATCH_SIZE_MAX"] = batch_size_max
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        resp = self.app.put('/recommendations/interested', data="[1]")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
     def test_increment_bad_interested(self):
         """ Increment interested with bad id """
         resp = self.app.put('/recommendations/1/interested',
                             content_type=CONTENT_TYPE_JSON)
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.put('/recommendations/one/interested',
+                            content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_query_recommendation_by_rec_product_id(self):
         """Query Recomendations by the rec_product_id"""
@@ -281,3 +358,446 @@ class TestYourResourceServer(unittest.TestCase):
                     content_type=CONTENT_TYPE_JSON
                 )
         self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    def test_get_recommendations_page(self):
+        """Page through the list of Recommendations"""
+        recs = self._create_recommendations(5)
+        resp = self.app.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([rec["id"] for rec in data], [recs[0].id, recs[1].id])
+        ids = [rec["id"] for rec in data]
+        while "Link" in resp.headers:
+            link = resp.headers["Link"]
+            self.assertTrue(link.endswith('>; rel="next"'))
+            resp = self.app.get(link[1:link.index(">")])
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            ids.extend(rec["id"] for rec in resp.get_json())
+        self.assertEqual(ids, [rec.id for rec in recs])
+
+    def test_get_recommendations_page_keeps_filters(self):
+        """Page through a filtered list of Recommendations"""
+        for rec_product_id in range(3):
+            Recommendation(product_id=1, rec_product_id=rec_product_id, type="Generic").create()
+        Recommendation(product_id=2, rec_product_id=1, type="Generic").create()
+        resp = self.app.get(BASE_URL, query_string="product_id=1&limit=2")
+        link = resp.headers["Link"]
+        self.assertIn("product_id=1", link)
+        resp = self.app.get(link[1:link.index(">")])
+        data = resp.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["product_id"], 1)
+        self.assertNotIn("Link", resp.headers)
+
+    def test_get_recommendations_sorted_by_interested(self):
+        """List Recommendations by interested count"""
+        for interested in [3, 7, 0]:
+            Recommendation(product_id=1, rec_product_id=2, interested=interested,
+                           type="Generic").create()
+        resp = self.app.get(BASE_URL, query_string="sort=interested")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([rec["interested"] for rec in data], [7, 3, 0])
+
+    def test_get_recommendations_sorted_by_trending(self):
+        """List Recommendations by trending score"""
+        ids = []
+        for _ in range(3):
+            rec = Recommendation(product_id=1, rec_product_id=2, type="Generic")
+            rec.create()
+            ids.append(rec.id)
+        resp = self.app.put(BASE_URL + "/interested", json=[{"id": ids[1], "count": 2}, ids[2]])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # by product_id the list could come from the cache, which must be skipped
+        for query_string in ("sort=trending&limit=2", "product_id=1&sort=trending&limit=2"):
+            resp = self.app.get(BASE_URL, query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = resp.get_json()
+            self.assertEqual([rec["id"] for rec in data], [ids[1], ids[2]])
+            self.assertNotIn("trending", data[0])  # only a sort key
+            link = resp.headers["Link"]
+            resp = self.app.get(link[1:link.index(">")])
+            self.assertEqual([rec["id"] for rec in resp.get_json()], [ids[0]])
+        self.assertNotIn("Link", resp.headers)
+
+    def test_get_recommendations_page_size_capped(self):
+        """List Recommendations with a page size over the maximum"""
+        self._create_recommendations(3)
+        app.config["PAGE_SIZE_MAX"], page_size_max = 2, app.config["PAGE_SIZE_MAX"]
+        try:
+            resp = self.app.get(BASE_URL, query_string="limit=1000")
+        finally:
+            app.config["PAGE_SIZE_MAX"] = page_size_max
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertIn("Link", resp.headers)
+
+    def test_get_recommendations_bad_page(self):
+        """List Recommendations with bad pagination parameters"""
+        for query_string in ["limit=0", "limit=ten", "cursor=bad", "sort=name"]:
+            resp = self.app.get(BASE_URL, query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query_string)
+
+    def test_bad_data_in_production(self):
+        """Answer 400 to bad data when exceptions do not propagate"""
+        app.config["PROPAGATE_EXCEPTIONS"] = False
+        try:
+            resp = self.app.get(BASE_URL, query_string="cursor=bad")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(resp.get_json()["message"], "Invalid cursor: bad")
+            resp = self.app.post(BASE_URL, json={"product_id": 1}, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        finally:
+            app.config["PROPAGATE_EXCEPTIONS"] = None
+
+    def test_export_recommendations(self):
+        """Export all Recommendations as NDJSON"""
+        recs = self._create_recommendations(5)
+        app.config["EXPORT_CHUNK_SIZE"], chunk_size = 2, app.config["EXPORT_CHUNK_SIZE"]
+        try:
+            resp = self.app.get(BASE_URL + "/export")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+            lines = resp.get_data(as_text=True).splitlines()
+        finally:
+            app.config["EXPORT_CHUNK_SIZE"] = chunk_size
+        self.assertEqual([json.loads(line) for line in lines], [
+            dict(rec.serialize(), interested=0) for rec in recs])
+
+    def test_export_recommendations_by_product_id(self):
+        """Export the Recommendations of a product as NDJSON"""
+        recs = self._create_recommendations(10)
+        test_product_id = recs[0].product_id
+        resp = self.app.get(BASE_URL + "/export", query_string="product_id={}".format(test_product_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(data), len([rec for rec in recs if rec.product_id == test_product_id]))
+        for rec in data:
+            self.assertEqual(rec["product_id"], test_product_id)
+
+    def test_export_no_recommendations(self):
+        """Export an empty table as NDJSON"""
+        resp = self.app.get(BASE_URL + "/export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data, b"")
+
+    def test_create_recommendation_batch(self):
+        """Create a batch of Recommendations"""
+        recs = [rec.serialize() for rec in RecommendationFactory.create_batch(3)]
+        resp = self.app.post(BASE_URL + "/batch", json=recs, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(len(data), 3)
+        for rec, result in zip(recs, data):
+            resp = self.app.get("{}/{}".format(BASE_URL, result["id"]))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            new_rec = resp.get_json()
+            self.assertEqual(new_rec["product_id"], rec["product_id"])
+            self.assertEqual(new_rec["rec_product_id"], rec["rec_product_id"])
+            self.assertEqual(new_rec["type"], rec["type"])
+
+    def test_create_recommendation_batch_with_errors(self):
+        """Create a batch of Recommendations with some bad items"""
+        good = RecommendationFactory().serialize()
+        bad = dict(good, type="no_such_type")
+        resp = self.app.post(BASE_URL + "/batch", json=[bad, good, {}],
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertIn("error", data[0])
+        self.assertEqual(data[1], {"id": 1})
+        self.assertIn("error", data[2])
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 1)
+
+    def test_create_recommendation_batch_all_bad(self):
+        """Create a batch of Recommendations with only bad items"""
+        resp = self.app.post(BASE_URL + "/batch", json=[{}, {"type": "Generic"}],
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_create_recommendation_batch_not_a_list(self):
+        """Create a batch of Recommendations from a single object"""
+        resp = self.app.post(BASE_URL + "/batch", json=RecommendationFactory().serialize(),
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_recommendation_batch_too_large(self):
+        """Create a batch of Recommendations over the size limit"""
+        recs = [rec.serialize() for rec in RecommendationFactory.create_batch(3)]
+        app.config["BATCH_SIZE_MAX"], batch_size_max = 2, app.config["BATCH_SIZE_MAX"]
+        try:
+            resp = self.app.post(BASE_URL + "/batch", json=recs, content_type=CONTENT_TYPE_JSON)
+        finally:
+            app.config["BATCH_SIZE_MAX"] = batch_size_max
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    def test_lookup_recommendations_batch(self):
+        """Look up the Recommendations of many products at once"""
+        recs = [Recommendation(product_id=product_id, rec_product_id=i, type=RecommendationType.Generic,
+                               interested=i) for product_id in (1, 2) for i in range(5)]
+        recs.append(Recommendation(product_id=3, rec_product_id=7, type=RecommendationType.UpSell))
+        Recommendation.create_many(recs)
+        resp = self.app.get(BASE_URL + "/batch", query_string="product_id=3,1,9&product_id=2&limit=3&sort=interested")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(list(data), ["3", "1", "9", "2"])
+        self.assertEqual([rec["rec_product_id"] for rec in data["1"]], [4, 3, 2])
+        self.assertEqual([rec["rec_product_id"] for rec in data["2"]], [4, 3, 2])
+        self.assertEqual(data["3"], [recs[-1].serialize()])
+        self.assertEqual(data["9"], [])
+        self.assertIn("ETag", resp.headers)
+
+        resp = self.app.get(BASE_URL + "/batch", query_string="product_id=1,3&type=UpSell")
+        self.assertEqual(resp.get_json(), {"1": [], "3": [recs[-1].serialize()]})
+        resp = self.app.get(BASE_URL + "/batch", query_string="product_id=1,2&rec_product_id=1")
+        self.assertEqual([rec["product_id"] for items in resp.get_json().values() for rec in items], [1, 2])
+
+    def test_lookup_recommendations_batch_not_modified(self):
+        """Look up many products with a current ETag, then after a write to one of them"""
+        Recommendation(product_id=1, rec_product_id=2, type=RecommendationType.Generic).create()
+        resp = self.app.get(BASE_URL + "/batch", query_string="product_id=1,2")
+        etag = resp.headers["ETag"]
+        resp = self.app.get(BASE_URL + "/batch", query_string="product_id=1,2", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        Recommendation(product_id=2, rec_product_id=3, type=RecommendationType.Generic).create()
+        resp = self.app.get(BASE_URL + "/batch", query_string="product_id=1,2", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()["2"]), 1)
+
+    def test_lookup_recommendations_batch_bad_parameters(self):
+        """Look up many products with bad parameters"""
+        app.config["BATCH_LOOKUP_MAX"], batch_lookup_max = 2, app.config["BATCH_LOOKUP_MAX"]
+        try:
+            for query_string in ("", "product_id=", "product_id=1,x", "product_id=1,2,3",
+                                 "product_id=1&type=Unknown", "product_id=1&rec_product_id=x",
+                                 "product_id=1&limit=0", "product_id=1&sort=name"):
+                resp = self.app.get(BASE_URL + "/batch", query_string=query_string)
+                self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query_string)
+        finally:
+            app.config["BATCH_LOOKUP_MAX"] = batch_lookup_max
+
+    def test_create_recommendation_batch_no_content_type(self):
+        """Create a batch of Recommendations with no content type"""
+        resp = self.app.post(BASE_URL + "/batch")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_query_by_product_id_is_cached(self):
+        """Query Recommendations of a product from the cache"""
+        recs = self._create_recommendations(3)
+        query_string = "product_id={}".format(recs[0].product_id)
+        resp = self.app.get(BASE_URL, query_string=query_string)
+        hits = recommendation_cache.hits
+        with mock.patch.object(Recommendation, "find_page") as find_page:
+            cached = self.app.get(BASE_URL, query_string=query_string)
+            find_page.assert_not_called()
+        self.assertEqual(recommendation_cache.hits, hits + 1)
+        self.assertEqual(cached.get_json(), resp.get_json())
+
+    def test_cache_invalidated_by_writes(self):
+        """Query Recommendations of a product after writes to it"""
+        rec = self._create_recommendations(1)[0]
+        url = "{}?product_id={}".format(BASE_URL, rec.product_id)
+
+        self.assertEqual(len(self.app.get(url).get_json()), 1)
+        self.app.post(BASE_URL, json=dict(rec.serialize(), interested=0),
+                      content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(len(self.app.get(url).get_json()), 2)
+
+        self.app.put("{}/{}/interested".format(BASE_URL, rec.id), content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(self.app.get(url).get_json()[0]["interested"], 1)
+
+        moved = dict(rec.serialize(), product_id=rec.product_id + 1000, interested=1)
+        self.app.put("{}/{}".format(BASE_URL, rec.id), json=moved, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(len(self.app.get(url).get_json()), 1)
+
+        data = self.app.get(url).get_json()
+        self.app.delete("{}/{}".format(BASE_URL, data[0]["id"]))
+        self.assertEqual(self.app.get(url).get_json(), [])
+
+    def test_cache_sees_writes_of_other_workers(self):
+        """Query Recommendations of a product after a write the cache did not see"""
+        rec = self._create_recommendations(1)[0]
+        url = "{}?product_id={}".format(BASE_URL, rec.product_id)
+        self.assertEqual(len(self.app.get(url).get_json()), 1)
+        # another worker's write only bumps the data version
+        with mock.patch.object(recommendation_cache, "invalidate"):
+            Recommendation(product_id=rec.product_id, rec_product_id=2, type="Generic").create()
+        self.assertEqual(len(self.app.get(url).get_json()), 2)
+
+    def test_cached_query_is_paginated(self):
+        """Page through Recommendations of a product from the cache"""
+        for interested in [3, 7, 0]:
+            Recommendation(product_id=1, rec_product_id=2, interested=interested,
+                           type="Generic").create()
+        url = BASE_URL + "?product_id=1&sort=interested&limit=2"
+        self.app.get(url)
+        resp = self.app.get(url)
+        self.assertEqual([rec["interested"] for rec in resp.get_json()], [7, 3])
+        link = resp.headers["Link"]
+        resp = self.app.get(link[1:link.index(">")])
+        self.assertEqual([rec["interested"] for rec in resp.get_json()], [0])
+        self.assertNotIn("Link", resp.headers)
+
+    def test_large_query_read_once(self):
+        """Query a product with more Recommendations than a page with one query"""
+        for interested in [3, 7, 0]:
+            Recommendation(product_id=1, rec_product_id=2, interested=interested,
+                           type="Generic").create()
+        url = BASE_URL + "?product_id=1&limit=1"
+        app.config["PAGE_SIZE_MAX"], page_size_max = 2, app.config["PAGE_SIZE_MAX"]
+        try:
+            self.app.get(url)
+            with mock.patch.object(Recommendation, "find_page", wraps=Recommendation.find_page) as find_page:
+                resp = self.app.get(url)
+        finally:
+            app.config["PAGE_SIZE_MAX"] = page_size_max
+        self.assertEqual(len(resp.get_json()), 1)
+        self.assertEqual(find_page.call_count, 1)
+        Recommendation(product_id=1, rec_product_id=3, type="Generic").create()
+        self.assertEqual(len(self.app.get(BASE_URL + "?product_id=1").get_json()), 4)
+
+    def test_top_recommendations(self):
+        """Get the top Recommendations of a product"""
+        for interested, rec_type in [(3, "Generic"), (7, "UpSell"), (0, "Generic"), (5, "Generic")]:
+            Recommendation(product_id=1, rec_product_id=2, interested=interested,
+                           type=rec_type).create()
+        Recommendation(product_id=2, rec_product_id=2, interested=9, type="Generic").create()
+        resp = self.app.get("/products/1/recommendations/top", query_string="n=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([rec["interested"] for rec in resp.get_json()], [7, 5])
+        resp = self.app.get("/products/1/recommendations/top", query_string="type=Generic")
+        self.assertEqual([rec["interested"] for rec in resp.get_json()], [5, 3, 0])
+
+    def test_top_recommendations_without_cache(self):
+        """Get the top Recommendations of a product from the database"""
+        for interested in [3, 7, 0]:
+            Recommendation(product_id=1, rec_product_id=2, interested=interested,
+                           type="Generic").create()
+        with mock.patch.object(recommendation_cache, "max_size", 0):
+            resp = self.app.get("/products/1/recommendations/top", query_string="n=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([rec["interested"] for rec in resp.get_json()], [7, 3])
+
+    def test_top_recommendations_bad_parameters(self):
+        """Get the top Recommendations of a product with bad parameters"""
+        for query_string in ["n=0", "n=many", "type=Nope"]:
+            resp = self.app.get("/products/1/recommendations/top", query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query_string)
+
+    def test_output_matches_marshalled_model(self):
+        """Return the same JSON as marshalling with the Swagger model"""
+        recs = self._create_recommendations(3)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.content_type, CONTENT_TYPE_JSON)
+        expected = marshal([Recommendation.find(rec.id).serialize() for rec in recs],
+                           recommendation_model)
+        self.assertEqual(resp.get_json(), json.loads(json.dumps(expected)))
+        resp = self.app.get("{}/{}".format(BASE_URL, recs[0].id))
+        self.assertEqual(resp.get_json(), expected[0])
+
+    def test_get_recommendation_not_modified(self):
+        """Get a Recommendation the client already has"""
+        rec = self._create_recommendations(1)[0]
+        url = "{}/{}".format(BASE_URL, rec.id)
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        self.assertTrue(etag.startswith('W/"'))
+        # answered from the data version, without reading the Recommendation
+        with mock.patch.object(Recommendation, "find") as find:
+            resp = self.app.get(url, headers={"If-None-Match": etag})
+            find.assert_not_called()
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["ETag"], etag)
+
+        # writes to other products leave the ETag alone
+        other = Recommendation(product_id=rec.product_id + 1000, rec_product_id=1, type="Generic")
+        other.create()
+        self.app.put("{}/{}/interested".format(BASE_URL, other.id), content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.app.put(url + "/interested", content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_list_not_modified(self):
+        """List the Recommendations of a product the client already has"""
+        recs = self._create_recommendations(2)
+        url = "{}?product_id={}".format(BASE_URL, recs[0].product_id)
+        etag = self.app.get(url).headers["ETag"]
+        with mock.patch.object(Recommendation, "find_page") as find_page:
+            resp = self.app.get(url, headers={"If-None-Match": etag})
+            find_page.assert_not_called()
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # a write to another product leaves the list's ETag alone
+        other = dict(recs[0].serialize(), product_id=recs[0].product_id + 1000)
+        self.app.post(BASE_URL, json=other, content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.app.post(BASE_URL, json=recs[0].serialize(), content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_list_etag_depends_on_query(self):
+        """Give different pages of a list different ETags"""
+        self._create_recommendations(3)
+        first = self.app.get(BASE_URL, query_string="limit=1")
+        second = self.app.get(BASE_URL, query_string="limit=2")
+        self.assertNotEqual(first.headers["ETag"], second.headers["ETag"])
+        resp = self.app.get(BASE_URL, query_string="limit=2",
+                            headers={"If-None-Match": first.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_top_recommendations_not_modified(self):
+        """Get the top Recommendations of a product the client already has"""
+        rec = self._create_recommendations(1)[0]
+        url = "/products/{}/recommendations/top".format(rec.product_id)
+        etag = self.app.get(url).headers["ETag"]
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.app.put("{}/{}/interested".format(BASE_URL, rec.id), content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_metrics_multiprocess(self):
+        """Expose the metrics that every worker writes to PROMETHEUS_MULTIPROC_DIR"""
+        with tempfile.TemporaryDirectory() as path, \
+                mock.patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": path}), \
+                mock.patch.object(values, "ValueClass", values.MultiProcessValue()):
+            counter = Counter("recommendations_test_total", "A metric of a worker", registry=None)
+            counter.inc(3)
+            resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("recommendations_test_total 3.0", resp.get_data(as_text=True))
+
+    def test_gunicorn_conf_metrics_multiprocess(self):
+        """Turn the multiprocess metrics on before gunicorn.conf.py imports prometheus_client"""
+        env = {key: value for key, value in os.environ.items() if key != "PROMETHEUS_MULTIPROC_DIR"}
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run(
+            [sys.executable, "-c", "import runpy; runpy.run_path('gunicorn.conf.py'); "
+                                   "from prometheus_client import values; print(values.ValueClass.__name__)"],
+            cwd=root, env=env, capture_output=True, text=True, check=True)
+        self.assertNotEqual(result.stdout.strip(), values.MutexValue.__name__)
+
+    def test_metrics(self):
+        """Expose request and database metrics"""
+        rec = self._create_recommendations(1)[0]
+        self.app.get("{}/{}".format(BASE_URL, rec.id))
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        body = resp.get_data(as_text=True)
+        self.assertIn('recommendations_http_request_duration_seconds_count{method="GET",'
+                      'route="/recommendations/<int:id>",status="200"}', body)
+        self.assertIn('route="/recommendations",status="201"', body)
+        self.assertIn('recommendations_db_query_duration_seconds_count{statement="INSERT"}', body)
+        self.assertIn("recommendations_http_requests_in_flight", body)
+        self.assertIn("recommendations_db_pool_checked_out", body)
+        self.assertIn("recommendations_db_pool_overflow", body)